@@ -0,0 +1,283 @@
+"""Drive nicebear's chat API with a fixed number of concurrent clients or a fixed request rate,
+and report latency, time to first token, throughput and errors as JSON. Only needs the
+standard library.
+
+    python bench/loadgen.py --url http://localhost:5000 --concurrency 16 --duration 30
+    python bench/loadgen.py --url http://localhost:5000 --rate 20 --duration 30 --stream
+"""
+import argparse
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+class Result:
+    """Outcome of one request; times are in seconds"""
+
+    def __init__(self, status, latency, ttft=None, tokens=0, error=None, model=None):
+        self.status = status
+        self.latency = latency
+        self.ttft = ttft
+        self.tokens = tokens
+        self.error = error
+        self.model = model
+
+class Client:
+    """One keep-alive connection to nicebear, reopened after a failure"""
+
+    def __init__(self, url, stream=False, timeout=300):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = '/api/chat/stream' if stream else '/api/chat'
+        self.stream = stream
+        self.timeout = timeout
+        self.connection = None
+
+    def send(self, body, client_id, started=None):
+        """POST one chat request; latency counts from `started` when it was scheduled earlier"""
+        started = started if started is not None else time.perf_counter()
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request('POST', self.path, json.dumps(body),
+                                    {'Content-Type': 'application/json', 'X-Client-ID': f"loadgen-{client_id}"})
+            response = self.connection.getresponse()
+            if self.stream and response.status == 200:
+                return self.read_stream(response, started)
+            data = response.read()
+            latency = time.perf_counter() - started
+            if response.status != 200:
+                return Result(response.status, latency, error=data[:200].decode('utf-8', 'replace'))
+            reply = json.loads(data)
+            return Result(response.status, latency, tokens=len(reply.get('response', '').split()),
+                          model=reply.get('model'))
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self.close()
+            return Result(0, time.perf_counter() - started, error=f"{type(e).__name__}: {e}")
+
+    def read_stream(self, response, started):
+        ttft = None
+        tokens = 0
+        error = None
+        model = None
+        for line in response:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if chunk.get('response') and ttft is None:
+                ttft = time.perf_counter() - started
+            if 'error' in chunk:
+                error = chunk['error']
+            if chunk.get('restart'):
+                # A bigger model starts the reply over
+                tokens = 0
+            elif not chunk.get('done'):
+                tokens += 1
+            else:
+                model = chunk.get('model')
+        latency = time.perf_counter() - started
+        # Errors after the stream started still arrive with a 200, in the last chunk
+        return Result(response.status if error is None else 'stream_error', latency, ttft, tokens, error, model)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+class Prompts:
+    """Hands out request bodies, making each prompt unique unless repeats are wanted"""
+
+    def __init__(self, prompts, unique=True, cache=False):
+        self.prompts = prompts
+        self.unique = unique
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def next(self):
+        with self.lock:
+            n = self.count
+            self.count += 1
+        prompt = self.prompts[n % len(self.prompts)]
+        if self.unique:
+            prompt = f"{prompt} (request {n})"
+        return {'message': prompt, 'cache': self.cache}
+
+def percentiles(values):
+    """p50/p95/p99, mean and max in milliseconds, by the nearest-rank method"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))]
+
+    return {
+        'p50': round(rank(50) * 1000, 2),
+        'p95': round(rank(95) * 1000, 2),
+        'p99': round(rank(99) * 1000, 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+        'max': round(values[-1] * 1000, 2)
+    }
+
+def closed_loop(url, prompts, concurrency, duration, max_requests, stream):
+    """Each of `concurrency` clients sends its next request as soon as the last one finishes"""
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration if duration else None
+    sent = [0]
+
+    def worker(client_id):
+        client = Client(url, stream)
+        try:
+            while deadline is None or time.perf_counter() < deadline:
+                with lock:
+                    if max_requests and sent[0] >= max_requests:
+                        return
+                    sent[0] += 1
+                result = client.send(prompts.next(), client_id)
+                with lock:
+                    results.append(result)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def open_loop(url, prompts, rate, duration, max_requests, stream, max_in_flight, poisson=True, seed=None):
+    """Start requests at `rate` per second whether or not earlier ones have finished.
+
+    Latency is measured from when a request was due, not when it was sent, so a server that
+    falls behind shows it in the numbers instead of slowing the load down.
+    """
+    results = []
+    lock = threading.Lock()
+    local = threading.local()
+    clients = []
+    rng = random.Random(seed)
+
+    def send(client_id, due):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = Client(url, stream)
+            with lock:
+                clients.append(client)
+        result = client.send(prompts.next(), client_id, started=due)
+        with lock:
+            results.append(result)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        start = time.perf_counter()
+        due = start
+        n = 0
+        while (not duration or due < start + duration) and (not max_requests or n < max_requests):
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, n, due)
+            n += 1
+            due += rng.expovariate(rate) if poisson else 1.0 / rate
+    for client in clients:
+        client.close()
+    return results
+
+def report(results, elapsed, config):
+    ok = [r for r in results if r.status == 200]
+    errors = {}
+    for result in results:
+        if result.status != 200:
+            errors[str(result.status)] = errors.get(str(result.status), 0) + 1
+    models = {}
+    for result in ok:
+        if result.model:
+            models[result.model] = models.get(result.model, 0) + 1
+    return {
+        'config': config,
+        'requests': len(results),
+        'succeeded': len(ok),
+        'errors': errors,
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else 0.0,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        'tokens_per_s': round(sum(r.tokens for r in ok) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': percentiles([r.latency for r in ok]),
+        'ttft_ms': percentiles([r.ttft for r in ok if r.ttft is not None]),
+        'replies_by_model': models,
+        'sample_errors': sorted({r.error for r in results if r.error})[:5]
+    }
+
+def run(args):
+    """Run the load described by parsed arguments and return the report"""
+    prompts = [args.prompt]
+    if args.prompts:
+        with open(args.prompts, encoding='utf-8') as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    source = Prompts(prompts, unique=not args.repeat, cache=args.cache)
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'func')}
+    if args.warmup:
+        closed_loop(args.url, source, args.concurrency, args.warmup, 0, args.stream)
+    started = time.perf_counter()
+    if args.rate:
+        results = open_loop(args.url, source, args.rate, args.duration, args.requests, args.stream,
+                            args.max_in_flight, poisson=not args.uniform, seed=args.seed)
+    else:
+        results = closed_loop(args.url, source, args.concurrency, args.duration, args.requests, args.stream)
+    return report(results, time.perf_counter() - started, config)
+
+def check_thresholds(result, args):
+    """Return the reasons a run should fail CI, if any"""
+    failures = []
+    if args.max_error_rate is not None and result['error_rate'] > args.max_error_rate:
+        failures.append(f"error rate {result['error_rate']} > {args.max_error_rate}")
+    latency = result['latency_ms']
+    if args.max_p99_ms is not None and (latency is None or latency['p99'] > args.max_p99_ms):
+        failures.append(f"p99 latency {latency and latency['p99']} ms > {args.max_p99_ms} ms")
+    return failures
+
+def add_arguments(parser):
+    parser.add_argument('--url', default='http://localhost:5000', help='nicebear base URL')
+    parser.add_argument('--stream', action='store_true', help='use /api/chat/stream and measure time to first token')
+    parser.add_argument('--concurrency', type=int, default=8, help='clients in closed-loop mode (default 8)')
+    parser.add_argument('--rate', type=float, default=0.0, help='requests per second; switches to open-loop mode')
+    parser.add_argument('--uniform', action='store_true', help='space open-loop requests evenly instead of randomly')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='open-loop cap on outstanding requests')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run (default 10; 0 means no limit)')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (default no limit)')
+    parser.add_argument('--warmup', type=float, default=0.0, help='seconds of unmeasured load before the run')
+    parser.add_argument('--prompt', default='Tell me something about bears.', help='prompt to send')
+    parser.add_argument('--prompts', help='file with one prompt per line, sent in turn')
+    parser.add_argument('--repeat', action='store_true', help="send prompts as-is instead of making each unique")
+    parser.add_argument('--cache', action='store_true', help="let nicebear answer from its response cache")
+    parser.add_argument('--seed', type=int, default=None, help='seed for open-loop arrival times')
+    parser.add_argument('--max-error-rate', type=float, default=None, help='exit 1 if the error rate is higher')
+    parser.add_argument('--max-p99-ms', type=float, default=None, help='exit 1 if p99 latency is higher')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    if not args.duration and not args.requests:
+        parser.error('give --duration or --requests')
+    result = run(args)
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    failures = check_thresholds(result, args)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
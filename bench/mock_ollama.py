@@ -0,0 +1,279 @@
+"""A stand-in for the Ollama API with tunable speed and failure rate, for benchmarking nicebear
+without a GPU. Only needs the standard library.
+
+    python bench/mock_ollama.py --port 11434 --ttft 0.2 --tokens-per-second 50 --error-rate 0.01
+    python bench/mock_ollama.py --models small,nicebear --model-speeds small=4 --unsure small=0.2
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+UNSURE_REPLY = "I don't know."
+
+WORDS = ('the bear ambles through the quiet forest looking for honey and finds a stream '
+         'full of fish so it sits down on a warm rock and waits').split()
+
+class MockOllama:
+    """Timing and failure settings, plus which models are 'loaded' and until when"""
+
+    def __init__(self, ttft=0.1, tokens_per_second=50.0, tokens=32, error_rate=0.0,
+                 models=('nicebear',), load_time=0.0, embedding_size=64, seed=None, keep_alive=300.0,
+                 speeds=None, unsure=None, malformed_rate=0.0):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.error_rate = error_rate
+        # Share of streamed replies cut off by a line that isn't JSON, like a truncated write
+        self.malformed_rate = malformed_rate
+        self.models = [model_tag(model) for model in models]
+        # How many times faster than the base timings each model is, and how often it gives up
+        self.speeds = {model_tag(model): factor for model, factor in (speeds or {}).items()}
+        self.unsure = {model_tag(model): rate for model, rate in (unsure or {}).items()}
+        self.load_time = load_time
+        self.embedding_size = embedding_size
+        self.random = random.Random(seed)
+        self.keep_alive = keep_alive
+        self.lock = threading.Lock()
+        self.loaded = {}
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def garbles(self):
+        with self.lock:
+            return self.malformed_rate > 0 and self.random.random() < self.malformed_rate
+
+    def gives_up(self, model):
+        """Whether this reply is an "I don't know", for testing escalation to a bigger model"""
+        rate = self.unsure.get(model, 0.0)
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def keep_alive_seconds(self, keep_alive):
+        """Seconds a request asks to keep its model loaded, as Ollama reads keep_alive; None is for ever"""
+        if keep_alive is None:
+            return self.keep_alive
+        if isinstance(keep_alive, (int, float)):
+            seconds = float(keep_alive)
+        else:
+            parts = re.findall(r'(-?[0-9.]+)(ms|s|m|h)', keep_alive)
+            seconds = sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+        return None if seconds < 0 else seconds
+
+    def unload_idle(self):
+        now = time.monotonic()
+        for model, expires_at in list(self.loaded.items()):
+            if expires_at is not None and expires_at <= now:
+                del self.loaded[model]
+
+    def loaded_models(self):
+        with self.lock:
+            self.unload_idle()
+            return sorted(self.loaded)
+
+    def load(self, model, keep_alive=None):
+        """Return how long loading took; only a request that finds the model unloaded pays for it"""
+        seconds = self.keep_alive_seconds(keep_alive)
+        with self.lock:
+            self.unload_idle()
+            cold = model not in self.loaded
+        if cold:
+            time.sleep(self.load_time)
+        with self.lock:
+            self.loaded[model] = None if seconds is None else time.monotonic() + seconds
+        return self.load_time if cold else 0.0
+
+    def reply_tokens(self, prompt, limit=None):
+        count = self.tokens if limit is None else min(self.tokens, limit)
+        offset = len(prompt) % len(WORDS)
+        return [WORDS[(offset + i) % len(WORDS)] + ' ' for i in range(count)]
+
+    def embed(self, text):
+        vector = [0.0] * self.embedding_size
+        for word in text.lower().split():
+            vector[sum(word.encode()) % self.embedding_size] += 1.0
+        return vector
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def write_chunk(self, data):
+            line = (json.dumps(data) + '\n').encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == '/api/tags':
+                self.send_json({'models': [{'name': model, 'model': model} for model in mock.models]})
+            elif self.path == '/api/ps':
+                self.send_json({'models': [{'name': model, 'model': model} for model in mock.loaded_models()]})
+            elif self.path == '/api/version':
+                self.send_json({'version': '0.0.0-mock'})
+            else:
+                self.send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                data = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self.send_json({'error': 'invalid JSON'}, 400)
+                return
+            if self.path == '/api/generate':
+                self.generate(data)
+            elif self.path == '/api/embed':
+                texts = data.get('input', [])
+                texts = texts if isinstance(texts, list) else [texts]
+                self.send_json({'model': data.get('model'), 'embeddings': [mock.embed(text) for text in texts]})
+            elif self.path == '/api/embeddings':
+                self.send_json({'embedding': mock.embed(data.get('prompt', ''))})
+            else:
+                self.send_json({'error': 'not found'}, 404)
+
+        def generate(self, data):
+            model = model_tag(data.get('model', ''))
+            if model not in mock.models:
+                self.send_json({'error': f"model '{data.get('model')}' not found"}, 404)
+                return
+            if mock.should_fail():
+                self.send_json({'error': 'mock failure'}, 500)
+                return
+            started = time.perf_counter()
+            load_time = mock.load(model, data.get('keep_alive'))
+            prompt = data.get('prompt', '')
+            if not prompt and not data.get('context'):
+                # Like Ollama, a request without a prompt only loads the model
+                self.send_json({'model': model, 'response': '', 'done': True, 'done_reason': 'load',
+                                'load_duration': int(load_time * 1e9)})
+                return
+            tokens = mock.reply_tokens(prompt, (data.get('options') or {}).get('num_predict'))
+            if mock.gives_up(model):
+                tokens = [word + ' ' for word in UNSURE_REPLY.split()]
+            prompt_tokens = len(prompt.split()) + len(data.get('context') or [])
+            speed = mock.speeds.get(model, 1.0)
+            time.sleep(mock.ttft / speed)
+            prompt_eval_duration = time.perf_counter() - started - load_time
+            interval = 1.0 / (mock.tokens_per_second * speed) if mock.tokens_per_second > 0 else 0.0
+
+            eval_started = time.perf_counter()
+            if data.get('stream', True):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    garbled = mock.garbles()
+                    for i, token in enumerate(tokens):
+                        if i:
+                            time.sleep(interval)
+                        self.write_chunk({'model': model, 'response': token, 'done': False})
+                        if garbled and i == len(tokens) // 2:
+                            line = b'{"model": "' + model.encode('utf-8') + b'", "resp\n'
+                            self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(line), line))
+                            return
+                    self.write_chunk(final_chunk(model, '', data, prompt_tokens, len(tokens), started,
+                                                 load_time, prompt_eval_duration, eval_started))
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up; a real runner would stop generating too
+                    pass
+            else:
+                time.sleep(interval * max(len(tokens) - 1, 0))
+                self.send_json(final_chunk(model, ''.join(tokens), data, prompt_tokens, len(tokens), started,
+                                           load_time, prompt_eval_duration, eval_started))
+
+    return Handler
+
+def model_tag(model):
+    return model if ':' in model else f"{model}:latest"
+
+def parse_model_values(text):
+    """Parse "small=4,medium=2" into {'small': 4.0, 'medium': 2.0}"""
+    values = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        model, _, value = item.partition('=')
+        values[model.strip()] = float(value)
+    return values
+
+def final_chunk(model, response, data, prompt_tokens, eval_count, started, load_time, prompt_eval_duration,
+                eval_started):
+    """The last chunk of a generation, with timings in nanoseconds like Ollama reports them"""
+    now = time.perf_counter()
+    return {
+        'model': model,
+        'response': response,
+        'done': True,
+        'done_reason': 'stop',
+        'context': list(data.get('context') or []) + list(range(prompt_tokens + eval_count)),
+        'total_duration': int((now - started) * 1e9),
+        'load_duration': int(load_time * 1e9),
+        'prompt_eval_count': prompt_tokens,
+        'prompt_eval_duration': max(int(prompt_eval_duration * 1e9), 1),
+        'eval_count': eval_count,
+        'eval_duration': max(int((now - eval_started) * 1e9), 1)
+    }
+
+def serve(mock, host='127.0.0.1', port=11434):
+    """Start the mock in a background thread and return the server; call shutdown() to stop it"""
+    server = ThreadingHTTPServer((host, port), make_handler(mock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-ollama', daemon=True).start()
+    return server
+
+def add_arguments(parser):
+    parser.add_argument('--ttft', type=float, default=0.1, help='seconds before the first token (default 0.1)')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0, help='generation speed (default 50)')
+    parser.add_argument('--tokens', type=int, default=32, help='tokens in every reply (default 32)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of generations answered with a 500 (default 0)')
+    parser.add_argument('--malformed-rate', type=float, default=0.0,
+                        help='fraction of streamed replies cut off by a line that is not JSON (default 0)')
+    parser.add_argument('--models', default='nicebear', help='comma-separated models to serve (default nicebear)')
+    parser.add_argument('--load-time', type=float, default=0.0,
+                        help='seconds the first request for each model spends loading it (default 0)')
+    parser.add_argument('--keep-alive', type=float, default=300.0,
+                        help="seconds a model stays loaded after a request that doesn't set keep_alive (default 300)")
+    parser.add_argument('--model-speeds', default='',
+                        help='comma-separated MODEL=FACTOR, how many times faster than the base timings a model is')
+    parser.add_argument('--unsure', default='',
+                        help="comma-separated MODEL=RATE, the fraction of a model's replies that just say it doesn't know")
+    parser.add_argument('--error-seed', type=int, default=None, help='seed for the error and unsure reply injection')
+
+def mock_from_args(args):
+    return MockOllama(ttft=args.ttft, tokens_per_second=args.tokens_per_second, tokens=args.tokens,
+                      error_rate=args.error_rate, models=args.models.split(','), load_time=args.load_time,
+                      seed=args.error_seed, keep_alive=args.keep_alive, speeds=parse_model_values(args.model_speeds),
+                      unsure=parse_model_values(args.unsure), malformed_rate=args.malformed_rate)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(mock_from_args(args)))
+    server.daemon_threads = True
+    print(f"Mock Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,98 @@
+"""Benchmark nicebear end to end on one machine: start the mock Ollama, start nicebear against
+it, drive it with the load generator and print the JSON report. Needs Flask and requests
+like nicebear itself, plus uvicorn, httpx and asgiref for --server asgi.
+
+    python bench/run.py --concurrency 16 --duration 20 --output bench.json
+    python bench/run.py --server asgi --rate 50 --stream --max-p99-ms 2000
+    python bench/run.py --cascade --models small,nicebear --model-speeds small=4 --unsure small=0.2
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import loadgen
+import mock_ollama
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_nicebear(server, port, env, log):
+    if server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'nicebear:asgi_app', '--port', str(port),
+                   '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-c',
+                   f"import nicebear; nicebear.app.run(port={port}, threaded=True)"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_until_up(url, process, log_path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            with open(log_path, encoding='utf-8', errors='replace') as f:
+                raise SystemExit(f"nicebear exited early:\n{f.read()}")
+        try:
+            urllib.request.urlopen(f"{url}/api/stats", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"nicebear did not start within {timeout} seconds")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask',
+                        help='serve nicebear with the threaded Flask server or uvicorn (default flask)')
+    parser.add_argument('--cascade', action='store_true',
+                        help='route between the mock models as tiers, smallest first, instead of using the first one')
+    mock_group = parser.add_argument_group('mock Ollama')
+    mock_ollama.add_arguments(mock_group)
+    load_group = parser.add_argument_group('load')
+    loadgen.add_arguments(load_group)
+    parser.set_defaults(url=None)
+    args = parser.parse_args(argv)
+
+    mock_port = free_port()
+    mock = mock_ollama.serve(mock_ollama.mock_from_args(args), port=mock_port)
+    port = free_port()
+    args.url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ,
+               'NICEBEAR_OLLAMA_HOST': f"http://127.0.0.1:{mock_port}",
+               'NICEBEAR_MODEL': args.models.split(',')[0],
+               'NICEBEAR_DB_PATH': os.path.join(tmp, 'bench.db'),
+               'NICEBEAR_TRACE_PATH': os.path.join(tmp, 'traces.jsonl')}
+        if args.cascade:
+            env['NICEBEAR_MODEL_TIERS'] = args.models
+        log_path = os.path.join(tmp, 'nicebear.log')
+        with open(log_path, 'wb') as log:
+            process = start_nicebear(args.server, port, env, log)
+        try:
+            wait_until_up(args.url, process, log_path)
+            result = loadgen.run(args)
+        finally:
+            process.terminate()
+            process.wait()
+            mock.shutdown()
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    failures = loadgen.check_thresholds(result, args)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,53 +1,4038 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+import argparse
+import asyncio
+import bisect
+import contextvars
+import gzip
+import hashlib
+import html
 import json
+import logging
+import math
 import os
+import random
+import re
+import sqlite3
+import sys
 import threading
+import time
+import uuid
 import webbrowser
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from logging.handlers import RotatingFileHandler
+from urllib.parse import parse_qs
 
-# Ollama API endpoint (default is localhost:11434)
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
+try:
+    import httpx  # only needed for the ASGI serving mode
+except ImportError:
+    httpx = None
+
+try:
+    import numpy as np  # only needed for the semantic cache
+except ImportError:
+    np = None
+
+try:
+    import brotli  # optional; static assets are also offered brotli-compressed when present
+except ImportError:
+    brotli = None
+
+try:
+    from asgiref.sync import sync_to_async
+    from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance  # lets the ASGI app fall back to the Flask routes
+except ImportError:
+    WsgiToAsgi = None
+
+# Ollama server and model name (default is localhost:11434 and the custom nicebear model)
+OLLAMA_HOST = os.environ.get('NICEBEAR_OLLAMA_HOST', 'http://localhost:11434').rstrip('/')
+OLLAMA_MODEL = os.environ.get('NICEBEAR_MODEL', 'nicebear')
+
+# Ollama hosts to spread load over (comma-separated, defaults to NICEBEAR_OLLAMA_HOST),
+# seconds between health checks, and whether a conversation should keep going to the host
+# that holds its KV cache
+OLLAMA_HOSTS = [host.strip().rstrip('/') for host in
+                os.environ.get('NICEBEAR_OLLAMA_HOSTS', OLLAMA_HOST).split(',') if host.strip()]
+HEALTH_CHECK_INTERVAL = float(os.environ.get('NICEBEAR_HEALTH_CHECK_INTERVAL', '10'))
+STICKY_SESSIONS = os.environ.get('NICEBEAR_STICKY_SESSIONS', '0') == '1'
+
+# Connection pool size, timeouts in seconds and retry policy for calls to Ollama
+OLLAMA_POOL_SIZE = int(os.environ.get('NICEBEAR_POOL_SIZE', '10'))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get('NICEBEAR_CONNECT_TIMEOUT', '5'))
+OLLAMA_READ_TIMEOUT = float(os.environ.get('NICEBEAR_READ_TIMEOUT', '300'))
+OLLAMA_MAX_RETRIES = int(os.environ.get('NICEBEAR_MAX_RETRIES', '2'))
+OLLAMA_RETRY_BACKOFF = float(os.environ.get('NICEBEAR_RETRY_BACKOFF', '0.5'))
+
+# Upper bound on concurrent connections from the ASGI app's async client
+OLLAMA_ASYNC_MAX_CONNECTIONS = int(os.environ.get('NICEBEAR_ASYNC_MAX_CONNECTIONS', '1000'))
+
+# WebSocket connections: messages waiting to be sent on one before replies have to wait for the
+# client, chat requests one may run at once, and seconds between checks of a queued request's place
+WS_SEND_QUEUE = 64
+WS_MAX_REQUESTS = 8
+WS_QUEUE_REPORT_INTERVAL = 1.0
+
+# How long Ollama keeps the model in memory after each request (a duration such as 30m, plain
+# seconds, or -1 for ever), whether to load it when nicebear starts, and seconds between pings
+# that keep it loaded (0 disables them). A generation that waits COLD_LOAD_SECONDS or more for
+# the model to load counts as a cold load.
+KEEP_ALIVE = os.environ.get('NICEBEAR_KEEP_ALIVE', '30m')
+if KEEP_ALIVE.lstrip('-').isdigit():
+    KEEP_ALIVE = int(KEEP_ALIVE)  # Ollama only parses durations given as strings with a unit
+PRELOAD_MODEL = os.environ.get('NICEBEAR_PRELOAD', '1') == '1'
+KEEP_WARM_INTERVAL = float(os.environ.get('NICEBEAR_KEEP_WARM_INTERVAL', '0'))
+COLD_LOAD_SECONDS = 1.0
+
+# SQLite file holding the conversation history, page sizes for the history and search endpoints,
+# and how many words a search result shows around its match
+DB_PATH = os.environ.get('NICEBEAR_DB_PATH',
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nicebear.db'))
+CONVERSATION_PAGE_SIZE = 30
+MESSAGE_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+SEARCH_SNIPPET_TOKENS = 16
+
+# How many conversations keep their model context between turns
+CONTEXT_CACHE_SIZE = int(os.environ.get('NICEBEAR_CONTEXT_CACHE_SIZE', '256'))
+
+# Prompt size limit in tokens for a conversation turn, an optional system prompt sent with
+# every request, and whether turns that slide out of the window are folded into a summary
+# (at most SUMMARY_TOKENS long) by a background job
+PROMPT_TOKEN_BUDGET = int(os.environ.get('NICEBEAR_PROMPT_TOKEN_BUDGET', '4096'))
+SYSTEM_PROMPT = os.environ.get('NICEBEAR_SYSTEM_PROMPT', '')
+SUMMARIZE_ENABLED = os.environ.get('NICEBEAR_SUMMARIZE', '1') == '1'
+SUMMARY_TOKENS = int(os.environ.get('NICEBEAR_SUMMARY_TOKENS', str(PROMPT_TOKEN_BUDGET // 4)))
+
+# Exact-match response cache: entries kept (0 disables), seconds each entry lives, and an
+# optional SQLite file that keeps the cache across restarts
+RESPONSE_CACHE_SIZE = int(os.environ.get('NICEBEAR_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_TTL = float(os.environ.get('NICEBEAR_CACHE_TTL', '3600'))
+RESPONSE_CACHE_PATH = os.environ.get('NICEBEAR_CACHE_PATH', '')
+
+# Semantic cache: serves the stored reply of an earlier prompt whose embedding is at least
+# SEMANTIC_CACHE_THRESHOLD cosine-similar. Off unless NICEBEAR_SEMANTIC_CACHE=1; the path is a
+# file prefix for the memory-mapped vectors (.npy) and their replies (.db)
+SEMANTIC_CACHE_ENABLED = os.environ.get('NICEBEAR_SEMANTIC_CACHE', '0') == '1'
+SEMANTIC_CACHE_SIZE = int(os.environ.get('NICEBEAR_SEMANTIC_CACHE_SIZE', '10000'))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('NICEBEAR_SEMANTIC_THRESHOLD', '0.92'))
+SEMANTIC_CACHE_PATH = os.environ.get('NICEBEAR_SEMANTIC_CACHE_PATH', '')
+EMBED_MODEL = os.environ.get('NICEBEAR_EMBED_MODEL', 'nomic-embed-text')
+
+# Admission control: generations allowed upstream at once per Ollama host, requests allowed
+# to wait (in total and per client), and how long one may wait in seconds before giving up
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get('NICEBEAR_MAX_CONCURRENT', '4'))
+MAX_QUEUE = int(os.environ.get('NICEBEAR_MAX_QUEUE', '64'))
+MAX_QUEUE_PER_CLIENT = int(os.environ.get('NICEBEAR_MAX_QUEUE_PER_CLIENT', '8'))
+QUEUE_TIMEOUT = float(os.environ.get('NICEBEAR_QUEUE_TIMEOUT', '120'))
+
+# Generation profiles: named sets of Ollama options, from the most to the least expensive;
+# NICEBEAR_PROFILES replaces them with a JSON object of the same shape. A chat request may name
+# one as "profile". Otherwise the load policy picks it, stepping down one profile while
+# PROFILE_QUEUE_HIGH requests wait ahead of it or the average time to first token is over
+# PROFILE_TTFT_HIGH seconds, and back up once both are under PROFILE_RECOVER times that. Each
+# step holds for PROFILE_HOLD_SECONDS at least, so the profile doesn't flap.
+GENERATION_PROFILES = json.loads(os.environ.get('NICEBEAR_PROFILES', 'null')) or {
+    'full': {},
+    'balanced': {'num_predict': 512},
+    'fast': {'num_predict': 128}
+}
+ADAPTIVE_PROFILES = os.environ.get('NICEBEAR_ADAPTIVE_PROFILES', '1') == '1'
+PROFILE_QUEUE_HIGH = int(os.environ.get('NICEBEAR_PROFILE_QUEUE_HIGH', '8'))
+PROFILE_TTFT_HIGH = float(os.environ.get('NICEBEAR_PROFILE_TTFT_HIGH', '5'))
+PROFILE_RECOVER = 0.5
+PROFILE_HOLD_SECONDS = float(os.environ.get('NICEBEAR_PROFILE_HOLD_SECONDS', '10'))
+
+# Model cascade: chat models from the smallest to the largest (NICEBEAR_MODEL alone by
+# default). Each prompt goes to the smallest tier the classifier thinks it needs: every sign of
+# a harder prompt (ROUTE_LONG_PROMPT_TOKENS tokens or more, a match for ROUTE_KEYWORDS, a
+# conversation ROUTE_DEEP_CONVERSATION messages long) moves it a tier up. An answer that is
+# empty or matches ESCALATE_PATTERN is asked again of the next tier up.
+MODEL_TIERS = [model.strip() for model in os.environ.get('NICEBEAR_MODEL_TIERS', '').split(',')
+               if model.strip()] or [OLLAMA_MODEL]
+ROUTE_LONG_PROMPT_TOKENS = int(os.environ.get('NICEBEAR_ROUTE_LONG_PROMPT', '150'))
+ROUTE_DEEP_CONVERSATION = int(os.environ.get('NICEBEAR_ROUTE_DEEP_CONVERSATION', '12'))
+ROUTE_KEYWORDS = os.environ.get('NICEBEAR_ROUTE_KEYWORDS',
+                                r'\b(code|debug|explain|why|prove|analy[sz]e|compare|calculate|translate|step by step)\b|```')
+ESCALATE_PATTERN = os.environ.get('NICEBEAR_ESCALATE_PATTERN',
+                                  r"\b(I don'?t know|I do not know|I'?m not sure|I can'?t help|I cannot help)\b")
+
+# Batch runs: prompts answered at once by default and at most, and results between the
+# checkpoints /api/batch sends back
+BATCH_PARALLEL = int(os.environ.get('NICEBEAR_BATCH_PARALLEL', '4'))
+BATCH_MAX_PARALLEL = 32
+BATCH_CHECKPOINT_EVERY = 10
+
+# Request tracing: the share of chat requests whose timeline is kept, besides every one slower
+# than TRACE_SLOW_SECONDS or that failed; the JSONL file kept traces are written to (empty for
+# none), its size before it is rotated, and how many recent traces /api/debug/traces looks through
+TRACE_SAMPLE_RATE = float(os.environ.get('NICEBEAR_TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SLOW_SECONDS = float(os.environ.get('NICEBEAR_TRACE_SLOW_SECONDS', '10'))
+TRACE_PATH = os.environ.get('NICEBEAR_TRACE_PATH',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces.jsonl'))
+TRACE_MAX_BYTES = int(os.environ.get('NICEBEAR_TRACE_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_BACKUPS = 3
+TRACE_RECENT = 500
+
+# Seconds browsers may keep the bear images without asking again, and the smallest JSON
+# response worth compressing
+ASSET_MAX_AGE = int(os.environ.get('NICEBEAR_ASSET_MAX_AGE', str(7 * 24 * 3600)))
+COMPRESS_MIN_SIZE = 1024
+
+# Priority classes a request can ask for, highest first
+PRIORITIES = ('high', 'normal', 'low')
+
+# Timing fields from Ollama's final chunk that are passed through to the client
+STATS_FIELDS = ('total_duration', 'load_duration', 'prompt_eval_count',
+                'prompt_eval_duration', 'eval_count', 'eval_duration')
 
 app = Flask(__name__, static_folder='static')
 
-def generate_response(prompt):
-    """Generate a response from the Dolphin-Llama3 model using Ollama API"""
+class OllamaError(Exception):
+    """Raised when Ollama can't be reached or answers with an error"""
+    status = 502
+
+class OllamaTimeout(OllamaError):
+    """Raised when Ollama doesn't respond within the timeout"""
+    status = 504
+
+class OllamaUnavailable(OllamaError):
+    """Raised when no connection to Ollama could be made, so the request never reached it"""
+
+# Metrics, served from /metrics in the Prometheus text format. Every thread records into its
+# own shard of each metric, so the hot path takes no lock; a scrape adds the shards up. The
+# event loop is a single thread, so the ASGI handlers share one shard.
+
+registered_metrics = []
+
+class Metric:
+    """A named metric whose values are kept per label set in per-thread shards"""
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+        registered_metrics.append(self)
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.retire_finished()
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def retire_finished(self):
+        """Fold the shards of threads that have exited into one, so short-lived threads don't pile up"""
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = live
+
+    def collect(self):
+        with self.lock:
+            self.retire_finished()
+            total = {}
+            self.merge(total, self.retired)
+            for _, shard in self.shards:
+                self.merge(total, shard)
+        return total
+
+    def label_text(self, values, extra=''):
+        pairs = [f'{label}="{metric_label_value(value)}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, value in sorted(self.collect().items()):
+            lines.extend(self.sample_lines(values, value))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def merge(self, total, shard):
+        for labels, value in list(shard.items()):
+            total[labels] = total.get(labels, 0) + value
+
+    def sample_lines(self, labels, value):
+        return [f'{self.name}{self.label_text(labels)} {value}']
+
+class Histogram(Metric):
+    """Fixed buckets; a value is counted in the first bucket it fits, the sum kept last"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def merge(self, total, shard):
+        for labels, counts in list(shard.items()):
+            if labels in total:
+                total[labels] = [a + b for a, b in zip(total[labels], counts)]
+            else:
+                total[labels] = list(counts)
+
+    def sample_lines(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f'{self.name}_bucket{self.label_text(labels, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{self.label_text(labels)} {counts[-1]}')
+        lines.append(f'{self.name}_count{self.label_text(labels)} {cumulative}')
+        return lines
+
+def metric_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+http_requests = Counter('nicebear_http_requests_total', 'HTTP requests by route, method and status',
+                        ('route', 'method', 'status'))
+http_request_seconds = Histogram('nicebear_http_request_duration_seconds',
+                                 'Time from receiving a request to sending the last byte of its response',
+                                 LATENCY_BUCKETS, ('route',))
+first_token_seconds = Histogram('nicebear_time_to_first_token_seconds',
+                                'Time from receiving a chat request to its first token, by where the reply came from',
+                                LATENCY_BUCKETS, ('source',))
+prompt_tokens_per_second = Histogram('nicebear_prompt_tokens_per_second',
+                                     'Prompt processing speed of each generation', TOKEN_RATE_BUCKETS)
+generation_tokens_per_second = Histogram('nicebear_generation_tokens_per_second',
+                                         'Token generation speed of each generation', TOKEN_RATE_BUCKETS)
+model_load_seconds = Histogram('nicebear_model_load_seconds', 'Time Ollama spent loading the model per generation',
+                               LATENCY_BUCKETS)
+model_cold_loads = Counter('nicebear_model_cold_loads_total',
+                           'Generations that waited for Ollama to load the model from scratch')
+prompt_tokens = Counter('nicebear_prompt_tokens_total', 'Prompt tokens processed by Ollama')
+generated_tokens = Counter('nicebear_generated_tokens_total', 'Tokens generated by Ollama')
+upstream_errors = Counter('nicebear_upstream_errors_total', 'Failed calls to Ollama by kind of failure', ('kind',))
+cancelled_generations = Counter('nicebear_generations_cancelled_total',
+                                'Chat requests stopped before their reply was complete, by why', ('reason',))
+cancelled_tokens_saved = Counter('nicebear_cancelled_tokens_saved_total',
+                                 'Estimated tokens Ollama did not have to generate because a request was cancelled')
+batch_items = Counter('nicebear_batch_items_total', 'Batch prompts answered, by outcome', ('outcome',))
+model_routes = Counter('nicebear_model_routes_total', 'Chat requests by the model tier they were sent to, and why',
+                       ('model', 'reason'))
+model_escalations = Counter('nicebear_model_escalations_total',
+                            'Answers that failed the check and were asked again of a bigger model', ('model',))
+generation_profiles = Counter('nicebear_generation_profile_total', 'Chat requests by the generation profile serving them',
+                              ('profile',))
+
+def upstream_error(error):
+    """Count an error from Ollama and return it, for `raise upstream_error(...)`"""
+    if isinstance(error, OllamaUnavailable):
+        upstream_errors.inc('unavailable')
+    elif isinstance(error, OllamaTimeout):
+        upstream_errors.inc('timeout')
+    else:
+        upstream_errors.inc('error')
+    return error
+
+def parse_chunk(line):
+    """Decode one line of an Ollama stream, raising OllamaError for one that isn't a JSON object"""
     try:
-        data = {
-            "model": "nicebear",  # Using the custom model name
-            "prompt": prompt,
-            "stream": False
+        chunk = json.loads(line)
+    except ValueError as e:
+        raise upstream_error(OllamaError(f"Ollama sent a malformed chunk: {e}")) from e
+    if not isinstance(chunk, dict):
+        raise upstream_error(OllamaError("Ollama sent a malformed chunk"))
+    return chunk
+
+def record_generation(result):
+    """Record the timings Ollama reports in the final chunk of a generation"""
+    if result.get('prompt_eval_count') and result.get('prompt_eval_duration'):
+        prompt_tokens.inc(amount=result['prompt_eval_count'])
+        prompt_tokens_per_second.observe(result['prompt_eval_count'] * 1e9 / result['prompt_eval_duration'])
+    if result.get('eval_count') and result.get('eval_duration'):
+        generated_tokens.inc(amount=result['eval_count'])
+        generation_tokens_per_second.observe(result['eval_count'] * 1e9 / result['eval_duration'])
+    if result.get('load_duration'):
+        model_load_seconds.observe(result['load_duration'] / 1e9)
+        if result['load_duration'] >= COLD_LOAD_SECONDS * 1e9:
+            model_cold_loads.inc()
+    trace_generation(result)
+
+def record_request(route, method, status, started):
+    http_requests.inc(route, method, status)
+    http_request_seconds.observe(time.perf_counter() - started, route)
+
+# Tracing: a chat request records a timeline of spans (queueing, connecting to Ollama,
+# Ollama's own load, prompt and generation phases, storing the reply...) in a context
+# variable, at the cost of a tuple per span. Whether the trace is kept is only decided when
+# the request ends: a TRACE_SAMPLE_RATE share of them are, and every slow or failed one.
+
+_current_trace = contextvars.ContextVar('nicebear_trace', default=None)
+
+class Trace:
+    """The timeline of one request; span times are perf_counter() readings"""
+
+    def __init__(self, name, sampled):
+        self.name = name
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.attributes = {}
+        self.error = None
+
+    def add(self, name, start, end, attributes=None):
+        self.spans.append((name, start, end, attributes))
+
+    def to_dict(self, duration, status, kept):
+        return {
+            'trace_id': self.attributes.get('request_id'),
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': round(duration * 1000, 3),
+            'status': status,
+            'error': self.error,
+            'kept': kept,
+            'attributes': self.attributes,
+            'spans': [{'name': name, 'start_ms': round((start - self.started) * 1000, 3),
+                       'duration_ms': round((end - start) * 1000, 3), **(attributes or {})}
+                      for name, start, end, attributes in sorted(self.spans, key=lambda span: span[1])]
         }
-        
-        response = requests.post(OLLAMA_API_URL, json=data)
-        if response.status_code == 200:
-            return response.json().get('response', 'No response generated')
+
+@contextmanager
+def trace_span(name, **attributes):
+    """Time the block as a span of the current request's trace, if there is one"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        attributes['error'] = type(e).__name__
+        raise
+    finally:
+        trace.add(name, start, time.perf_counter(), attributes or None)
+
+def trace_event(name):
+    """Mark a moment, such as the first token, in the current request's trace"""
+    trace = _current_trace.get()
+    if trace is not None:
+        now = time.perf_counter()
+        trace.add(name, now, now)
+
+def trace_tag(**attributes):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+def trace_error(error):
+    """Mark the current request as failed even though its status doesn't show it, as in a stream"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.error = str(error)
+
+def trace_generation(result):
+    """Add Ollama's load, prompt and generation times from its final chunk, placed to end now"""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    end = time.perf_counter()
+    eval_start = end - result.get('eval_duration', 0) / 1e9
+    prompt_start = eval_start - result.get('prompt_eval_duration', 0) / 1e9
+    trace.add('ollama.eval', eval_start, end, {'tokens': result.get('eval_count')})
+    trace.add('ollama.prompt_eval', prompt_start, eval_start, {'tokens': result.get('prompt_eval_count')})
+    if result.get('load_duration'):
+        trace.add('ollama.load', prompt_start - result['load_duration'] / 1e9, prompt_start)
+
+class Tracer:
+    """Decides which traces to keep, writes them to a rotating JSONL file and remembers the latest"""
+
+    def __init__(self, sample_rate, slow_seconds, path, max_bytes, backups, recent):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=recent)
+        self.traced = 0
+        self.kept = {'failed': 0, 'slow': 0, 'sampled': 0}
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.logger = None
+        self.handler = None
+        self.pid = None
+        if path:
+            self.logger = logging.getLogger('nicebear.traces')
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def open_file(self):
+        """Give this process a handler of its own for the trace file, the first time it writes one.
+
+        A {pid} in the path becomes the process ID, so each worker of a multi-process server writes
+        and rotates its own file; workers sharing one would rotate it out from under each other.
+        Workers forked after the app was loaded get their own ID, not the parent's.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.handler is not None:
+                self.logger.removeHandler(self.handler)
+                self.handler.close()
+            self.handler = RotatingFileHandler(self.path.replace('{pid}', str(os.getpid())), maxBytes=self.max_bytes,
+                                               backupCount=self.backups, encoding='utf-8')
+            self.handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(self.handler)
+            self.pid = os.getpid()
+
+    def start(self, name):
+        """Start tracing a request in the current context and return its trace"""
+        trace = Trace(name, random.random() < self.sample_rate)
+        _current_trace.set(trace)
+        return trace
+
+    def finish(self, trace, status):
+        """End the request's trace, keeping it if it was sampled, slow or failed"""
+        _current_trace.set(None)
+        duration = time.perf_counter() - trace.started
+        # A cancelled request didn't fail; its client gave up on it
+        if trace.error is not None or (status >= 400 and status != GenerationCancelled.status):
+            kept = 'failed'
+        elif duration >= self.slow_seconds:
+            kept = 'slow'
+        elif trace.sampled:
+            kept = 'sampled'
+        else:
+            kept = None
+        with self.lock:
+            self.traced += 1
+            if kept is None:
+                return
+            self.kept[kept] += 1
+        record = trace.to_dict(duration, status, kept)
+        with self.lock:
+            self.recent.append(record)
+        if self.logger is not None:
+            if self.pid != os.getpid():
+                self.open_file()
+            self.logger.info(json.dumps(record))
+
+    def slowest(self, limit):
+        with self.lock:
+            records = list(self.recent)
+        return sorted(records, key=lambda record: record['duration_ms'], reverse=True)[:limit]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'traced': self.traced,
+                'kept': dict(self.kept),
+                'sample_rate': self.sample_rate,
+                'slow_seconds': self.slow_seconds
+            }
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS, TRACE_PATH, TRACE_MAX_BYTES, TRACE_BACKUPS, TRACE_RECENT)
+
+# Routes whose POSTs are traced; chats over the WebSocket are traced one by one
+TRACED_ROUTES = ('/api/chat', '/api/chat/stream')
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Return the process-wide session that keeps connections to Ollama alive"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # Connection errors are retried for any method because the request never
+                # reached Ollama; read errors and 5xx answers are only retried for GETs so a
+                # generation is never started twice
+                retry = Retry(
+                    total=OLLAMA_MAX_RETRIES,
+                    connect=OLLAMA_MAX_RETRIES,
+                    read=OLLAMA_MAX_RETRIES,
+                    status=OLLAMA_MAX_RETRIES,
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=frozenset(['GET', 'HEAD']),
+                    backoff_factor=OLLAMA_RETRY_BACKOFF,
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_maxsize=OLLAMA_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+def ollama_request(method, path, backend=None, **kwargs):
+    """Send a request to Ollama through the shared session, raising OllamaError on failure"""
+    url = (backend.url if backend is not None else OLLAMA_HOST) + path
+    try:
+        response = get_session().request(method, url,
+                                         timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
+                                         **kwargs)
+    except requests.ConnectTimeout as e:
+        raise upstream_error(OllamaUnavailable(f"Could not connect to Ollama at {url}: {e}")) from e
+    except requests.Timeout as e:
+        raise upstream_error(OllamaTimeout(f"Ollama timed out: {e}")) from e
+    except requests.ConnectionError as e:
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        if isinstance(reason, NewConnectionError):
+            raise upstream_error(OllamaUnavailable(f"Could not connect to Ollama at {url}: {e}")) from e
+        raise upstream_error(OllamaError(f"Could not reach Ollama: {e}")) from e
+    except requests.RequestException as e:
+        raise upstream_error(OllamaError(f"Could not reach Ollama: {e}")) from e
+    if response.status_code != 200:
+        message = f"{response.status_code} - {response.text}"
+        response.close()
+        raise upstream_error(OllamaError(message))
+    return response
+
+# Backend pool: every generation goes to the healthy Ollama host with the fewest requests in
+# flight. A background thread polls each host for health and for the models it has loaded.
+
+def model_tag(model):
+    """Ollama lists models with their tag, e.g. nicebear:latest"""
+    return model if ':' in model else f"{model}:latest"
+
+class Backend:
+    """One Ollama host and what the pool knows about it"""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.models = set()
+        self.loaded = set()
+        self.last_error = None
+        self.checked_at = None
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'loaded_models': sorted(self.loaded),
+            'last_error': self.last_error,
+            'checked_at': self.checked_at
+        }
+
+class BackendPool:
+    """Least-outstanding-requests routing over several Ollama hosts with failover"""
+
+    def __init__(self, urls, sticky=False, max_sticky=CONTEXT_CACHE_SIZE):
+        self.backends = [Backend(url) for url in urls]
+        self.sticky = sticky
+        self.max_sticky = max_sticky
+        self.assignments = OrderedDict()
+        self.lock = threading.Lock()
+        self.checker = None
+
+    def pick(self, model=None, conversation_id=None, exclude=()):
+        """Reserve the best backend for a request, or return None if every one has been tried"""
+        self.start_health_checks()
+        with self.lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            # With every host marked down, still try them rather than fail without asking
+            candidates = [b for b in candidates if b.healthy] or candidates
+            if not candidates:
+                return None
+            backend = None
+            if self.sticky and conversation_id:
+                backend = self.assignments.get(conversation_id)
+                if backend not in candidates:
+                    backend = None
+            if backend is None:
+                if model:
+                    tag = model_tag(model)
+                    # Only hosts known to have the model, unless none of them report it
+                    candidates = [b for b in candidates if not b.models or tag in b.models] or candidates
+                    backend = min(candidates, key=lambda b: (b.outstanding, tag not in b.loaded))
+                else:
+                    backend = min(candidates, key=lambda b: b.outstanding)
+            if self.sticky and conversation_id:
+                self.assignments[conversation_id] = backend
+                self.assignments.move_to_end(conversation_id)
+                while len(self.assignments) > self.max_sticky:
+                    self.assignments.popitem(last=False)
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend, error=None):
+        """Return a backend picked for a request, ejecting it if it couldn't be reached"""
+        with self.lock:
+            backend.outstanding -= 1
+            if error is not None:
+                backend.healthy = False
+                backend.failures += 1
+                backend.last_error = str(error)
+
+    def check(self, backend):
+        """Ask a backend which models it has and which are loaded; marks it up or down"""
+        try:
+            timeout = (OLLAMA_CONNECT_TIMEOUT, 5)
+            tags = get_session().get(backend.url + '/api/tags', timeout=timeout)
+            tags.raise_for_status()
+            running = get_session().get(backend.url + '/api/ps', timeout=timeout)
+            running.raise_for_status()
+        except requests.RequestException as e:
+            with self.lock:
+                backend.healthy = False
+                backend.last_error = str(e)
+                backend.checked_at = time.time()
+            return False
+        with self.lock:
+            backend.models = {m['name'] for m in tags.json().get('models', [])}
+            backend.loaded = {m['name'] for m in running.json().get('models', [])}
+            backend.healthy = True
+            backend.checked_at = time.time()
+        return True
+
+    def check_all(self):
+        for backend in self.backends:
+            self.check(backend)
+
+    def start_health_checks(self):
+        """Start polling the backends in the background, once per process"""
+        if self.checker is not None or HEALTH_CHECK_INTERVAL <= 0:
+            return
+        with self.lock:
+            if self.checker is not None:
+                return
+            self.checker = threading.Thread(target=self.run_health_checks, name='nicebear-health', daemon=True)
+        self.checker.start()
+
+    def run_health_checks(self):
+        while True:
+            self.check_all()
+            time.sleep(HEALTH_CHECK_INTERVAL)
+
+    def stats(self):
+        with self.lock:
+            return [backend.stats() for backend in self.backends]
+
+backend_pool = BackendPool(OLLAMA_HOSTS, sticky=STICKY_SESSIONS)
+
+def ollama_send(method, path, model=None, conversation_id=None, **kwargs):
+    """Send a request to the best backend, moving on to another one if it can't be reached.
+
+    Returns (backend, response); pass the backend to backend_pool.release() when done with
+    the response.
+    """
+    tried = []
+    error = None
+    while True:
+        backend = backend_pool.pick(model, conversation_id, exclude=tried)
+        if backend is None:
+            raise error
+        try:
+            # Until Ollama's response headers arrive, which for a stream is when it starts work
+            with trace_span('ollama.connect', host=backend.url):
+                return backend, ollama_request(method, path, backend=backend, **kwargs)
+        except OllamaUnavailable as e:
+            backend_pool.release(backend, e)
+            tried.append(backend)
+            error = e
+        except BaseException:
+            backend_pool.release(backend)
+            raise
+
+def ollama_generate(data, conversation_id=None):
+    """Run a generation to completion and return Ollama's full reply"""
+    backend, response = ollama_send('POST', '/api/generate', data.get('model'), conversation_id,
+                                    json={"keep_alive": KEEP_ALIVE, **data, "stream": False})
+    try:
+        result = response.json()
+    finally:
+        backend_pool.release(backend)
+    record_generation(result)
+    return result
+
+def ollama_stream(data, conversation_id=None):
+    """Yield Ollama's chunks for a streamed generation, raising OllamaError if it fails"""
+    backend, response = ollama_send('POST', '/api/generate', data.get('model'), conversation_id,
+                                    json={"keep_alive": KEEP_ALIVE, **data, "stream": True}, stream=True)
+    try:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = parse_chunk(line)
+            if 'error' in chunk:
+                raise upstream_error(OllamaError(chunk['error']))
+            if chunk.get('done'):
+                record_generation(chunk)
+            yield chunk
+            if chunk.get('done'):
+                return
+    except requests.RequestException as e:
+        raise upstream_error(OllamaError(f"Ollama stream failed: {e}")) from e
+    finally:
+        response.close()
+        backend_pool.release(backend)
+
+def ollama_embed(texts):
+    """Embed a batch of texts with the embedding model, returning one vector per text"""
+    data = {"model": EMBED_MODEL, "input": list(texts)}
+    backend, response = ollama_send('POST', '/api/embed', EMBED_MODEL, json=data)
+    try:
+        return response.json()['embeddings']
+    finally:
+        backend_pool.release(backend)
+
+# Model lifecycle: the chat model is loaded on every host when nicebear starts, rather than by
+# the first request, and can be pinged so Ollama never unloads it between requests.
+
+class ModelWarmer:
+    """Loads the chat models on every backend ahead of the first request and keeps them loaded"""
+
+    def __init__(self, models, keep_alive, preload=True, interval=0):
+        self.models = list(models)
+        self.keep_alive = keep_alive
+        self.preload = preload
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loads = 0
+        self.failures = 0
+        self.last_load_seconds = None
+        self.last_error = None
+
+    def load(self, backend, model):
+        """Ask one backend to load a model; a generate request without a prompt only loads it"""
+        try:
+            response = ollama_request('POST', '/api/generate', backend=backend,
+                                      json={"model": model, "keep_alive": self.keep_alive})
+            result = response.json()
+        except (OllamaError, ValueError) as e:
+            with self.lock:
+                self.failures += 1
+                self.last_error = str(e)
+            return False
+        with self.lock:
+            self.loads += 1
+            self.last_load_seconds = result.get('load_duration', 0) / 1e9
+        # Readiness needn't wait for the next health check to see it
+        with backend_pool.lock:
+            backend.loaded.add(model_tag(model))
+        return True
+
+    def start(self):
+        """Load the model in the background, and keep pinging it if asked to, once per process"""
+        if self.thread is not None or not (self.preload or self.interval > 0):
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='nicebear-warmer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        if not self.preload:
+            time.sleep(self.interval)
+        while True:
+            for backend in backend_pool.backends:
+                for model in self.models:
+                    self.load(backend, model)
+            if self.interval <= 0:
+                return
+            time.sleep(self.interval)
+
+    def loaded_on(self):
+        """URLs of the healthy backends that have every model in memory, as the health checks last
+        saw them; without health checks each backend is asked now"""
+        if HEALTH_CHECK_INTERVAL <= 0:
+            backend_pool.check_all()
+        tags = {model_tag(model) for model in self.models}
+        with backend_pool.lock:
+            return [b.url for b in backend_pool.backends if b.healthy and tags <= b.loaded]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'models': self.models,
+                'keep_alive': self.keep_alive,
+                'keep_warm_interval': self.interval,
+                'loads': self.loads,
+                'failures': self.failures,
+                'last_load_seconds': self.last_load_seconds,
+                'last_error': self.last_error,
+                'cold_loads': sum(model_cold_loads.collect().values())
+            }
+
+model_warmer = ModelWarmer(MODEL_TIERS, KEEP_ALIVE, PRELOAD_MODEL, KEEP_WARM_INTERVAL)
+
+def relay_chunk(chunk):
+    """Turn a streamed Ollama chunk into the chunk sent to the browser"""
+    if chunk.get('done'):
+        # The final chunk carries the eval stats; drop the bulky context array
+        final = {'response': chunk.get('response', ''), 'done': True}
+        final.update({key: chunk[key] for key in STATS_FIELDS if key in chunk})
+        return final
+    if chunk.get('restart'):
+        # A bigger model answers again from the start
+        return {'response': '', 'done': False, 'restart': True, 'model': chunk['model']}
+    return {'response': chunk.get('response', ''), 'done': False}
+
+# Conversation store: one SQLite database in WAL mode, so readers never block the writer.
+# Each thread gets its own connection.
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    summary TEXT NOT NULL DEFAULT '',
+    summary_tokens INTEGER NOT NULL DEFAULT 0,
+    summarized_seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_by_update ON conversations (updated_at DESC, id DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    tokens INTEGER,
+    model TEXT,
+    UNIQUE (conversation_id, seq)
+);
+"""
+
+# Columns added since the first release, for stores created before them
+DB_MIGRATIONS = (
+    ('conversations', 'summary', "TEXT NOT NULL DEFAULT ''"),
+    ('conversations', 'summary_tokens', 'INTEGER NOT NULL DEFAULT 0'),
+    ('conversations', 'summarized_seq', 'INTEGER NOT NULL DEFAULT 0'),
+    ('messages', 'tokens', 'INTEGER'),
+    ('messages', 'model', 'TEXT'),
+)
+
+# Full-text index over message contents. It is an external-content FTS5 table, so the text is
+# stored once, in messages; the triggers keep the index in step with every insert and delete,
+# which costs work in proportion to the message and nothing else.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+_db_local = threading.local()
+_db_schema_lock = threading.Lock()
+_db_schema_ready = False
+_db_search_available = False
+
+def get_db():
+    """Return this thread's connection to the conversation store"""
+    global _db_schema_ready, _db_search_available
+    db = getattr(_db_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('PRAGMA foreign_keys=ON')
+        with _db_schema_lock:
+            if not _db_schema_ready:
+                db.executescript(DB_SCHEMA)
+                migrate_db(db)
+                _db_search_available = create_search_index(db)
+                _db_schema_ready = True
+        _db_local.db = db
+    return db
+
+def migrate_db(db):
+    """Add missing columns to an older store and count the tokens of its messages"""
+    for table, column, definition in DB_MIGRATIONS:
+        if column not in {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}:
+            db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    # Same estimate as count_tokens()
+    db.execute('UPDATE messages SET tokens = (length(content) + 3) / 4 WHERE tokens IS NULL')
+
+def create_search_index(db):
+    """Create the full-text index if SQLite has FTS5, filling it from a store made before it; returns
+    whether search is available"""
+    existed = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+    try:
+        db.executescript(SEARCH_SCHEMA)
+    except sqlite3.OperationalError as e:
+        app.logger.warning("Full-text search is unavailable: %s", e)
+        return False
+    if not existed:
+        db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    return True
+
+def count_tokens(text):
+    """Estimate how many tokens a text takes; about four characters each for typical English"""
+    return (len(text) + 3) // 4
+
+def conversation_title(content):
+    """Title a conversation with its first user message, like the sidebar always did"""
+    return content[:25] + ('...' if len(content) > 25 else '')
+
+def is_message(data):
+    """Whether data is a message a client may store: a role of 'user' or 'assistant' and a content string"""
+    return isinstance(data, dict) and data.get('role') in ('user', 'assistant') and isinstance(data.get('content'), str)
+
+def create_conversation(conversation_id=None, messages=()):
+    """Create a conversation, optionally importing existing messages, and return its summary.
+
+    The conversation and its messages are written in one transaction, so an import that fails
+    leaves nothing behind.
+    """
+    conversation_id = conversation_id or uuid.uuid4().hex
+    now = time.time()
+    db = get_db()
+    with db:
+        db.execute('BEGIN IMMEDIATE')
+        created = db.execute('INSERT OR IGNORE INTO conversations (id, created_at, updated_at) VALUES (?, ?, ?)',
+                             (conversation_id, now, now)).rowcount
+        # Importing into a conversation that already exists would duplicate its messages
+        if created and messages:
+            db.executemany('INSERT INTO messages (conversation_id, seq, role, content, created_at, tokens) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           [(conversation_id, seq, message['role'], message['content'], now,
+                             count_tokens(message['content'])) for seq, message in enumerate(messages)])
+            title = next((conversation_title(message['content']) for message in messages
+                          if message['role'] == 'user'), '')
+            db.execute('UPDATE conversations SET message_count = ?, title = ? WHERE id = ?',
+                       (len(messages), title, conversation_id))
+    return get_conversation(conversation_id)
+
+def get_conversation(conversation_id):
+    row = get_db().execute('SELECT * FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+    return dict(row) if row else None
+
+def list_conversations(limit=CONVERSATION_PAGE_SIZE, cursor=None):
+    """Return a page of conversations, most recently updated first, and the cursor for the next page"""
+    query = 'SELECT * FROM conversations'
+    params = []
+    if cursor:
+        updated_at, conversation_id = cursor.split('|', 1)
+        query += ' WHERE (updated_at, id) < (?, ?)'
+        params += [float(updated_at), conversation_id]
+    query += ' ORDER BY updated_at DESC, id DESC LIMIT ?'
+    rows = [dict(row) for row in get_db().execute(query, params + [limit + 1])]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['updated_at']!r}|{rows[-1]['id']}"
+    return rows, next_cursor
+
+def get_messages(conversation_id, limit=MESSAGE_PAGE_SIZE, before=None):
+    """Return the latest messages before seq `before` in chronological order, and the next cursor"""
+    query = 'SELECT seq, role, content, created_at FROM messages WHERE conversation_id = ?'
+    params = [conversation_id]
+    if before is not None:
+        query += ' AND seq < ?'
+        params.append(before)
+    query += ' ORDER BY seq DESC LIMIT ?'
+    rows = [dict(row) for row in get_db().execute(query, params + [limit + 1])]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]['seq']
+    rows.reverse()
+    return rows, next_cursor
+
+def append_message(conversation_id, role, content, tokens=None, model=None):
+    """Append one message to a conversation, creating the conversation if needed.
+
+    The message's token count is stored with it so it never has to be worked out again; pass
+    it when it is known exactly (Ollama's eval_count for a reply). A reply also records the
+    model that wrote it.
+    """
+    if tokens is None:
+        tokens = count_tokens(content)
+    now = time.time()
+    db = get_db()
+    with db:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('INSERT OR IGNORE INTO conversations (id, created_at, updated_at) VALUES (?, ?, ?)',
+                   (conversation_id, now, now))
+        db.execute("""
+            UPDATE conversations
+            SET message_count = message_count + 1,
+                updated_at = ?,
+                title = CASE WHEN title = '' AND ? = 'user' THEN ? ELSE title END
+            WHERE id = ?
+        """, (now, role, conversation_title(content), conversation_id))
+        seq = db.execute('SELECT message_count - 1 FROM conversations WHERE id = ?',
+                         (conversation_id,)).fetchone()[0]
+        db.execute('INSERT INTO messages (conversation_id, seq, role, content, created_at, tokens, model) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?)', (conversation_id, seq, role, content, now, tokens, model))
+    return {'seq': seq, 'role': role, 'content': content, 'created_at': now}
+
+def retract_message(conversation_id, seq):
+    """Remove the message append_message() stored at seq, unless others were appended after it"""
+    db = get_db()
+    with db:
+        db.execute('BEGIN IMMEDIATE')
+        last = db.execute('SELECT message_count - 1 FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+        if last is None or last[0] != seq:
+            return False
+        db.execute('DELETE FROM messages WHERE conversation_id = ? AND seq = ?', (conversation_id, seq))
+        # A conversation left empty gets its title from the next first message
+        db.execute("UPDATE conversations SET message_count = message_count - 1, "
+                   "title = CASE WHEN message_count = 1 THEN '' ELSE title END WHERE id = ?", (conversation_id,))
+    return True
+
+def delete_conversation(conversation_id):
+    with get_db() as db:
+        return db.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,)).rowcount > 0
+
+class SearchUnavailable(Exception):
+    """Raised when the SQLite nicebear runs on was built without FTS5"""
+
+def search_query(text):
+    """Turn what a user typed into an FTS5 query for messages with all its words, the last one as
+    a prefix so results show up while typing. Quoting every word keeps FTS5's operators out."""
+    words = [f'"{word}"' for word in re.findall(r'\w+', text)]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+def search_messages(text, limit=SEARCH_PAGE_SIZE, cursor=None):
+    """Return a page of messages matching `text`, best match first, and the cursor for the next page.
+
+    Each result has its conversation and an HTML snippet of the message with the matched words in
+    <mark>; everything else in the snippet is escaped.
+    """
+    db = get_db()
+    if not _db_search_available:
+        raise SearchUnavailable("Full-text search needs SQLite with FTS5")
+    query = search_query(text)
+    offset = int(cursor) if cursor else 0
+    if not query or offset < 0:
+        return [], None
+    rows = db.execute("""
+        SELECT m.conversation_id, c.title, c.updated_at, m.seq, m.role, m.created_at,
+               snippet(messages_fts, 0, char(2), char(3), '…', ?) AS snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN conversations c ON c.id = m.conversation_id
+        WHERE messages_fts MATCH ?
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+    """, (SEARCH_SNIPPET_TOKENS, query, limit + 1, offset)).fetchall()
+    results = []
+    for row in rows[:limit]:
+        result = dict(row)
+        result['snippet'] = html.escape(result['snippet']).replace('\x02', '<mark>').replace('\x03', '</mark>')
+        results.append(result)
+    return results, str(offset + limit) if len(rows) > limit else None
+
+def page_size(value, default):
+    """Parse a page size from the query string, capped at MAX_PAGE_SIZE"""
+    return max(1, min(int(value), MAX_PAGE_SIZE)) if value else default
+
+# Multi-turn state: Ollama hands back a `context` array of token IDs with every reply. Sending
+# it with the next prompt lets the runner reuse its KV cache, so a follow-up turn only costs
+# its new tokens instead of re-reading the whole transcript.
+
+class ConversationContexts:
+    """LRU map from conversation ID to the context Ollama returned for its last turn.
+
+    A context is only good for the model that produced it, and only while that model answered
+    the latest turn, so each conversation keeps one entry, tagged with its model.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prompt_tokens_skipped = 0
+
+    def get(self, conversation_id, model):
+        with self.lock:
+            entry = self.entries.get(conversation_id)
+            if entry is None or entry[0] != model:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(conversation_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, conversation_id, model, context, tokens_reused=0):
+        # Token IDs fit in 32 bits; an array takes a fraction of the memory of a list of ints
+        with self.lock:
+            self.entries[conversation_id] = (model, array('i', context))
+            self.entries.move_to_end(conversation_id)
+            self.prompt_tokens_skipped += tokens_reused
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, conversation_id):
+        with self.lock:
+            self.entries.pop(conversation_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'conversations': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'prompt_tokens_skipped': self.prompt_tokens_skipped
+            }
+
+conversation_contexts = ConversationContexts(CONTEXT_CACHE_SIZE)
+
+def transcript_prompt(history, message, summary=''):
+    """Fold earlier messages into the prompt when a conversation has no context to continue"""
+    lines = [f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in history]
+    prompt = "Conversation so far:\n" + "\n".join(lines) + f"\n\nUser: {message}"
+    if summary:
+        prompt = f"Summary of the earlier conversation:\n{summary}\n\n{prompt}"
+    return prompt
+
+# Context window: a conversation's prompt is kept within PROMPT_TOKEN_BUDGET tokens. It holds
+# the system prompt, a running summary of older turns and as many of the latest turns as fit.
+# Turns that slide out of the window are folded into the summary in the background, a batch
+# at a time, so no request ever waits for it and the summary is never rebuilt from scratch.
+
+def context_window(conversation_id, message):
+    """Return (summary, latest messages that fit the budget, seq of the oldest one kept)"""
+    row = get_db().execute('SELECT summary, summary_tokens, summarized_seq, message_count '
+                           'FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+    if row is None:
+        return '', [], 0
+    budget = PROMPT_TOKEN_BUDGET - count_tokens(SYSTEM_PROMPT) - row['summary_tokens'] - count_tokens(message)
+    window = []
+    first_seq = row['message_count']
+    # Newest first, stopping at the first message that doesn't fit, so only the window is read
+    for message_row in get_db().execute(
+            'SELECT seq, role, content, tokens FROM messages WHERE conversation_id = ? AND seq >= ? '
+            'ORDER BY seq DESC', (conversation_id, row['summarized_seq'])):
+        budget -= message_row['tokens']
+        if budget < 0:
+            break
+        window.append(dict(message_row))
+        first_seq = message_row['seq']
+    window.reverse()
+    if first_seq > row['summarized_seq'] and summarizer is not None:
+        summarizer.schedule(conversation_id, first_seq)
+    return row['summary'], window, first_seq
+
+def summary_prompt(summary, messages):
+    lines = [f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in messages]
+    prompt = ("Write a concise summary of the conversation below, keeping names, facts, decisions "
+              "and open questions. Reply with the summary only.\n\n")
+    if summary:
+        prompt += f"Summary so far:\n{summary}\n\nWhat was said next:\n"
+    return prompt + "\n".join(lines)
+
+class Summarizer:
+    """Folds the turns that slid out of a conversation's window into its running summary"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.runs = 0
+        self.failures = 0
+        self.messages_folded = 0
+
+    def schedule(self, conversation_id, up_to):
+        """Summarize the conversation's unsummarized messages before seq up_to, unless already underway"""
+        with self.lock:
+            if conversation_id in self.pending:
+                return
+            self.pending.add(conversation_id)
+        threading.Thread(target=self.run, args=(conversation_id, up_to),
+                         name='nicebear-summarizer', daemon=True).start()
+
+    def run(self, conversation_id, up_to):
+        try:
+            self.summarize(conversation_id, up_to)
+        except (OllamaError, QueueFull) as e:
+            with self.lock:
+                self.failures += 1
+            app.logger.warning("Summarizing conversation %s failed: %s", conversation_id, e)
+        finally:
+            with self.lock:
+                self.pending.discard(conversation_id)
+
+    def summarize(self, conversation_id, up_to):
+        """Fold the messages in, as many at a time as fit in the prompt budget next to the summary"""
+        db = get_db()
+        row = db.execute('SELECT summary, summarized_seq FROM conversations WHERE id = ?',
+                         (conversation_id,)).fetchone()
+        if row is None:
+            return
+        summary, seq = row['summary'], row['summarized_seq']
+        while seq < up_to:
+            messages, next_seq = self.next_chunk(db, conversation_id, seq, up_to, summary)
+            if not messages:
+                return
+            # Background work yields to chat requests
+            with scheduler.slot('nicebear-summarizer', 'low'):
+                result = ollama_generate({"model": MODEL_TIERS[-1], "prompt": summary_prompt(summary, messages),
+                                          "options": {"num_predict": SUMMARY_TOKENS}})
+            folded = result.get('response', '').strip()
+            if not folded:
+                return
+            # Only move forward from where this chunk started, in case the conversation was reset meanwhile
+            if not db.execute('UPDATE conversations SET summary = ?, summary_tokens = ?, summarized_seq = ? '
+                              'WHERE id = ? AND summarized_seq = ?',
+                              (folded, result.get('eval_count') or count_tokens(folded), next_seq,
+                               conversation_id, seq)).rowcount:
+                return
+            with self.lock:
+                self.runs += 1
+                self.messages_folded += len(messages)
+            summary, seq = folded, next_seq
+
+    def next_chunk(self, db, conversation_id, seq, up_to, summary):
+        """The messages from seq on, before up_to, that fit in one summary prompt, and the seq after
+        them. A message too long to fit on its own is cut short."""
+        room = PROMPT_TOKEN_BUDGET - count_tokens(summary_prompt(summary, []))
+        messages = []
+        for message_row in db.execute('SELECT seq, role, content, tokens FROM messages WHERE conversation_id = ? '
+                                      'AND seq >= ? AND seq < ? ORDER BY seq', (conversation_id, seq, up_to)):
+            # Its "User: " or "Assistant: " label and the line break take a few tokens more
+            tokens = message_row['tokens'] + 3
+            if tokens > room:
+                if not messages:
+                    messages.append({'role': message_row['role'], 'content': message_row['content'][:max(room, 1) * 4]})
+                    seq = message_row['seq'] + 1
+                break
+            room -= tokens
+            messages.append({'role': message_row['role'], 'content': message_row['content']})
+            seq = message_row['seq'] + 1
+        return messages, seq
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'runs': self.runs,
+                'failures': self.failures,
+                'messages_folded': self.messages_folded
+            }
+
+summarizer = Summarizer() if SUMMARIZE_ENABLED else None
+
+# Response cache: identical stateless prompts (same model, prompt and options) are answered
+# from memory instead of running the model again.
+
+# Request fields that don't change what the model generates
+UNCACHED_FIELDS = ('stream', 'context', 'keep_alive')
+
+def cache_key(payload):
+    """Hash a stateless Ollama request; prompts that differ only in whitespace share a key"""
+    fields = {key: value for key, value in payload.items() if key not in UNCACHED_FIELDS}
+    fields['prompt'] = ' '.join(fields.get('prompt', '').split())
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Exact-match cache of finished generations with LRU eviction, a TTL and optional SQLite backing"""
+
+    def __init__(self, max_entries, ttl, path=''):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def disk(self):
+        """Return this thread's connection to the on-disk cache"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS response_cache '
+                       '(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, result TEXT NOT NULL)')
+            self.local.db = db
+        return db
+
+    def get(self, key):
+        if not self.max_entries:
+            return None
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self.entries[key]
+                self.expirations += 1
+        if self.path:
+            row = self.disk().execute('SELECT expires_at, result FROM response_cache WHERE key = ? AND expires_at > ?',
+                                      (key, now)).fetchone()
+            if row is not None:
+                result = json.loads(row[1])
+                self._remember(key, row[0], result)
+                with self.lock:
+                    self.hits += 1
+                return result
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        if not self.max_entries:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, result)
+        if self.path:
+            db = self.disk()
+            db.execute('INSERT OR REPLACE INTO response_cache (key, expires_at, result) VALUES (?, ?, ?)',
+                       (key, expires_at, json.dumps(result)))
+            with self.lock:
+                self.writes += 1
+                trim = self.writes % 100 == 0
+            # Trim the file now and then rather than on every write
+            if trim:
+                db.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+                db.execute('DELETE FROM response_cache WHERE key NOT IN '
+                           '(SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT ?)',
+                           (self.max_entries,))
+
+    def _remember(self, key, expires_at, result):
+        with self.lock:
+            self.entries[key] = (expires_at, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH)
+
+class SemanticCache:
+    """Near-duplicate cache: answers a prompt with the stored reply of a similar earlier prompt.
+
+    Prompt embeddings are unit vectors in one float32 matrix, so a batch of lookups is a single
+    matrix product. Only entries with the same scope (model and options) can match. When the
+    matrix is full the least recently used row is overwritten. With a path, the matrix is a
+    memory-mapped .npy file and the replies live in a SQLite file next to it. Replies are kept
+    without their context, which encodes the earlier prompt and can't continue another one.
+    """
+
+    def __init__(self, max_entries, threshold, path='', embed=None):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.path = path
+        self.embed = embed or ollama_embed
+        self.lock = threading.Lock()
+        self.matrix = None
+        self.scopes = np.zeros(max_entries, dtype=np.int64)
+        self.last_used = np.zeros(max_entries, dtype=np.float64)
+        self.replies = [None] * max_entries
+        self.count = 0
+        self.db = None
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.lookup_seconds = 0.0
+        self.generation_seconds_saved = 0.0
+        if path:
+            self.load()
+
+    def load(self):
+        """Reopen the vectors and replies persisted by an earlier run"""
+        self.db = sqlite3.connect(self.path + '.db', timeout=10, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS semantic_cache (slot INTEGER PRIMARY KEY, '
+                        'scope INTEGER NOT NULL, last_used REAL NOT NULL, reply TEXT NOT NULL)')
+        if not os.path.exists(self.path + '.npy'):
+            return
+        matrix = np.load(self.path + '.npy', mmap_mode='r+')
+        if matrix.shape[0] != self.max_entries:
+            # Resized since the last run: start over rather than guess which rows to keep
+            self.db.execute('DELETE FROM semantic_cache')
+            return
+        self.matrix = matrix
+        for slot, scope, last_used, reply in self.db.execute('SELECT * FROM semantic_cache ORDER BY slot'):
+            self.scopes[slot] = scope
+            self.last_used[slot] = last_used
+            self.replies[slot] = json.loads(reply)
+            self.replies[slot].pop('context', None)
+            self.count = max(self.count, slot + 1)
+
+    def allocate(self, dimensions):
+        self.matrix = None
+        if self.path:
+            self.matrix = np.lib.format.open_memmap(self.path + '.npy', mode='w+', dtype=np.float32,
+                                                    shape=(self.max_entries, dimensions))
+        else:
+            self.matrix = np.zeros((self.max_entries, dimensions), dtype=np.float32)
+
+    def discard_all(self, dimensions):
+        """Drop every entry and start over with vectors of a new size, as when the embedding model
+        changed since they were stored; called with the lock held"""
+        self.count = 0
+        self.replies = [None] * self.max_entries
+        self.scopes[:] = 0
+        self.last_used[:] = 0
+        if self.db is not None:
+            self.db.execute('DELETE FROM semantic_cache')
+        self.allocate(dimensions)
+
+    def vectors(self, prompts):
+        vectors = np.asarray(self.embed(prompts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def search(self, vectors, scope, k=1):
+        """Return the k best (similarity, slot) pairs in scope for each query vector, best first"""
+        with self.lock:
+            # Vectors of another size come from another embedding model and match nothing stored
+            if self.count == 0 or self.matrix is None or self.matrix.shape[1] != vectors.shape[1]:
+                return [[] for _ in vectors]
+            scores = self.matrix[:self.count] @ vectors.T
+            scores[self.scopes[:self.count] != scope] = -np.inf
+        k = min(k, self.count)
+        results = []
+        for column in scores.T:
+            top = np.argpartition(-column, k - 1)[:k]
+            top = top[np.argsort(-column[top])]
+            results.append([(float(column[slot]), int(slot)) for slot in top if column[slot] > -np.inf])
+        return results
+
+    def lookup_many(self, prompts, scope):
+        """Look up a batch of prompts with one embedding call and one matrix product.
+
+        Returns (reply or None, similarity, vector) per prompt; pass the vector back to add()
+        on a miss so the prompt isn't embedded twice.
+        """
+        started = time.perf_counter()
+        vectors = self.vectors(prompts)
+        matches = self.search(vectors, scope)
+        found = []
+        now = time.time()
+        with self.lock:
+            for vector, best in zip(vectors, matches):
+                if best and best[0][0] >= self.threshold:
+                    similarity, slot = best[0]
+                    reply = self.replies[slot]
+                    self.last_used[slot] = now
+                    self.hits += 1
+                    self.generation_seconds_saved += reply.get('total_duration', 0) / 1e9
+                    found.append((reply, similarity, vector))
+                else:
+                    found.append((None, best[0][0] if best else 0.0, vector))
+            self.lookups += len(prompts)
+            self.lookup_seconds += time.perf_counter() - started
+        return found
+
+    def lookup(self, prompt, scope):
+        return self.lookup_many([prompt], scope)[0]
+
+    def add(self, vector, scope, reply):
+        now = time.time()
+        reply = {key: value for key, value in reply.items() if key != 'context'}
+        with self.lock:
+            if self.matrix is None:
+                self.allocate(len(vector))
+            elif self.matrix.shape[1] != len(vector):
+                # Entries persisted by a run with another embedding model
+                app.logger.warning("Embeddings changed size from %d to %d; clearing the semantic cache",
+                                   self.matrix.shape[1], len(vector))
+                self.discard_all(len(vector))
+            if self.count < self.max_entries:
+                slot = self.count
+                self.count += 1
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.evictions += 1
+            self.matrix[slot] = vector
+            self.scopes[slot] = scope
+            self.last_used[slot] = now
+            self.replies[slot] = reply
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO semantic_cache VALUES (?, ?, ?, ?)',
+                                (slot, scope, now, json.dumps(reply)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': self.count,
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'evictions': self.evictions,
+                'avg_lookup_ms': 1000 * self.lookup_seconds / self.lookups if self.lookups else 0.0,
+                'generation_seconds_saved': self.generation_seconds_saved,
+                'avg_generation_ms_saved': (1000 * self.generation_seconds_saved / self.hits
+                                            if self.hits else 0.0)
+            }
+
+def semantic_scope(payload):
+    """Group requests whose replies are interchangeable apart from the prompt"""
+    return int(cache_key({**payload, 'prompt': ''})[:15], 16)
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    if np is None:
+        app.logger.warning("NICEBEAR_SEMANTIC_CACHE is set but numpy isn't installed; semantic cache disabled")
+    else:
+        semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_PATH)
+
+# Scheduler: sits between the chat routes and Ollama so a traffic spike queues here, where it
+# can be bounded and ordered, instead of piling up inside Ollama.
+
+class QueueFull(Exception):
+    """Raised when a request can't be queued; retry_after is a hint in seconds"""
+    status = 429
+
+    def __init__(self, retry_after, message="nicebear is busy"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class QueueTimeout(QueueFull):
+    """Raised when a queued request waited longer than the queue timeout"""
+    status = 503
+
+class SchedulerWaiter:
+    """A request waiting for a generation slot; can be woken from any thread"""
+
+    def __init__(self, client, priority, loop=None):
+        self.client = client
+        self.priority = priority
+        self.loop = loop
+        self.granted = False
+        self.cancelled = False
+        self.queued_at = time.monotonic()
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def cancel(self):
+        """Wake a thread waiting for a slot so it gives up its place; a coroutine is cancelled instead"""
+        self.cancelled = True
+        if self.loop is None:
+            self.event.set()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+class Scheduler:
+    """Caps concurrent upstream generations and queues the rest fairly.
+
+    Waiting requests are grouped by priority class and, within a class, by client. A freed
+    slot goes to the highest non-empty class and rotates between its clients, so a client
+    with a burst of requests can't starve the others. Threads and coroutines share one queue.
+    """
+
+    def __init__(self, max_concurrent, max_queue, max_queue_per_client, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.queue_timeout = queue_timeout
+        self.lock = threading.Lock()
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        # Moving average of how long a generation holds its slot, for Retry-After hints
+        self.service_seconds = 1.0
+
+    def retry_after(self):
+        return max(1, min(60, math.ceil(self.service_seconds * (self.queued + 1) / self.max_concurrent)))
+
+    def enqueue(self, waiter):
+        """Admit the waiter straight away if a slot is free, otherwise queue it"""
+        with self.lock:
+            if self.active < self.max_concurrent and self.queued == 0:
+                self.active += 1
+                self.admitted += 1
+                waiter.granted = True
+                return True
+            clients = self.queues[waiter.priority]
+            waiting = clients.get(waiter.client)
+            if self.queued >= self.max_queue or (waiting and len(waiting) >= self.max_queue_per_client):
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            clients.setdefault(waiter.client, deque()).append(waiter)
+            self.queued += 1
+            return False
+
+    def dispatch(self):
+        """Hand free slots to the next waiters; called with the lock held"""
+        while self.active < self.max_concurrent and self.queued:
+            clients = next(self.queues[priority] for priority in PRIORITIES if self.queues[priority])
+            client, waiting = next(iter(clients.items()))
+            waiter = waiting.popleft()
+            if waiting:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+            self.queued -= 1
+            self.active += 1
+            self.admitted += 1
+            waited = time.monotonic() - waiter.queued_at
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            waiter.grant()
+
+    def withdraw(self, waiter):
+        """Remove a waiter that gave up; returns False if it was granted a slot in the meantime"""
+        with self.lock:
+            if waiter.granted:
+                return False
+            clients = self.queues[waiter.priority]
+            clients[waiter.client].remove(waiter)
+            if not clients[waiter.client]:
+                del clients[waiter.client]
+            self.queued -= 1
+            return True
+
+    def give_up(self, waiter):
+        if self.withdraw(waiter):
+            with self.lock:
+                self.timed_out += 1
+                retry_after = self.retry_after()
+            raise QueueTimeout(retry_after, "nicebear is busy and the request waited too long")
+
+    def acquire(self, client, priority='normal', on_wait=None):
+        """Block until a generation slot is free; returns a ticket to pass to release().
+
+        on_wait is called with the waiter if it has to queue. Raises GenerationCancelled if the
+        waiter is cancelled before it gets a slot.
+        """
+        waiter = SchedulerWaiter(client, priority)
+        if not self.enqueue(waiter):
+            if on_wait is not None:
+                on_wait(waiter)
+            if not waiter.event.wait(self.queue_timeout):
+                self.give_up(waiter)
+            elif waiter.cancelled and self.withdraw(waiter):
+                raise GenerationCancelled("Generation cancelled")
+        return time.monotonic()
+
+    async def async_acquire(self, client, priority='normal', on_wait=None):
+        """Coroutine version of acquire(); on_wait is called with the waiter if it has to queue"""
+        waiter = SchedulerWaiter(client, priority, asyncio.get_running_loop())
+        if not self.enqueue(waiter):
+            if on_wait is not None:
+                on_wait(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.give_up(waiter)
+            except asyncio.CancelledError:
+                if not self.withdraw(waiter):
+                    self.release(time.monotonic())
+                raise
+        return time.monotonic()
+
+    def position(self, waiter):
+        """Where a queued waiter stands, 1 being next, if nobody else arrives; None once it left the queue"""
+        with self.lock:
+            clients = self.queues[waiter.priority]
+            waiting = clients.get(waiter.client)
+            if waiter.granted or waiting is None or waiter not in waiting:
+                return None
+            higher = PRIORITIES[:PRIORITIES.index(waiter.priority)]
+            ahead = sum(len(others) for priority in higher for others in self.queues[priority].values())
+            # Its class is served round-robin by client, from the first client in the order
+            rounds = waiting.index(waiter)
+            before = True
+            for client, others in clients.items():
+                if client == waiter.client:
+                    before = False
+                    ahead += rounds
+                else:
+                    ahead += min(len(others), rounds + before)
+            return ahead + 1
+
+    def depth(self, priority='normal'):
+        """Requests waiting that would be served before a new one of this priority"""
+        with self.lock:
+            return sum(len(waiting) for ahead in PRIORITIES[:PRIORITIES.index(priority) + 1]
+                       for waiting in self.queues[ahead].values())
+
+    def release(self, ticket):
+        with self.lock:
+            self.active -= 1
+            self.service_seconds += 0.2 * (time.monotonic() - ticket - self.service_seconds)
+            self.dispatch()
+
+    @contextmanager
+    def slot(self, client, priority='normal'):
+        ticket = self.acquire(client, priority)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def async_slot(self, client, priority='normal'):
+        ticket = await self.async_acquire(client, priority)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': self.active,
+                'queued': self.queued,
+                'queued_by_priority': {priority: sum(len(waiting) for waiting in clients.values())
+                                       for priority, clients in self.queues.items()},
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'avg_wait_ms': 1000 * self.wait_seconds / self.admitted if self.admitted else 0.0,
+                'max_wait_ms': 1000 * self.max_wait_seconds,
+                'avg_generation_seconds': self.service_seconds
+            }
+
+# Capacity grows with the number of Ollama hosts behind the pool
+scheduler = Scheduler(MAX_CONCURRENT_GENERATIONS * len(backend_pool.backends), MAX_QUEUE,
+                      MAX_QUEUE_PER_CLIENT, QUEUE_TIMEOUT)
+
+class ProfilePolicy:
+    """Picks the generation profile of requests that don't name one, from how loaded the server is.
+
+    Under pressure (a long queue or a slow average time to first token) new requests get the
+    next cheaper profile; once both are well under their thresholds they get the next dearer
+    one. A shorter answer beats a timeout. Each step holds for a while before the next.
+    """
+
+    def __init__(self, profiles, adaptive, queue_high, ttft_high, recover, hold_seconds):
+        self.names = list(profiles)
+        self.adaptive = adaptive
+        self.queue_high = queue_high
+        self.ttft_high = ttft_high
+        self.recover = recover
+        self.hold_seconds = hold_seconds
+        self.lock = threading.Lock()
+        self.level = 0
+        self.changed_at = float('-inf')
+        self.ttft = 0.0
+        self.switches = 0
+        self.served = {name: 0 for name in self.names}
+
+    def observe_ttft(self, seconds):
+        """Fold a generation's time to first token, queueing included, into the moving average"""
+        with self.lock:
+            self.ttft += 0.2 * (seconds - self.ttft)
+
+    def choose(self, requested=None, priority='normal'):
+        """Return the profile for a new request: the one it asked for, or the one the load calls for"""
+        depth = scheduler.depth(priority) if requested not in self.served and self.adaptive else 0
+        with self.lock:
+            if requested in self.served:
+                name = requested
+            else:
+                if self.adaptive:
+                    self.adjust(depth)
+                name = self.names[self.level]
+            self.served[name] += 1
+        generation_profiles.inc(name)
+        return name
+
+    def adjust(self, depth):
+        """Step the level towards what the load calls for; called with the lock held"""
+        now = time.monotonic()
+        if now - self.changed_at < self.hold_seconds:
+            return
+        if depth >= self.queue_high or self.ttft >= self.ttft_high:
+            if self.level == len(self.names) - 1:
+                return
+            self.level += 1
+        elif depth <= self.queue_high * self.recover and self.ttft <= self.ttft_high * self.recover:
+            if self.level == 0:
+                return
+            self.level -= 1
         else:
-            return f"Error: {response.status_code} - {response.text}"
-    except Exception as e:
-        return f"Error generating response: {str(e)}"
+            return
+        self.changed_at = now
+        self.switches += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'current': self.names[self.level],
+                'adaptive': self.adaptive,
+                'avg_ttft_seconds': self.ttft,
+                'switches': self.switches,
+                'served': dict(self.served)
+            }
+
+profile_policy = ProfilePolicy(GENERATION_PROFILES, ADAPTIVE_PROFILES, PROFILE_QUEUE_HIGH, PROFILE_TTFT_HIGH,
+                               PROFILE_RECOVER, PROFILE_HOLD_SECONDS)
+
+# Model cascade: easy prompts go to a small model, which answers several times faster than
+# the big one, and an answer that fails the check is asked again of the next model up. What
+# each tier saved is measured against the largest tier's average cost, so the numbers are
+# only there once the largest tier has answered something.
+
+class ModelRouter:
+    """Picks the model tier for each prompt and keeps count of what each tier cost and saved"""
+
+    def __init__(self, tiers, long_prompt_tokens, deep_conversation, keywords, escalate_pattern):
+        self.tiers = list(tiers)
+        self.long_prompt_tokens = long_prompt_tokens
+        self.deep_conversation = deep_conversation
+        self.keywords = re.compile(keywords, re.IGNORECASE) if keywords else None
+        self.escalate_pattern = re.compile(escalate_pattern, re.IGNORECASE) if escalate_pattern else None
+        self.lock = threading.Lock()
+        self.usage = {model: {'routed': {}, 'answered': 0, 'escalated': 0, 'seconds': 0.0, 'eval_tokens': 0,
+                              'eval_seconds': 0.0, 'wasted_seconds': 0.0} for model in self.tiers}
+
+    def route(self, message, depth=0, requested=None):
+        """Return the model for a prompt and why: the one asked for, or the classifier's pick"""
+        if requested in self.usage:
+            return self.count(requested, 'override')
+        signals = ((count_tokens(message) >= self.long_prompt_tokens)
+                   + (self.keywords is not None and self.keywords.search(message) is not None)
+                   + (depth >= self.deep_conversation))
+        return self.count(self.tiers[min(signals, len(self.tiers) - 1)], 'classifier')
+
+    def retry(self, answered_by):
+        """Return the model to answer again with when the user asks for a bigger one"""
+        if answered_by in self.usage:
+            return self.count(self.tiers[min(self.tiers.index(answered_by) + 1, len(self.tiers) - 1)], 'retry')
+        return self.count(self.tiers[-1], 'retry')
+
+    def count(self, model, reason):
+        with self.lock:
+            routed = self.usage[model]['routed']
+            routed[reason] = routed.get(reason, 0) + 1
+        model_routes.inc(model, reason)
+        trace_tag(model=model, route=reason)
+        return model, reason
+
+    def escalation(self, model, text):
+        """The next model up if an answer fails the check and there is a bigger model, else None"""
+        if model not in self.usage or model == self.tiers[-1]:
+            return None
+        if text.strip() and (self.escalate_pattern is None or self.escalate_pattern.search(text) is None):
+            return None
+        return self.tiers[self.tiers.index(model) + 1]
+
+    def record(self, model, result, escalated=False):
+        """Add the timings of a finished generation to its tier's usage"""
+        usage = self.usage.get(model)
+        if usage is None:
+            return
+        seconds = result.get('total_duration', 0) / 1e9
+        with self.lock:
+            if escalated:
+                usage['escalated'] += 1
+                usage['wasted_seconds'] += seconds
+            else:
+                usage['answered'] += 1
+                usage['seconds'] += seconds
+                usage['eval_tokens'] += result.get('eval_count', 0)
+                usage['eval_seconds'] += result.get('eval_duration', 0) / 1e9
+        if escalated:
+            model_escalations.inc(model)
+
+    def stats(self):
+        with self.lock:
+            largest = self.usage[self.tiers[-1]]
+            baseline = largest['seconds'] / largest['answered'] if largest['answered'] else None
+            per_token = largest['eval_seconds'] / largest['eval_tokens'] if largest['eval_tokens'] else None
+            tiers = {}
+            for model in self.tiers:
+                usage = self.usage[model]
+                tier = {key: dict(value) if isinstance(value, dict) else value for key, value in usage.items()}
+                tier['avg_seconds'] = usage['seconds'] / usage['answered'] if usage['answered'] else None
+                # Answers that had to be asked again count against the tier that gave them
+                tier['latency_saved_seconds'] = (
+                    usage['answered'] * baseline - usage['seconds'] - usage['wasted_seconds']
+                    if baseline is not None and model != self.tiers[-1] else None)
+                tier['compute_saved_seconds'] = (
+                    usage['eval_tokens'] * per_token - usage['eval_seconds'] - usage['wasted_seconds']
+                    if per_token is not None and model != self.tiers[-1] else None)
+                tiers[model] = tier
+            return {'tiers': tiers}
+
+model_router = ModelRouter(MODEL_TIERS, ROUTE_LONG_PROMPT_TOKENS, ROUTE_DEEP_CONVERSATION, ROUTE_KEYWORDS,
+                           ESCALATE_PATTERN)
+
+def escalated_payload(payload, model, prompt=None):
+    """The request for the next model up; another model's context is of no use to it"""
+    payload = {key: value for key, value in payload.items() if key != 'context'}
+    payload['model'] = model
+    if prompt:
+        payload['prompt'] = prompt
+    return payload
+
+def cascade_stream(payload, conversation_id=None, escalation_prompt=None):
+    """Yield Ollama's chunks for a chat generation, asking the next tier up when an answer fails
+    the check. A `restart` chunk naming the new model tells readers to drop the text so far.
+
+    escalation_prompt replaces the prompt for the bigger model when the first one continued a
+    context, since the bigger model needs the conversation spelled out.
+    """
+    while True:
+        pieces = []
+        stream = ollama_stream(payload, conversation_id)
+        try:
+            for chunk in stream:
+                if not chunk.get('done'):
+                    pieces.append(chunk.get('response', ''))
+                    yield chunk
+                    continue
+                bigger = model_router.escalation(payload['model'], ''.join(pieces) + chunk.get('response', ''))
+                model_router.record(payload['model'], chunk, escalated=bigger is not None)
+                if bigger is None:
+                    yield chunk
+                    return
+        finally:
+            stream.close()
+        payload = escalated_payload(payload, bigger, escalation_prompt)
+        trace_event('escalate')
+        yield {'model': bigger, 'response': '', 'done': False, 'restart': True}
+
+async def async_cascade_stream(payload, conversation_id=None, escalation_prompt=None):
+    """Coroutine version of cascade_stream()"""
+    while True:
+        pieces = []
+        stream = async_ollama_stream(payload, conversation_id)
+        try:
+            async for chunk in stream:
+                if not chunk.get('done'):
+                    pieces.append(chunk.get('response', ''))
+                    yield chunk
+                    continue
+                bigger = model_router.escalation(payload['model'], ''.join(pieces) + chunk.get('response', ''))
+                model_router.record(payload['model'], chunk, escalated=bigger is not None)
+                if bigger is None:
+                    yield chunk
+                    return
+        finally:
+            await stream.aclose()
+        payload = escalated_payload(payload, bigger, escalation_prompt)
+        trace_event('escalate')
+        yield {'model': bigger, 'response': '', 'done': False, 'restart': True}
+
+def busy_body(error):
+    message = f"{error}, please try again in {error.retry_after} seconds"
+    return {'response': f"Error: {message}", 'error': message}
+
+# Request coalescing ("singleflight"): identical stateless prompts that arrive while one is
+# being generated attach to that generation instead of starting their own. The generation
+# runs detached from whoever started it, so it carries on for the others if that requester
+# goes away, and stops once nobody is left to read it.
+
+class Flight:
+    """One upstream generation shared by every identical request that arrives while it runs"""
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        self.stored = False
+        self.subscribers = 1
+        self.task = None
+        self.cond = threading.Condition()
+        self.async_waiters = set()
+
+    def publish(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+        self.wake_async_waiters()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+        self.wake_async_waiters()
+
+    def claim_store(self):
+        """True for the first reader to finish, which caches the reply for everyone"""
+        with self.cond:
+            first, self.stored = not self.stored, True
+            return first
+
+    def wake_async_waiters(self):
+        for loop, event in list(self.async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def follow(self):
+        """Yield every chunk: the ones produced before joining, then the rest as they arrive"""
+        index = 0
+        while True:
+            with self.cond:
+                while index == len(self.chunks) and not self.done:
+                    self.cond.wait()
+                pending = self.chunks[index:]
+                finished = self.done
+            index += len(pending)
+            yield from pending
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+    async def async_follow(self):
+        """Coroutine version of follow()"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self.async_waiters.add(waiter)
+        try:
+            index = 0
+            while True:
+                with self.cond:
+                    pending = self.chunks[index:]
+                    finished = self.done
+                    waiter[1].clear()
+                index += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                if not pending:
+                    await waiter[1].wait()
+        finally:
+            self.async_waiters.discard(waiter)
+
+class Coalescer:
+    """Tracks in-flight generations by cache key"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.started = 0
+        self.joined = 0
+        self.cancelled = 0
+
+    def join(self, key):
+        """Attach to the generation running for key, or register a new one; returns (flight, is_new)"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and not flight.done and not flight.cancelled:
+                flight.subscribers += 1
+                self.joined += 1
+                return flight, False
+            flight = self.flights[key] = Flight(key)
+            self.started += 1
+            return flight, True
+
+    def leave(self, flight):
+        with self.lock:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is reading any more; the producer stops at its next chunk
+                flight.cancelled = True
+                self.cancelled += 1
+
+    def forget(self, flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+    def abandon(self, flight):
+        """Called by a leader cancelled before its generation started; returns whether others joined it.
+
+        If nobody did, the flight is forgotten at once, so no new request can join it before it ends.
+        """
+        with self.lock:
+            if flight.subscribers > 1:
+                return True
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.flights),
+                'upstream_calls': self.started,
+                'upstream_calls_saved': self.joined,
+                'cancelled': self.cancelled
+            }
+
+coalescer = Coalescer()
+
+class FlightCancelled(OllamaError):
+    """Raised to the remaining readers of a shared generation that was abandoned"""
+
+def produce_flight(flight, payload, conversation_id, ticket):
+    """Run a shared generation in the background, publishing its chunks to the flight"""
+    stream = cascade_stream(payload, conversation_id)
+    try:
+        for chunk in stream:
+            if flight.cancelled:
+                flight.finish(FlightCancelled("Generation cancelled"))
+                return
+            flight.publish(chunk)
+        flight.finish()
+    except OllamaError as e:
+        flight.finish(e)
+    finally:
+        if not flight.done:
+            # Anything else went wrong; the readers must still learn the generation is over
+            flight.finish(OllamaError("Generation failed"))
+        stream.close()
+        scheduler.release(ticket)
+        coalescer.forget(flight)
+
+def produce_abandoned_flight(flight, payload, conversation_id, client, priority):
+    """Queue for a slot on behalf of the requests sharing a generation whose leader was cancelled
+    while it waited, then run the generation"""
+    try:
+        ticket = scheduler.acquire(client, priority)
+    except QueueFull as e:
+        flight.finish(e)
+        coalescer.forget(flight)
+        return
+    produce_flight(flight, payload, conversation_id, ticket)
+
+async def async_produce_flight(flight, payload, conversation_id, ticket):
+    """Coroutine version of produce_flight"""
+    stream = async_cascade_stream(payload, conversation_id)
+    try:
+        async for chunk in stream:
+            if flight.cancelled:
+                flight.finish(FlightCancelled("Generation cancelled"))
+                return
+            flight.publish(chunk)
+        flight.finish()
+    except OllamaError as e:
+        flight.finish(e)
+    finally:
+        if not flight.done:
+            flight.finish(OllamaError("Generation failed"))
+        await stream.aclose()
+        scheduler.release(ticket)
+        coalescer.forget(flight)
+
+async def async_produce_abandoned_flight(flight, payload, conversation_id, client, priority):
+    """Coroutine version of produce_abandoned_flight"""
+    try:
+        ticket = await scheduler.async_acquire(client, priority)
+    except QueueFull as e:
+        flight.finish(e)
+        coalescer.forget(flight)
+        return
+    await async_produce_flight(flight, payload, conversation_id, ticket)
+
+# Cancellation: a chat request whose client went away or asked to stop (POST /api/chat/abort
+# with its request ID) stops reading its reply, which closes the stream to Ollama so the
+# generation stops too and its slot goes to the next request.
+
+class GenerationCancelled(Exception):
+    """Raised when a chat request is cancelled before its reply is complete"""
+    status = 499
+
+CANCEL_REASONS = ('disconnect', 'abort')
+
+def request_id_from(data, headers):
+    """The ID a client gave its chat request, in the body or the X-Request-ID header, or a new one"""
+    request_id = data.get('request_id') or headers.get('X-Request-ID') or ''
+    if not isinstance(request_id, str) or not 0 < len(request_id) <= 100:
+        request_id = uuid.uuid4().hex
+    return request_id
+
+# A user asking for the last question to be answered again by the next model up
+RETRY_PATTERN = re.compile(r'\s*(please\s+)?retry with (an? )?(bigger|larger) model\W*$', re.IGNORECASE)
+
+def retry_target(conversation_id):
+    """For a retry: the latest question in a conversation, its seq and the model that answered last"""
+    db = get_db()
+    answered = db.execute("SELECT model FROM messages WHERE conversation_id = ? AND role = 'assistant' "
+                          'ORDER BY seq DESC LIMIT 1', (conversation_id,)).fetchone()
+    # Skip earlier retries, so retrying again climbs another tier for the same question
+    for row in db.execute("SELECT seq, content FROM messages WHERE conversation_id = ? AND role = 'user' "
+                          'ORDER BY seq DESC', (conversation_id,)):
+        if not RETRY_PATTERN.match(row['content']):
+            return row['content'], row['seq'], answered['model'] if answered else None
+    return None
+
+class ActiveTurns:
+    """The chat requests being answered, by client and request ID, so they can be aborted.
+
+    Request IDs are chosen by clients, so one is only found for the client that sent it; nobody
+    can stop another client's request by guessing its ID.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = {}
+        self.cancelled = {reason: 0 for reason in CANCEL_REASONS}
+        self.tokens_saved = 0
+        # Moving average of reply length, to estimate what a cancelled generation would have cost
+        self.reply_tokens = None
+
+    def add(self, turn):
+        with self.lock:
+            self.turns[turn.client, turn.request_id] = turn
+
+    def discard(self, turn):
+        with self.lock:
+            if self.turns.get((turn.client, turn.request_id)) is turn:
+                del self.turns[turn.client, turn.request_id]
+
+    def abort(self, client, request_id):
+        """Cancel the client's request with this ID; returns False if it has none"""
+        with self.lock:
+            turn = self.turns.get((client, request_id))
+        if turn is None:
+            return False
+        turn.cancel('abort')
+        return True
+
+    def replied(self, tokens):
+        with self.lock:
+            if self.reply_tokens is None:
+                self.reply_tokens = float(tokens)
+            else:
+                self.reply_tokens += 0.1 * (tokens - self.reply_tokens)
+
+    def record_cancel(self, reason, tokens_generated, stopped_upstream):
+        """Count a cancelled request; only one that stopped its generation saved any tokens"""
+        with self.lock:
+            self.cancelled[reason] += 1
+            saved = 0
+            if stopped_upstream and self.reply_tokens is not None:
+                saved = max(0, round(self.reply_tokens - tokens_generated))
+            self.tokens_saved += saved
+        cancelled_generations.inc(reason)
+        if saved:
+            cancelled_tokens_saved.inc(amount=saved)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': len(self.turns),
+                'cancelled': dict(self.cancelled),
+                'tokens_saved': self.tokens_saved,
+                'avg_reply_tokens': self.reply_tokens
+            }
+
+active_turns = ActiveTurns()
+
+class ChatTurn:
+    """One chat request: builds the Ollama request for it and records the outcome.
+
+    prepare() and finish() touch the conversation store, so the ASGI handlers run them in a
+    worker thread; everything else is cheap enough to call from the event loop. A turn may hold
+    a scheduler slot and a place in a shared generation; close() gives both back.
+
+    cancel() may be called from any thread. A thread waiting for a slot is woken and a thread
+    reading the reply stops at its next chunk; a coroutine is interrupted at once through
+    `interrupt`, which the ASGI handlers set.
+    """
+
+    def __init__(self, message, conversation_id=None, use_cache=True, client='anonymous', priority='normal',
+                 request_id=None, profile=None, model=None):
+        self.message = message
+        self.conversation_id = conversation_id
+        self.use_cache = use_cache
+        self.client = client
+        self.priority = priority
+        # The profile and model asked for; prepare() settles the ones used
+        self.profile = profile
+        self.model = model
+        self.route = None
+        self.escalations = 0
+        self.escalation_prompt = None
+        self.payload = None
+        # Where prepare() stored the user message, until the turn gets past the queue
+        self.question_seq = None
+        self.context_reused = 0
+        self.cache_key = None
+        self.cached = None
+        self.similarity = None
+        self.embedding = None
+        self.ticket = None
+        self.flight = None
+        self.follower = False
+        self.received = time.perf_counter()
+        self.pieces = []
+        self.result = None
+        self.request_id = request_id or uuid.uuid4().hex
+        trace_tag(request_id=self.request_id, conversation_id=conversation_id, client=client)
+        self.registered = False
+        self.cancelled = None
+        self.interrupt = None
+        # Where a thread waits for a slot, so cancel() can wake it
+        self.waiter = None
+        # Called with the scheduler's waiter when an async turn has to queue for a slot
+        self.on_queued = None
+
+    @classmethod
+    def from_request(cls, data, client='anonymous', headers=None):
+        """Create a turn from a chat request body"""
+        priority = data.get('priority') if data.get('priority') in PRIORITIES else 'normal'
+        profile = data.get('profile') if data.get('profile') in GENERATION_PROFILES else None
+        model = data.get('model') if data.get('model') in MODEL_TIERS else None
+        return cls(data.get('message', ''), data.get('conversation_id'),
+                   use_cache=data.get('cache', True) is not False, client=client, priority=priority,
+                   request_id=request_id_from(data, headers or {}), profile=profile, model=model)
+
+    def prepare(self):
+        """Build the Ollama request, continuing the conversation's context, and store the user message"""
+        retry = None
+        if self.conversation_id and RETRY_PATTERN.match(self.message):
+            retry = retry_target(self.conversation_id)
+        if retry is not None:
+            self.model, self.route = model_router.retry(retry[2])
+        else:
+            depth = 0
+            if self.conversation_id and len(MODEL_TIERS) > 1:
+                conversation = get_conversation(self.conversation_id)
+                depth = conversation['message_count'] if conversation else 0
+            self.model, self.route = model_router.route(self.message, depth, self.model)
+        self.payload = {"model": self.model, "prompt": self.message}
+        if SYSTEM_PROMPT:
+            self.payload['system'] = SYSTEM_PROMPT
+        self.profile = profile_policy.choose(self.profile, self.priority)
+        if GENERATION_PROFILES[self.profile]:
+            self.payload['options'] = dict(GENERATION_PROFILES[self.profile])
+        trace_tag(profile=self.profile)
+        if self.conversation_id:
+            context = conversation_contexts.get(self.conversation_id, self.model) if retry is None else None
+            if retry is not None:
+                question, question_seq, _ = retry
+                with trace_span('history'):
+                    summary, window, _ = context_window(self.conversation_id, question)
+                # The question is asked afresh, without the answers and retries that followed it
+                window = [m for m in window if m['seq'] < question_seq]
+                self.payload['prompt'] = transcript_prompt(window, question, summary) if window or summary else question
+            elif context is not None and len(context) + count_tokens(self.message) <= PROMPT_TOKEN_BUDGET:
+                self.payload['context'] = context.tolist()
+                self.context_reused = len(context)
+                if self.model != MODEL_TIERS[-1]:
+                    # A bigger model asked to take over can't use this model's context
+                    with trace_span('history'):
+                        summary, window, _ = context_window(self.conversation_id, self.message)
+                    if window or summary:
+                        self.escalation_prompt = transcript_prompt(window, self.message, summary)
+            else:
+                # New conversation, its context was evicted or it outgrew the budget: start over
+                # from the summary and the latest turns
+                with trace_span('history'):
+                    summary, window, _ = context_window(self.conversation_id, self.message)
+                if window or summary:
+                    self.payload['prompt'] = transcript_prompt(window, self.message, summary)
+            with trace_span('store_message'):
+                self.question_seq = append_message(self.conversation_id, 'user', self.message)['seq']
+        # Only a turn that doesn't continue a conversation can be answered from the cache
+        if self.use_cache and 'context' not in self.payload and self.payload['prompt'] == self.message:
+            self.cache_key = cache_key(self.payload)
+            self.cached = response_cache.get(self.cache_key)
+            if self.cached is None and semantic_cache is not None:
+                self.lookup_similar()
+            if self.cached:
+                # A reply a bigger model gave after the routed one failed the check
+                self.model = self.cached.get('model', self.model)
+        return self.payload
+
+    def lookup_similar(self):
+        try:
+            with trace_span('semantic_cache'):
+                reply, similarity, self.embedding = semantic_cache.lookup(self.message, semantic_scope(self.payload))
+        except OllamaError as e:
+            # The cache is an optimization; a broken embedding model must not break chat
+            app.logger.warning("Semantic cache lookup failed: %s", e)
+            return
+        if reply is not None:
+            self.cached = reply
+            self.similarity = similarity
+
+    def remember_similar(self, reply):
+        try:
+            semantic_cache.add(self.embedding, semantic_scope(self.payload), reply)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            # Like a failed lookup, a failed write must not fail a reply that is already made
+            app.logger.warning("Semantic cache write failed: %s", e)
+
+    def retract_question(self):
+        """Remove the user message of a turn the scheduler turned away, so the client can send it
+        again without it being stored twice"""
+        if self.question_seq is not None:
+            retract_message(self.conversation_id, self.question_seq)
+            self.question_seq = None
+
+    def open_stream(self):
+        """Start producing the reply and return an iterator of Ollama chunks.
+
+        Raises QueueFull if no slot can be had. Stateless turns share a generation with
+        identical requests already in flight.
+        """
+        if self.cached:
+            return iter([{**self.cached, 'done': True}])
+        self.register()
+        if self.cache_key:
+            self.flight, leader = coalescer.join(self.cache_key)
+            if not leader:
+                self.follower = True
+                return self.flight.follow()
+        try:
+            with trace_span('queue', priority=self.priority):
+                self.ticket = scheduler.acquire(self.client, self.priority, self.wait_in_queue)
+            self.check_cancelled()
+        except QueueFull as e:
+            # Requests that joined while this one was queued get the same answer
+            if self.flight is not None:
+                self.flight.finish(e)
+                coalescer.forget(self.flight)
+            self.retract_question()
+            raise
+        except GenerationCancelled:
+            if self.flight is not None:
+                self.hand_off_flight()
+            raise
+        if self.flight is not None:
+            ticket, self.ticket = self.ticket, None
+            threading.Thread(target=produce_flight, args=(self.flight, self.payload, self.conversation_id, ticket),
+                             name='nicebear-flight', daemon=True).start()
+            return self.flight.follow()
+        return cascade_stream(self.payload, self.conversation_id, self.escalation_prompt)
+
+    async def async_open_stream(self):
+        """Coroutine version of open_stream(); returns an async iterator"""
+        if self.cached:
+            return one_chunk({**self.cached, 'done': True})
+        self.register()
+        if self.cache_key:
+            self.flight, leader = coalescer.join(self.cache_key)
+            if not leader:
+                self.follower = True
+                return self.flight.async_follow()
+        try:
+            with trace_span('queue', priority=self.priority):
+                self.ticket = await scheduler.async_acquire(self.client, self.priority, self.on_queued)
+            self.check_cancelled()
+        except QueueFull as e:
+            # Requests that joined while this one was queued get the same answer
+            if self.flight is not None:
+                self.flight.finish(e)
+                coalescer.forget(self.flight)
+            await asyncio.to_thread(self.retract_question)
+            raise
+        except (GenerationCancelled, asyncio.CancelledError):
+            if self.flight is not None:
+                self.hand_off_flight(asynchronous=True)
+            raise
+        if self.flight is not None:
+            ticket, self.ticket = self.ticket, None
+            self.flight.task = asyncio.create_task(
+                async_produce_flight(self.flight, self.payload, self.conversation_id, ticket))
+            return self.flight.async_follow()
+        return async_cascade_stream(self.payload, self.conversation_id, self.escalation_prompt)
+
+    def hand_off_flight(self, asynchronous=False):
+        """Give up leading a shared generation that hasn't started, as a cancelled turn must.
+
+        The requests that joined it still want the reply, so it runs in the background for them,
+        on this turn's slot or on one it queues for. If none joined, the generation is ended.
+        """
+        flight, ticket = self.flight, self.ticket
+        self.ticket = None
+        if not coalescer.abandon(flight):
+            if ticket is not None:
+                scheduler.release(ticket)
+            flight.finish(FlightCancelled("Generation cancelled"))
+            return
+        if asynchronous:
+            if ticket is not None:
+                producer = async_produce_flight(flight, self.payload, self.conversation_id, ticket)
+            else:
+                producer = async_produce_abandoned_flight(flight, self.payload, self.conversation_id, self.client,
+                                                          self.priority)
+            flight.task = asyncio.create_task(producer)
+        elif ticket is not None:
+            threading.Thread(target=produce_flight, args=(flight, self.payload, self.conversation_id, ticket),
+                             name='nicebear-flight', daemon=True).start()
+        else:
+            threading.Thread(target=produce_abandoned_flight,
+                             args=(flight, self.payload, self.conversation_id, self.client, self.priority),
+                             name='nicebear-flight', daemon=True).start()
+
+    def register(self):
+        if not self.registered:
+            active_turns.add(self)
+            self.registered = True
+
+    def wait_in_queue(self, waiter):
+        self.waiter = waiter
+        # In case cancel() ran before the waiter was known
+        if self.cancelled is not None:
+            waiter.cancel()
+
+    def cancel(self, reason):
+        """Stop producing the reply; reason is 'disconnect' or 'abort'"""
+        if self.cancelled is None and self.result is None:
+            self.cancelled = reason
+            if self.waiter is not None:
+                self.waiter.cancel()
+            if self.interrupt is not None:
+                self.interrupt()
+
+    def check_cancelled(self):
+        if self.cancelled is not None:
+            raise GenerationCancelled("Generation cancelled")
+
+    def close(self):
+        """Give back the scheduler slot and leave the shared generation, if the turn holds them"""
+        # A turn stops its generation unless others still read a shared one
+        stopped_upstream = not self.follower
+        if self.ticket is not None:
+            scheduler.release(self.ticket)
+            self.ticket = None
+        if self.flight is not None:
+            coalescer.leave(self.flight)
+            stopped_upstream = self.flight.cancelled
+            self.flight = None
+        if self.registered:
+            active_turns.discard(self)
+            self.registered = False
+            if self.cancelled is not None and self.result is None:
+                active_turns.record_cancel(self.cancelled, len(self.pieces), stopped_upstream)
+
+    def generate(self):
+        """Produce the whole reply, from the cache or from Ollama once a slot is free"""
+        chunks = None
+        try:
+            chunks = self.open_stream()
+            for chunk in chunks:
+                self.check_cancelled()
+                if self.collect(chunk):
+                    return self.finish()
+        except QueueFull:
+            # Turned away along with the request whose generation this one shared
+            self.retract_question()
+            raise
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.close()
+        raise OllamaError("Ollama ended the reply early")
+
+    async def async_generate(self):
+        """Coroutine version of generate()"""
+        chunks = None
+        try:
+            chunks = await self.async_open_stream()
+            async for chunk in chunks:
+                self.check_cancelled()
+                if self.collect(chunk):
+                    return await asyncio.to_thread(self.finish)
+        except QueueFull:
+            await asyncio.to_thread(self.retract_question)
+            raise
+        finally:
+            if chunks is not None:
+                await chunks.aclose()
+            self.close()
+        raise OllamaError("Ollama ended the reply early")
+
+    def collect(self, chunk):
+        """Accumulate a streamed chunk; returns True once the final chunk has arrived"""
+        if chunk.get('restart'):
+            # The answer failed the check and a bigger model starts over
+            self.pieces = []
+            self.model = chunk['model']
+            self.context_reused = 0
+            self.escalations += 1
+            return False
+        if not self.pieces and not self.escalations:
+            source = 'cache' if self.cached else 'shared' if self.follower else 'model'
+            elapsed = time.perf_counter() - self.received
+            first_token_seconds.observe(elapsed, source)
+            if source == 'model':
+                profile_policy.observe_ttft(elapsed)
+            trace_event('first_token')
+        self.pieces.append(chunk.get('response', ''))
+        if chunk.get('done'):
+            self.result = {**chunk, 'response': ''.join(self.pieces)}
+            return True
+        return False
+
+    def finish(self, result=None):
+        """Keep the new context for the next turn and store the reply"""
+        result = result if result is not None else self.result
+        self.result = result
+        if result.get('eval_count') and self.cached is None:
+            active_turns.replied(result['eval_count'])
+        trace_tag(cached=self.cached is not None, coalesced=self.follower, context_tokens_reused=self.context_reused,
+                  model=self.model, escalations=self.escalations)
+        # A shared generation is stored once, by whichever of its readers gets here first
+        if self.cache_key and self.cached is None and (self.flight is None or self.flight.claim_store()):
+            reply = {key: result[key] for key in ('response', 'context') + STATS_FIELDS if key in result}
+            reply['model'] = self.model
+            response_cache.put(self.cache_key, reply)
+            if self.embedding is not None:
+                self.remember_similar(reply)
+        if self.conversation_id:
+            # A near-duplicate's reply doesn't continue this prompt; the next turn starts over
+            if result.get('context') and self.similarity is None:
+                conversation_contexts.put(self.conversation_id, self.model, result['context'], self.context_reused)
+            with trace_span('store_reply'):
+                append_message(self.conversation_id, 'assistant', result.get('response', ''), result.get('eval_count'),
+                               self.model)
+        return result
+
+    def response_fields(self):
+        """Extra fields reported to the client along with the reply"""
+        fields = {'request_id': self.request_id, 'context_tokens_reused': self.context_reused,
+                  'cached': self.cached is not None, 'coalesced': self.follower, 'profile': self.profile,
+                  'model': self.model, 'route': self.route, 'escalated': self.escalations > 0}
+        if self.similarity is not None:
+            fields['similarity'] = self.similarity
+        return fields
+
+    def client_reply(self, chunk):
+        """A streamed chunk as the client gets it, with the turn's fields added to the last one"""
+        out = relay_chunk(chunk)
+        if out['done']:
+            out.update(self.response_fields())
+        return out
+
+    def client_chunk(self, chunk):
+        """Serialize a streamed chunk for the client"""
+        return json.dumps(self.client_reply(chunk)) + '\n'
+
+# Batch runs: prompts are read from JSONL one line at a time and answered a few at once, each
+# result coming out as soon as it is ready. The checkpoint records the lines done as a
+# watermark, below which all are, plus the few done above it. Reading never gets more than
+# BATCH_WINDOW_FACTOR * parallel lines past the watermark, so that set stays small and memory
+# stays flat however long the input is.
+
+BATCH_ID_FIELDS = ('id', 'custom_id', 'request_id', 'key')
+BATCH_PROMPT_FIELDS = ('prompt', 'message', 'input', 'text', 'body', 'content', 'question')
+BATCH_WINDOW_FACTOR = 4
+
+class BatchCheckpoint:
+    """Which lines of a batch input have been answered, by their index from 0"""
+
+    def __init__(self, watermark=0, done=(), output_size=None):
+        self.watermark = watermark
+        self.done = set(done)
+        # Size of the CLI's output file when the checkpoint was taken
+        self.output_size = output_size
+
+    def is_done(self, index):
+        return index < self.watermark or index in self.done
+
+    def mark(self, index):
+        self.done.add(index)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+    def to_dict(self):
+        data = {'watermark': self.watermark, 'done': sorted(self.done)}
+        if self.output_size is not None:
+            data['output_size'] = self.output_size
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a checkpoint from to_dict(); raises ValueError if it isn't one"""
+        try:
+            watermark = int(data.get('watermark', 0))
+            done = [int(index) for index in data.get('done', ())]
+            output_size = data.get('output_size')
+            output_size = int(output_size) if output_size is not None else None
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError("not a batch checkpoint")
+        return cls(watermark, [index for index in done if index >= watermark], output_size)
+
+    @classmethod
+    def load(cls, path):
+        """Read a checkpoint file, or start afresh if there is none"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                return cls.from_dict(json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path):
+        # Written aside and renamed, so an interrupted save leaves the last checkpoint whole
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temporary, path)
+
+def parse_batch_line(line, id_field=None, prompt_field=None):
+    """Return the ID and prompt of a line of batch input, which is a JSON object or string.
+
+    Without id_field or prompt_field the first of BATCH_ID_FIELDS or BATCH_PROMPT_FIELDS the
+    object has is used; the ID is None if there is none. Raises ValueError if there's no prompt.
+    """
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if isinstance(item, str):
+        item = {'prompt': item}
+    if not isinstance(item, dict):
+        raise ValueError("expected a JSON object or string")
+    item_id = next((item[field] for field in ((id_field,) if id_field else BATCH_ID_FIELDS)
+                    if item.get(field) is not None), None)
+    prompt = next((item[field] for field in ((prompt_field,) if prompt_field else BATCH_PROMPT_FIELDS)
+                   if isinstance(item.get(field), str) and item[field].strip()), None)
+    if prompt is None:
+        raise ValueError(f"no prompt in field {prompt_field!r}" if prompt_field else "no prompt found")
+    return item_id, prompt
+
+class BatchRun:
+    """One pass over batch input, which is any iterable of lines.
+
+    Iterating answers up to `parallel` prompts at once and yields their results in the order
+    they complete, each with its ID (the line number if the line has none) and line index.
+    Lines the checkpoint has as done are skipped, and each result is marked done in it just
+    before it is yielded. A line that can't be answered yields an error and counts as done too.
+    Closing the iterator early cancels the prompts being answered.
+    """
+
+    def __init__(self, lines, parallel=BATCH_PARALLEL, checkpoint=None, id_field=None, prompt_field=None,
+                 use_cache=True, client='batch', cancel_reason='abort'):
+        self.lines = lines
+        self.parallel = max(1, min(parallel, BATCH_MAX_PARALLEL))
+        self.checkpoint = checkpoint if checkpoint is not None else BatchCheckpoint()
+        self.id_field = id_field
+        self.prompt_field = prompt_field
+        self.use_cache = use_cache
+        self.client = client
+        self.cancel_reason = cancel_reason
+        self.run_id = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.turns = {}
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def __iter__(self):
+        lines = iter(self.lines)
+        pool = ThreadPoolExecutor(self.parallel, thread_name_prefix='nicebear-batch')
+        pending = {}
+        index = -1
+        exhausted = False
+        try:
+            while True:
+                window_end = self.checkpoint.watermark + BATCH_WINDOW_FACTOR * self.parallel
+                while not exhausted and len(pending) < self.parallel and index + 1 < window_end:
+                    line = next(lines, None)
+                    if line is None:
+                        exhausted = True
+                        break
+                    index += 1
+                    if self.checkpoint.is_done(index):
+                        self.skipped += 1
+                        continue
+                    if not line.strip():
+                        self.checkpoint.mark(index)
+                        continue
+                    try:
+                        item_id, prompt = parse_batch_line(line, self.id_field, self.prompt_field)
+                    except ValueError as e:
+                        yield self.result(index, {'id': index + 1, 'index': index, 'error': f"Error: {e}"})
+                        continue
+                    future = pool.submit(self.answer, index, index + 1 if item_id is None else item_id, prompt)
+                    pending[future] = index
+                # Whatever holds the window back is still pending, so this is only empty at the end
+                if not pending:
+                    return
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield self.result(pending.pop(future), future.result())
+        finally:
+            self.stop()
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def result(self, index, result):
+        self.checkpoint.mark(index)
+        outcome = 'error' if 'error' in result else 'ok'
+        if outcome == 'error':
+            self.failed += 1
+        else:
+            self.succeeded += 1
+        batch_items.inc(outcome)
+        return result
+
+    def answer(self, index, item_id, prompt):
+        """Answer one prompt, in a worker thread, waiting out a full queue as often as it takes"""
+        while True:
+            turn = ChatTurn(prompt, use_cache=self.use_cache, client=self.client, priority='low',
+                            request_id=f"batch-{self.run_id}-{index}")
+            with self.lock:
+                if self.stopping.is_set():
+                    return {'id': item_id, 'index': index, 'error': 'Error: Generation cancelled'}
+                self.turns[index] = turn
+            try:
+                turn.prepare()
+                result = turn.generate()
+            except QueueFull as e:
+                if self.stopping.wait(e.retry_after):
+                    return {'id': item_id, 'index': index, 'error': 'Error: Generation cancelled'}
+                continue
+            except (OllamaError, GenerationCancelled) as e:
+                return {'id': item_id, 'index': index, 'error': f"Error: {e}"}
+            finally:
+                with self.lock:
+                    self.turns.pop(index, None)
+            reply = relay_chunk(result)
+            del reply['done']
+            fields = turn.response_fields()
+            return {'id': item_id, 'index': index, **reply, 'cached': fields['cached'],
+                    'coalesced': fields['coalesced'], 'profile': fields['profile'], 'model': fields['model'],
+                    'escalated': fields['escalated']}
+
+    def stop(self):
+        """Cancel the prompts being answered and start no more"""
+        with self.lock:
+            self.stopping.set()
+            turns = list(self.turns.values())
+        for turn in turns:
+            turn.cancel(self.cancel_reason)
+
+    def stats(self):
+        return {'succeeded': self.succeeded, 'failed': self.failed, 'skipped': self.skipped,
+                'checkpoint': self.checkpoint.to_dict()}
+
+def run_batch_file(input_path, output_path, checkpoint_path, parallel=BATCH_PARALLEL, id_field=None,
+                   prompt_field=None, use_cache=True):
+    """Answer the prompts in a JSONL file ('-' for stdin), appending results to output_path.
+
+    The checkpoint is saved every BATCH_CHECKPOINT_EVERY results and when the run stops, with
+    the output's size at the time. Resuming cuts off what was written after it, as those lines
+    are answered again, so each line's result is in the output once. Returns the run's stats.
+    """
+    checkpoint = BatchCheckpoint.load(checkpoint_path)
+    source = sys.stdin.buffer if input_path == '-' else open(input_path, 'rb')
+    try:
+        with open(output_path, 'ab') as output:
+            if checkpoint.output_size is not None and output.tell() > checkpoint.output_size:
+                output.truncate(checkpoint.output_size)
+                output.seek(0, os.SEEK_END)
+
+            def save():
+                output.flush()
+                checkpoint.output_size = output.tell()
+                checkpoint.save(checkpoint_path)
+
+            run = BatchRun(source, parallel, checkpoint, id_field, prompt_field, use_cache)
+            results = iter(run)
+            try:
+                for count, result in enumerate(results, 1):
+                    output.write((json.dumps(result) + '\n').encode('utf-8'))
+                    if count % BATCH_CHECKPOINT_EVERY == 0:
+                        save()
+            finally:
+                results.close()
+                save()
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    return run.stats()
+
+# Static assets: the page and the bear images are read once, with their validators and
+# compressed forms worked out up front, and the Flask and ASGI routes share them. The images
+# may be cached for ASSET_MAX_AGE; the page is revalidated on every load so a new version
+# shows up at once, which costs an empty 304 when nothing changed.
+
+class StaticAsset:
+    """A file served from memory with an ETag, Last-Modified and precompressed variants"""
+
+    def __init__(self, path, content_type, cache_control, compressible=False):
+        self.path = path
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.compressible = compressible
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.etag = None
+        self.last_modified = None
+        self.variants = {}
+
+    def load(self):
+        with self.lock:
+            # The debug server picks up edits to the file; otherwise it is read once
+            if self.mtime is not None and not app.debug:
+                return
+            full_path = os.path.join(app.root_path, self.path)
+            mtime = int(os.path.getmtime(full_path))
+            if mtime == self.mtime:
+                return
+            with open(full_path, 'rb') as f:
+                body = f.read()
+            variants = {'identity': body}
+            if self.compressible:
+                variants['gzip'] = gzip.compress(body, 9, mtime=0)
+                if brotli is not None:
+                    variants['br'] = brotli.compress(body)
+            # Weak, because the compressed variants share it
+            self.etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+            self.last_modified = formatdate(mtime, usegmt=True)
+            self.variants = variants
+            self.mtime = mtime
+
+    def respond(self, headers):
+        """Return (status, body, headers) answering a GET with the given request headers"""
+        self.load()
+        response_headers = {'Cache-Control': self.cache_control, 'ETag': self.etag,
+                            'Last-Modified': self.last_modified}
+        if self.compressible:
+            response_headers['Vary'] = 'Accept-Encoding'
+        if self.not_modified(headers):
+            return 304, b'', response_headers
+        encoding = choose_encoding(headers.get('accept-encoding', ''), self.variants)
+        if encoding != 'identity':
+            response_headers['Content-Encoding'] = encoding
+        return 200, self.variants[encoding], response_headers
+
+    def not_modified(self, headers):
+        if_none_match = headers.get('if-none-match')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            return '*' in tags or self.etag.removeprefix('W/') in tags
+        if_modified_since = headers.get('if-modified-since')
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.mtime
+            except (TypeError, ValueError):
+                return False
+        return False
+
+def choose_encoding(accept_encoding, available):
+    """Pick the best of the available encodings the client accepts, preferring brotli"""
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(coding.strip())
+    for encoding in ('br', 'gzip'):
+        if encoding in available and (encoding in accepted or '*' in accepted):
+            return encoding
+    return 'identity'
+
+def compress(body, encoding):
+    return brotli.compress(body, quality=5) if encoding == 'br' else gzip.compress(body, 6)
+
+static_assets = {
+    '/': StaticAsset(os.path.join('templates', 'index.html'), 'text/html; charset=utf-8', 'no-cache',
+                     compressible=True),
+    '/lightbear.png': StaticAsset('lightbear.png', 'image/png', f'public, max-age={ASSET_MAX_AGE}'),
+    '/darkbear.png': StaticAsset('darkbear.png', 'image/png', f'public, max-age={ASSET_MAX_AGE}'),
+}
+
+def asset_response(path):
+    asset = static_assets[path]
+    status, body, headers = asset.respond(request.headers)
+    return Response(body, status, headers, content_type=asset.content_type)
 
 @app.route('/')
 def home():
-    return render_template('index.html')
+    return asset_response('/')
+
+def request_client():
+    """Who a request counts as for fair scheduling"""
+    return request.headers.get('X-Client-ID') or request.remote_addr or 'anonymous'
+
+def ndjson_response(chunks, headers=None):
+    return Response(stream_with_context(chunks), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', **(headers or {})})
+
+def chat_request_error(data):
+    """What makes a chat request body unanswerable, or None if nothing does"""
+    if not isinstance(data, dict):
+        return 'The request body must be a JSON object'
+    if not isinstance(data.get('message', ''), str):
+        return 'The message must be a string'
+    if data.get('conversation_id') is not None and not isinstance(data['conversation_id'], str):
+        return 'The conversation_id must be a string'
+    return None
+
+def cancelled_body(turn):
+    return {'response': 'Error: Generation cancelled', 'error': 'Generation cancelled', 'cancelled': True,
+            'request_id': turn.request_id}
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    user_input = request.json.get('message', '')
+    data = request.get_json(silent=True)
+    error = chat_request_error(data)
+    if error is not None:
+        return jsonify({'error': error}), 400
+    user_input = data.get('message', '')
     if not user_input.strip():
         return jsonify({'response': 'Please enter a message'})
     
-    response = generate_response(user_input)
-    return jsonify({'response': response})
+    turn = ChatTurn.from_request(data, request_client(), request.headers)
+    turn.prepare()
+    try:
+        with trace_span('generate'):
+            result = turn.generate()
+    except QueueFull as e:
+        return jsonify(busy_body(e)), e.status, {'Retry-After': str(e.retry_after)}
+    except GenerationCancelled as e:
+        return jsonify(cancelled_body(turn)), e.status
+    except OllamaError as e:
+        # Keep the error readable in the chat while telling the client it failed upstream
+        return jsonify({'response': f"Error: {e}"}), e.status
+    with trace_span('respond'):
+        return jsonify({'response': result.get('response', 'No response generated'), **turn.response_fields()})
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Relay the model's output as newline-delimited JSON chunks"""
+    data = request.get_json(silent=True)
+    error = chat_request_error(data)
+    if error is not None:
+        return jsonify({'error': error}), 400
+    user_input = data.get('message', '')
+    if not user_input.strip():
+        return ndjson_response([json.dumps({'response': 'Please enter a message', 'done': True}) + '\n'])
+
+    turn = ChatTurn.from_request(data, request_client(), request.headers)
+    turn.prepare()
+    headers = {'X-Request-ID': turn.request_id}
+    if turn.cached:
+        turn.finish(turn.cached)
+        return ndjson_response([turn.client_chunk({**turn.cached, 'done': True})], headers)
+
+    # Wait for a slot before answering so a full queue can still be reported as a 429
+    try:
+        chunks = turn.open_stream()
+    except QueueFull as e:
+        turn.close()
+        return jsonify(busy_body(e)), e.status, {'Retry-After': str(e.retry_after)}
+    except GenerationCancelled as e:
+        turn.close()
+        return jsonify(cancelled_body(turn)), e.status
+
+    def generate():
+        try:
+            for chunk in chunks:
+                turn.check_cancelled()
+                if turn.collect(chunk):
+                    turn.finish()
+                yield turn.client_chunk(chunk)
+        except GeneratorExit:
+            # The server found the client gone when a write failed
+            turn.cancel('disconnect')
+            raise
+        except GenerationCancelled:
+            yield json.dumps({**cancelled_body(turn), 'done': True}) + '\n'
+        except OllamaError as e:
+            trace_error(e)
+            yield json.dumps({'error': f"Error: {e}", 'done': True}) + '\n'
+        except QueueFull as e:
+            # Shared generation whose first requester was turned away
+            trace_error(e)
+            yield json.dumps({**busy_body(e), 'done': True}) + '\n'
+        finally:
+            # Closing the stream from Ollama makes it stop generating
+            chunks.close()
+
+    response = ndjson_response(generate(), headers)
+    # Runs when the response is closed, even if the client went away before it was sent
+    response.call_on_close(turn.close)
+    return response
+
+@app.route('/api/chat/abort', methods=['POST'])
+def abort_chat():
+    """Cancel a chat request by its ID; also accepts the text/plain body navigator.sendBeacon sends"""
+    data = request.get_json(force=True, silent=True) or {}
+    aborted = active_turns.abort(request_client(), str(data.get('request_id', '')))
+    return jsonify({'aborted': aborted}), 200 if aborted else 404
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Answer a JSONL body of prompts, relaying results as NDJSON in the order they complete.
+
+    A `{"checkpoint": ...}` line follows every BATCH_CHECKPOINT_EVERY results and ends the
+    stream. Sending the same input again with the last checkpoint received, as the
+    `checkpoint` query parameter, carries on where that left off.
+    """
+    try:
+        parallel = int(request.args.get('parallel', BATCH_PARALLEL))
+        checkpoint = BatchCheckpoint.from_dict(json.loads(request.args.get('checkpoint', '{}')))
+    except ValueError as e:
+        return jsonify({'error': f"Invalid batch parameters: {e}"}), 400
+    run = BatchRun(request.stream, parallel, checkpoint, request.args.get('id_field'),
+                   request.args.get('prompt_field'), use_cache=request.args.get('cache') != 'false',
+                   client=request_client(), cancel_reason='disconnect')
+
+    def generate():
+        results = iter(run)
+        try:
+            for count, result in enumerate(results, 1):
+                yield json.dumps(result) + '\n'
+                if count % BATCH_CHECKPOINT_EVERY == 0:
+                    yield json.dumps({'checkpoint': run.checkpoint.to_dict()}) + '\n'
+        finally:
+            # Stops the prompts still being answered if the client went away
+            results.close()
+        yield json.dumps({**run.stats(), 'done': True}) + '\n'
+
+    return ndjson_response(generate())
+
+@app.before_request
+def start_background_tasks():
+    """Start warming the models and checking the backends, once per process; under a WSGI server
+    that happens on the first request a worker gets"""
+    model_warmer.start()
+    backend_pool.start_health_checks()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.path in TRACED_ROUTES and request.method == 'POST':
+        g.trace = tracer.start(f"POST {request.path}")
+
+@app.teardown_request
+def finish_trace(error):
+    """End the trace of a request that failed or wasn't streamed"""
+    trace = g.pop('trace', None)
+    if trace is not None:
+        if error is not None:
+            trace.error = str(error)
+        tracer.finish(trace, g.get('response_status', 500))
+
+@app.after_request
+def count_request(response):
+    g.response_status = response.status_code
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    args = (route, request.method, response.status_code, g.request_started)
+    if response.mimetype == 'application/x-ndjson':
+        # Streamed replies are timed until their last chunk has been sent
+        response.call_on_close(lambda: record_request(*args))
+        trace = g.pop('trace', None)
+        if trace is not None:
+            response.call_on_close(lambda: tracer.finish(trace, response.status_code))
+    else:
+        record_request(*args)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress larger JSON and text responses, such as history pages and metrics, for clients that accept it"""
+    if (response.mimetype not in ('application/json', 'text/plain') or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''), ('br', 'gzip') if brotli else ('gzip',))
+    if encoding != 'identity':
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    scheduler_stats = scheduler.stats()
+    gauges = (
+        ('nicebear_generations_in_flight', 'Generations running on Ollama', scheduler_stats['active']),
+        ('nicebear_generations_queued', 'Generations waiting for a slot', scheduler_stats['queued']),
+        ('nicebear_backends_healthy', 'Ollama hosts passing health checks',
+         sum(backend.healthy for backend in backend_pool.backends)),
+    )
+    lines = []
+    for name, help, value in gauges:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {value}']
+    for metric in registered_metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stats')
+def stats():
+    """Counters from the server's caches and queues, for tuning"""
+    return jsonify({
+        'contexts': conversation_contexts.stats(),
+        'response_cache': response_cache.stats(),
+        'semantic_cache': semantic_cache.stats() if semantic_cache is not None else None,
+        'scheduler': scheduler.stats(),
+        'coalescer': coalescer.stats(),
+        'profiles': profile_policy.stats(),
+        'routing': model_router.stats(),
+        'summarizer': summarizer.stats() if summarizer is not None else None,
+        'cancellation': active_turns.stats(),
+        'websocket': websocket_hub.stats(),
+        'backends': backend_pool.stats(),
+        'model': model_warmer.stats(),
+        'tracing': tracer.stats()
+    })
+
+@app.route('/api/debug/traces')
+def debug_traces():
+    """The slowest of the recently kept traces, slowest first"""
+    try:
+        limit = page_size(request.args.get('limit'), 20)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    return jsonify({'traces': tracer.slowest(limit), **tracer.stats()})
+
+@app.route('/api/ready')
+def ready():
+    """Readiness check for load balancers: 200 once the chat model is loaded on a healthy host"""
+    loaded_on = model_warmer.loaded_on()
+    status = 200 if loaded_on else 503
+    return jsonify({'ready': bool(loaded_on), 'models': MODEL_TIERS, 'loaded_on': loaded_on}), status
+
+@app.route('/api/conversations', methods=['GET'])
+def conversations_page():
+    try:
+        limit = page_size(request.args.get('limit'), CONVERSATION_PAGE_SIZE)
+        conversations, next_cursor = list_conversations(limit, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    return jsonify({'conversations': conversations, 'next_cursor': next_cursor})
+
+@app.route('/api/search')
+def search():
+    """Full-text search over every message, best match first"""
+    try:
+        limit = page_size(request.args.get('limit'), SEARCH_PAGE_SIZE)
+        results, next_cursor = search_messages(request.args.get('q', ''), limit, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    except SearchUnavailable as e:
+        return jsonify({'error': str(e)}), 501
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+@app.route('/api/conversations', methods=['POST'])
+def new_conversation():
+    data = request.get_json(silent=True) or {}
+    messages = data.get('messages') or []
+    if data.get('id') is not None and not isinstance(data['id'], str):
+        return jsonify({'error': 'A conversation id must be a string'}), 400
+    if not isinstance(messages, list) or not all(is_message(message) for message in messages):
+        return jsonify({'error': "Messages must be a list, each with a role of 'user' or 'assistant' and a "
+                                 "content string"}), 400
+    conversation = create_conversation(data.get('id'), messages)
+    return jsonify(conversation), 201
+
+@app.route('/api/conversations/<conversation_id>', methods=['DELETE'])
+def remove_conversation(conversation_id):
+    conversation_contexts.discard(conversation_id)
+    if not delete_conversation(conversation_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    return '', 204
+
+@app.route('/api/conversations/<conversation_id>/messages', methods=['GET'])
+def conversation_messages(conversation_id):
+    if get_conversation(conversation_id) is None:
+        return jsonify({'error': 'Conversation not found'}), 404
+    try:
+        limit = page_size(request.args.get('limit'), MESSAGE_PAGE_SIZE)
+        before = request.args.get('before', type=int)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    messages, next_cursor = get_messages(conversation_id, limit, before)
+    return jsonify({'messages': messages, 'next_cursor': next_cursor})
+
+@app.route('/api/conversations/<conversation_id>/messages', methods=['POST'])
+def add_message(conversation_id):
+    data = request.get_json(silent=True) or {}
+    if not is_message(data):
+        return jsonify({'error': "A message needs a role of 'user' or 'assistant' and a content string"}), 400
+    return jsonify(append_message(conversation_id, data['role'], data['content'])), 201
 
 # Explicitly serve the bear images
 @app.route('/lightbear.png')
 def serve_light_bear_image():
-    return send_from_directory(app.root_path, 'lightbear.png')
+    return asset_response('/lightbear.png')
 
 @app.route('/darkbear.png')
 def serve_dark_bear_image():
-    return send_from_directory(app.root_path, 'darkbear.png')
+    return asset_response('/darkbear.png')
+
+# ASGI serving path: async handlers for the chat and static routes that wait on Ollama
+# without holding a thread each. Run it with e.g. `uvicorn nicebear:asgi_app`; any
+# route without an async handler is passed through to the Flask app.
+
+_async_client = None
+
+def get_async_client():
+    """Return the process-wide async client used by the ASGI handlers"""
+    global _async_client
+    if _async_client is None:
+        if httpx is None:
+            raise RuntimeError("The ASGI serving mode needs httpx (pip install httpx)")
+        limits = httpx.Limits(max_connections=OLLAMA_ASYNC_MAX_CONNECTIONS,
+                              max_keepalive_connections=OLLAMA_POOL_SIZE)
+        # httpx only retries failed connection attempts, which is what we want for POSTs
+        transport = httpx.AsyncHTTPTransport(limits=limits, retries=OLLAMA_MAX_RETRIES)
+        _async_client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+        )
+    return _async_client
+
+@contextmanager
+def httpx_errors():
+    """Translate httpx exceptions into OllamaError like ollama_request does"""
+    try:
+        yield
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        raise upstream_error(OllamaUnavailable(f"Could not connect to Ollama: {e}")) from e
+    except httpx.TimeoutException as e:
+        raise upstream_error(OllamaTimeout(f"Ollama timed out: {e}")) from e
+    except httpx.HTTPError as e:
+        raise upstream_error(OllamaError(f"Could not reach Ollama: {e}")) from e
+
+async def async_ollama_send(method, path, model=None, conversation_id=None, stream=False, **kwargs):
+    """Async counterpart of ollama_send"""
+    client = get_async_client()
+    tried = []
+    error = None
+    while True:
+        backend = backend_pool.pick(model, conversation_id, exclude=tried)
+        if backend is None:
+            raise error
+        try:
+            with trace_span('ollama.connect', host=backend.url), httpx_errors():
+                response = await client.send(client.build_request(method, backend.url + path, **kwargs),
+                                             stream=stream)
+            if response.status_code != 200:
+                await response.aread()
+                await response.aclose()
+                raise upstream_error(OllamaError(f"{response.status_code} - {response.text}"))
+            return backend, response
+        except OllamaUnavailable as e:
+            backend_pool.release(backend, e)
+            tried.append(backend)
+            error = e
+        except BaseException:
+            backend_pool.release(backend)
+            raise
+
+async def async_ollama_stream(data, conversation_id=None):
+    """Async counterpart of ollama_stream"""
+    backend, response = await async_ollama_send('POST', '/api/generate', data.get('model'), conversation_id,
+                                                stream=True, json={"keep_alive": KEEP_ALIVE, **data, "stream": True})
+    try:
+        with httpx_errors():
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = parse_chunk(line)
+                if 'error' in chunk:
+                    raise upstream_error(OllamaError(chunk['error']))
+                if chunk.get('done'):
+                    record_generation(chunk)
+                yield chunk
+                if chunk.get('done'):
+                    return
+    finally:
+        await response.aclose()
+        backend_pool.release(backend)
+
+asgi_routes = {}
+
+def asgi_route(path, methods=('GET',)):
+    """Register an async handler with the ASGI app, like app.route does for Flask"""
+    def decorator(func):
+        for method in methods:
+            asgi_routes[(method, path)] = func
+        return func
+    return decorator
+
+class AsgiRequest:
+    """The parts of an ASGI HTTP request that the async handlers use"""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {key.decode('latin-1'): value.decode('latin-1')
+                        for key, value in scope.get('headers', [])}
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        self.args = {key: values[0] for key, values in query.items()}
+
+    async def body(self):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    async def json(self):
+        return json.loads(await self.body() or b'{}')
+
+class AsgiResponse:
+    """A complete response sent by an async handler"""
+
+    def __init__(self, body=b'', status=200, headers=None, content_type='application/json'):
+        self.body = body
+        self.status = status
+        self.headers = {'content-type': content_type, **(headers or {})}
+
+    def raw_headers(self):
+        return [(key.lower().encode('latin-1'), str(value).encode('latin-1'))
+                for key, value in self.headers.items()]
+
+    async def __call__(self, send):
+        headers = self.raw_headers() + [(b'content-length', str(len(self.body)).encode())]
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+class AsgiStreamingResponse(AsgiResponse):
+    """A response whose body is sent piece by piece from an async generator of bytes.
+
+    Given the request's receive channel, it stops as soon as the client disconnects and calls
+    on_disconnect; stop() ends it early from any thread. Either way the generator is closed.
+    """
+
+    def __init__(self, chunks, status=200, headers=None, content_type='application/x-ndjson', on_close=None,
+                 receive=None, on_disconnect=None):
+        super().__init__(b'', status, headers, content_type)
+        self.chunks = chunks
+        self.on_close = on_close
+        self.receive = receive
+        self.on_disconnect = on_disconnect
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def pump(self, send):
+        async for chunk in self.chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    async def __call__(self, send):
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': self.raw_headers()})
+        pump = asyncio.ensure_future(self.pump(send))
+        waits = [pump, asyncio.ensure_future(self.stopped.wait())]
+        if self.receive is not None:
+            disconnected = asyncio.ensure_future(wait_for_disconnect(self.receive))
+            waits.append(disconnected)
+        try:
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            finished = pump.done()
+            gone = not finished and self.receive is not None and disconnected.done()
+            if gone and self.on_disconnect is not None:
+                self.on_disconnect()
+        finally:
+            for waiting in waits:
+                waiting.cancel()
+            # Let the pump unwind before closing the generator it was iterating
+            await asyncio.wait([pump])
+            await self.chunks.aclose()
+            if self.on_close is not None:
+                self.on_close()
+        if finished:
+            pump.result()
+        if not gone:
+            await send({'type': 'http.response.body', 'body': b''})
+
+async def wait_for_disconnect(receive):
+    """Return once the client has gone away; call after the request body has been read"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+def asgi_json(data, status=200, headers=None):
+    return AsgiResponse(json.dumps(data).encode('utf-8'), status, headers)
+
+async def asgi_asset(path, request):
+    asset = static_assets[path]
+    # Only the first request reads the file
+    if asset.mtime is None or app.debug:
+        await asyncio.to_thread(asset.load)
+    status, body, headers = asset.respond(request.headers)
+    return AsgiResponse(body, status, headers, content_type=asset.content_type)
+
+@asgi_route('/')
+async def asgi_home(request):
+    return await asgi_asset('/', request)
+
+@asgi_route('/lightbear.png')
+async def asgi_light_bear_image(request):
+    return await asgi_asset('/lightbear.png', request)
+
+@asgi_route('/darkbear.png')
+async def asgi_dark_bear_image(request):
+    return await asgi_asset('/darkbear.png', request)
+
+def asgi_client(request):
+    """Async counterpart of request_client"""
+    client = request.scope.get('client')
+    return request.headers.get('x-client-id') or (client[0] if client else 'anonymous')
+
+async def one_chunk(chunk):
+    yield chunk
+
+def asgi_ndjson(chunks, on_close=None, headers=None, receive=None, on_disconnect=None):
+    return AsgiStreamingResponse(chunks, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',
+                                                  **(headers or {})},
+                                 on_close=on_close, receive=receive, on_disconnect=on_disconnect)
+
+@asgi_route('/api/chat', methods=['POST'])
+async def asgi_chat(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    error = chat_request_error(data)
+    if error is not None:
+        return asgi_json({'error': error}, 400)
+    user_input = data.get('message', '')
+    if not user_input.strip():
+        return asgi_json({'response': 'Please enter a message'})
+
+    turn = ChatTurn.from_request(data, asgi_client(request), request.headers)
+    await asyncio.to_thread(turn.prepare)
+    # Generate in a task of its own, so a disconnect or an abort can cancel it mid-wait
+    loop = asyncio.get_running_loop()
+    generation = asyncio.ensure_future(turn.async_generate())
+    turn.interrupt = lambda: loop.call_soon_threadsafe(generation.cancel)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request.receive))
+    try:
+        with trace_span('generate'):
+            await asyncio.wait([generation, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not generation.done():
+                turn.cancel('disconnect')
+            result = await generation
+    except asyncio.CancelledError:
+        if turn.cancelled is None:
+            raise
+        return asgi_json(cancelled_body(turn), GenerationCancelled.status)
+    except GenerationCancelled as e:
+        return asgi_json(cancelled_body(turn), e.status)
+    except QueueFull as e:
+        return asgi_json(busy_body(e), e.status, {'Retry-After': e.retry_after})
+    except OllamaError as e:
+        return asgi_json({'response': f"Error: {e}"}, e.status)
+    finally:
+        disconnected.cancel()
+        generation.cancel()
+    with trace_span('respond'):
+        return asgi_json({'response': result.get('response', 'No response generated'), **turn.response_fields()})
+
+@asgi_route('/api/chat/stream', methods=['POST'])
+async def asgi_chat_stream(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    error = chat_request_error(data)
+    if error is not None:
+        return asgi_json({'error': error}, 400)
+    user_input = data.get('message', '')
+    if not user_input.strip():
+        return asgi_ndjson(one_chunk((json.dumps({'response': 'Please enter a message', 'done': True}) + '\n').encode()))
+
+    turn = ChatTurn.from_request(data, asgi_client(request), request.headers)
+    await asyncio.to_thread(turn.prepare)
+    headers = {'X-Request-ID': turn.request_id}
+    if turn.cached:
+        await asyncio.to_thread(turn.finish, turn.cached)
+        return asgi_ndjson(one_chunk(turn.client_chunk({**turn.cached, 'done': True}).encode()), headers=headers)
+
+    try:
+        chunks = await turn.async_open_stream()
+    except QueueFull as e:
+        turn.close()
+        return asgi_json(busy_body(e), e.status, {'Retry-After': e.retry_after})
+    except GenerationCancelled as e:
+        turn.close()
+        return asgi_json(cancelled_body(turn), e.status)
+
+    async def generate():
+        try:
+            async for chunk in chunks:
+                turn.check_cancelled()
+                if turn.collect(chunk):
+                    await asyncio.to_thread(turn.finish)
+                yield turn.client_chunk(chunk).encode()
+        except GenerationCancelled:
+            yield (json.dumps({**cancelled_body(turn), 'done': True}) + '\n').encode()
+        except OllamaError as e:
+            trace_error(e)
+            yield (json.dumps({'error': f"Error: {e}", 'done': True}) + '\n').encode()
+        except QueueFull as e:
+            trace_error(e)
+            yield (json.dumps({**busy_body(e), 'done': True}) + '\n').encode()
+        finally:
+            # Closing the stream from Ollama makes it stop generating
+            await chunks.aclose()
+
+    response = asgi_ndjson(generate(), on_close=turn.close, headers=headers, receive=request.receive,
+                           on_disconnect=lambda: turn.cancel('disconnect'))
+    turn.interrupt = response.stop
+    return response
+
+@asgi_route('/api/chat/abort', methods=['POST'])
+async def asgi_abort_chat(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    request_id = str(data.get('request_id', '')) if isinstance(data, dict) else ''
+    aborted = active_turns.abort(asgi_client(request), request_id)
+    return asgi_json({'aborted': aborted}, 200 if aborted else 404)
+
+# WebSocket chat channel: one connection carries the chat requests of any number of
+# conversations, and each reply is streamed back as messages tagged with its request and
+# conversation IDs. Replies leave through a bounded queue per connection, so a client that
+# reads slowly holds up its own generations instead of the server buffering for it.
+
+class WebSocketHub:
+    """Counts of WebSocket connections and the chat requests sent over them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.opened = 0
+        self.requests = 0
+        self.rejected = 0
+        # Messages that found their connection's send queue full and had to wait
+        self.send_waits = 0
+
+    def count(self, name, amount=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'open': self.open,
+                'opened': self.opened,
+                'requests': self.requests,
+                'rejected': self.rejected,
+                'send_waits': self.send_waits
+            }
+
+websocket_hub = WebSocketHub()
+
+class WebSocketChannel:
+    """One /api/ws connection.
+
+    The client sends JSON messages: {"type": "chat", ...} with the fields /api/chat takes, and
+    {"type": "cancel", "request_id": ...}. A chat request is answered with "chunk" messages like
+    the lines of /api/chat/stream, the last one with "done"; or with an "error" message, also
+    with "done", if it fails. While it waits for a slot it gets "queued" messages with its
+    place in the queue. Every message about a request carries its request_id and
+    conversation_id. Closing the connection cancels the requests still running on it.
+    """
+
+    def __init__(self, scope, receive, send):
+        self.receive = receive
+        self.send = send
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                   for key, value in scope.get('headers', [])}
+        client = scope.get('client')
+        self.client = headers.get('x-client-id') or (client[0] if client else 'anonymous')
+        self.outbox = asyncio.Queue(WS_SEND_QUEUE)
+        self.pending_replies = 0
+        self.turns = {}
+        self.tasks = set()
+
+    async def run(self):
+        if (await self.receive())['type'] != 'websocket.connect':
+            return
+        await self.send({'type': 'websocket.accept'})
+        websocket_hub.count('opened')
+        websocket_hub.count('open')
+        sender = asyncio.ensure_future(self.pump())
+        try:
+            while True:
+                message = await self.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message['type'] == 'websocket.receive':
+                    await self.handle(message.get('text') or message.get('bytes') or '')
+        finally:
+            for turn in list(self.turns.values()):
+                turn.cancel('disconnect')
+            tasks = [sender, *self.tasks]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            websocket_hub.count('open', -1)
+
+    async def pump(self):
+        """Send queued messages one at a time, as fast as the client takes them"""
+        while True:
+            message = await self.outbox.get()
+            await self.send({'type': 'websocket.send', 'text': json.dumps(message)})
+
+    async def post(self, message):
+        if self.outbox.full():
+            websocket_hub.count('send_waits')
+        await self.outbox.put(message)
+
+    async def reply(self, message):
+        """Post a reply from the receive loop without holding it up, so cancels keep coming in while
+        the client is slow to read. With WS_SEND_QUEUE replies already waiting, the loop waits
+        too: a client that keeps sending without reading is slowed down rather than buffered for.
+        """
+        if self.pending_replies >= WS_SEND_QUEUE:
+            await self.post(message)
+            return
+        self.pending_replies += 1
+        self.spawn(self.post_reply(message))
+
+    async def post_reply(self, message):
+        try:
+            await self.post(message)
+        finally:
+            self.pending_replies -= 1
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def handle(self, text):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await self.reply({'type': 'error', 'error': 'Invalid JSON message', 'status': 400})
+        elif data.get('type') == 'chat':
+            await self.start_chat(data)
+        elif data.get('type') == 'cancel':
+            turn = self.turns.get(data.get('request_id'))
+            if turn is not None:
+                turn.cancel('abort')
+        elif data.get('type') == 'ping':
+            await self.reply({'type': 'pong'})
+        else:
+            await self.reply({'type': 'error', 'error': f"Unknown message type {data.get('type')!r}", 'status': 400})
+
+    async def start_chat(self, data):
+        turn = ChatTurn.from_request(data, self.client)
+        tags = {'request_id': turn.request_id, 'conversation_id': turn.conversation_id}
+        error = chat_request_error(data)
+        if error is not None:
+            await self.reply({'type': 'error', **tags, 'error': error, 'status': 400, 'done': True})
+            return
+        if not turn.message.strip():
+            await self.reply({'type': 'chunk', **tags, 'response': 'Please enter a message', 'done': True})
+            return
+        if turn.request_id in self.turns:
+            websocket_hub.count('rejected')
+            await self.reply({'type': 'error', **tags, 'error': 'A request with this ID is still running',
+                             'status': 409, 'done': True})
+            return
+        if len(self.turns) >= WS_MAX_REQUESTS:
+            websocket_hub.count('rejected')
+            await self.reply({'type': 'error', **tags, 'status': 429, 'done': True,
+                             'error': f"At most {WS_MAX_REQUESTS} requests may run at once on a connection"})
+            return
+        websocket_hub.count('requests')
+        self.turns[turn.request_id] = turn
+        self.spawn(self.chat(turn, tags))
+
+    async def chat(self, turn, tags):
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        turn.interrupt = lambda: loop.call_soon_threadsafe(task.cancel)
+        turn.on_queued = lambda waiter: self.spawn(self.report_position(waiter, tags))
+        # The task has a context of its own, so its trace doesn't mix with the connection's others
+        trace = tracer.start('WS /api/ws chat')
+        trace_tag(request_id=turn.request_id, conversation_id=turn.conversation_id, client=turn.client)
+        status = 500
+        chunks = None
+        try:
+            await asyncio.to_thread(turn.prepare)
+            chunks = await turn.async_open_stream()
+            async for chunk in chunks:
+                turn.check_cancelled()
+                if turn.collect(chunk):
+                    await asyncio.to_thread(turn.finish)
+                await self.post({'type': 'chunk', **tags, **turn.client_reply(chunk)})
+            status = 200
+        except (GenerationCancelled, asyncio.CancelledError):
+            if turn.cancelled is None:
+                raise
+            status = GenerationCancelled.status
+            # Nobody is left to tell after a disconnect
+            if turn.cancelled == 'abort':
+                await self.post({'type': 'error', **tags, **cancelled_body(turn), 'status': GenerationCancelled.status,
+                                 'done': True})
+        except QueueFull as e:
+            status = e.status
+            await self.post({'type': 'error', **tags, **busy_body(e), 'status': e.status,
+                             'retry_after': e.retry_after, 'done': True})
+        except OllamaError as e:
+            status = e.status
+            await self.post({'type': 'error', **tags, 'error': f"Error: {e}", 'status': e.status, 'done': True})
+        finally:
+            # Closing the stream from Ollama makes it stop generating
+            if chunks is not None:
+                await chunks.aclose()
+            turn.close()
+            self.turns.pop(turn.request_id, None)
+            tracer.finish(trace, status)
+
+    async def report_position(self, waiter, tags):
+        """Tell the client where its request stands in the queue whenever that changes"""
+        last = None
+        while True:
+            position = scheduler.position(waiter)
+            if position is None:
+                return
+            if position != last:
+                await self.post({'type': 'queued', **tags, 'position': position})
+                last = position
+            await asyncio.sleep(WS_QUEUE_REPORT_INTERVAL)
+
+if WsgiToAsgi is not None:
+    class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+        # asgiref runs every WSGI request on one shared thread, so a long streamed response such as
+        # /api/batch would hold up every other Flask route; here each gets a thread from the pool
+        run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False)
+
+    class ThreadedWsgiToAsgi(WsgiToAsgi):
+        """WsgiToAsgi that serves Flask requests side by side"""
+
+        async def __call__(self, scope, receive, send):
+            await ThreadedWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+_wsgi_fallback = ThreadedWsgiToAsgi(app) if WsgiToAsgi is not None else None
+
+async def asgi_lifespan(receive, send):
+    """Handle ASGI startup and shutdown, closing the async client on the way out"""
+    global _async_client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_background_tasks()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _async_client is not None:
+                await _async_client.aclose()
+                _async_client = None
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point serving the async handlers, with Flask handling everything else"""
+    if scope['type'] == 'lifespan':
+        await asgi_lifespan(receive, send)
+        return
+    if scope['type'] == 'websocket':
+        if scope['path'] == '/api/ws':
+            await WebSocketChannel(scope, receive, send).run()
+        else:
+            # Closing before accepting turns the handshake down
+            await send({'type': 'websocket.close'})
+        return
+    if scope['type'] != 'http':
+        return
+
+    started = time.perf_counter()
+    handler = asgi_routes.get((scope['method'], scope['path']))
+    if handler is None:
+        if _wsgi_fallback is not None:
+            # Flask records its own metrics
+            await _wsgi_fallback(scope, receive, send)
+            return
+        route = 'unmatched'
+        response = asgi_json({'error': 'Not found'}, 404)
+    else:
+        route = scope['path']
+        request = AsgiRequest(scope, receive)
+        # Each request is a task of its own, so the trace stays with it and the tasks it starts
+        trace = tracer.start(f"POST {route}") if route in TRACED_ROUTES and scope['method'] == 'POST' else None
+        try:
+            response = await handler(request)
+        except ValueError:
+            response = asgi_json({'error': 'Invalid JSON body'}, 400)
+        except BaseException as e:
+            if trace is not None:
+                trace.error = str(e)
+                tracer.finish(trace, 500)
+            raise
+    try:
+        await response(send)
+    finally:
+        record_request(route, scope['method'], response.status, started)
+        if handler is not None and trace is not None:
+            tracer.finish(trace, response.status)
 
 def open_browser():
     """Open the browser after a short delay"""
@@ -55,8 +4040,10 @@ def open_browser():
 
 # Create templates directory and HTML file
 def create_template_files():
-    # Create templates directory
-    os.makedirs('templates', exist_ok=True)
+    # Create templates directory next to the script, where the page is served from, whatever the
+    # working directory
+    template_dir = os.path.join(app.root_path, 'templates')
+    os.makedirs(template_dir, exist_ok=True)
     
     html_content = '''
     <!DOCTYPE html>
@@ -130,6 +4117,7 @@ def create_template_files():
             
             .conversation-list {
                 flex-grow: 1;
+                min-height: 0;
                 overflow-y: auto;
             }
             
@@ -164,15 +4152,47 @@ def create_template_files():
                 background-color: var(--delete-btn-hover);
             }
             
-            .conversation-item:hover .delete-btn {
-                visibility: visible;
+            .conversation-item:hover .delete-btn {
+                visibility: visible;
+            }
+            
+            .conversation-title {
+                white-space: nowrap;
+                overflow: hidden;
+                text-overflow: ellipsis;
+                flex-grow: 1;
+            }
+            
+            .load-more {
+                padding: 8px 15px;
+                text-align: center;
+                cursor: pointer;
+                color: var(--thinking-color);
+            }
+            
+            .load-more:hover {
+                background-color: var(--hover-color);
+            }
+            
+            .search-input {
+                margin: 0 10px 10px;
+                padding: 8px;
+                border: 1px solid var(--border-color);
+                border-radius: 4px;
+                background-color: var(--input-bg);
+                color: var(--text-color);
+            }
+            
+            .search-result {
+                flex-direction: column;
+                align-items: stretch;
             }
             
-            .conversation-title {
-                white-space: nowrap;
-                overflow: hidden;
-                text-overflow: ellipsis;
-                flex-grow: 1;
+            .search-snippet {
+                font-size: 0.85em;
+                color: var(--thinking-color);
+                overflow-wrap: anywhere;
+                margin-top: 4px;
             }
             
             .new-chat-btn {
@@ -235,14 +4255,15 @@ def create_template_files():
                 background-color: var(--chat-bg);
             }
             
+            /* Spacing is padding rather than margin so each message's height includes it */
             .user-message {
                 color: var(--user-msg-color);
-                margin-bottom: 10px;
+                padding-bottom: 10px;
             }
             
             .llm-message {
                 color: var(--llm-msg-color);
-                margin-bottom: 20px;
+                padding-bottom: 20px;
             }
             
             .thinking {
@@ -287,9 +4308,11 @@ def create_template_files():
                 <h3>Conversations</h3>
             </div>
             <div class="new-chat-btn" onclick="startNewChat()">New Chat</div>
+            <input type="search" id="search-input" class="search-input" placeholder="Search messages...">
             <div id="conversation-list" class="conversation-list">
                 <!-- Conversation history will be populated here -->
             </div>
+            <div id="search-results" class="conversation-list" style="display: none"></div>
         </div>
         
         <!-- Main Content -->
@@ -299,11 +4322,7 @@ def create_template_files():
                 <h1>nicebear</h1>
                 <button id="theme-toggle">🌙 Dark Mode</button>
             </div>
-            <div id="chat-container">
-                <div>chat with bear</div>
-                <div>type your message</div>
-                <br>
-            </div>
+            <div id="chat-container"></div>
             <div id="input-container">
                 <input type="text" id="user-input" placeholder="Type your message here...">
                 <button id="send-button">Send</button>
@@ -315,13 +4334,26 @@ def create_template_files():
             const userInput = document.getElementById('user-input');
             const sendButton = document.getElementById('send-button');
             const conversationList = document.getElementById('conversation-list');
+            const searchInput = document.getElementById('search-input');
+            const searchResults = document.getElementById('search-results');
             const themeToggle = document.getElementById('theme-toggle');
             const bearImage = document.getElementById('bear-image');
             const body = document.body;
             
-            // Store conversations
-            let conversations = [];
+            // Conversations by ID, and the sidebar order (most recently updated first)
+            const conversationsById = new Map();
+            let conversationOrder = [];
             let currentConversationId = null;
+            let nextConversationCursor = null;
+            let nextMessageCursor = null;
+            let loadingMore = false;
+            
+            // Messages of the open conversation; messages not stored yet get a local key
+            let messages = [];
+            let localKeyCounter = 0;
+            
+            // How many of a conversation's latest messages are kept in IndexedDB
+            const CACHED_MESSAGES = 50;
             
             // Theme management
             function toggleTheme() {
@@ -352,152 +4384,840 @@ def create_template_files():
             
             themeToggle.addEventListener('click', toggleTheme);
             
-            // Load conversations from localStorage if available
-            function loadConversations() {
+            async function fetchJSON(url, options) {
+                const response = await fetch(url, options);
+                if (!response.ok) {
+                    throw new Error(`${response.status} ${response.statusText}`);
+                }
+                return response.json();
+            }
+            
+            function postJSON(url, data) {
+                return fetchJSON(url, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify(data),
+                });
+            }
+            
+            // Local copy of the sidebar and of each conversation's latest messages, so the page
+            // can show them before the server answers. Every conversation is its own record, so
+            // a turn only rewrites the conversation it belongs to. Without IndexedDB (some
+            // private windows) everything still works from the server.
+            const localStore = {
+                db: null,
+                
+                open() {
+                    return new Promise(resolve => {
+                        if (!window.indexedDB) return resolve(null);
+                        const request = indexedDB.open('nicebear', 1);
+                        request.onupgradeneeded = () => {
+                            request.result.createObjectStore('conversations', { keyPath: 'id' });
+                            request.result.createObjectStore('messages', { keyPath: 'id' });
+                        };
+                        request.onsuccess = () => resolve(this.db = request.result);
+                        request.onerror = () => resolve(null);
+                        request.onblocked = () => resolve(null);
+                    });
+                },
+                
+                run(store, mode, operation) {
+                    return new Promise(resolve => {
+                        if (!this.db) return resolve(null);
+                        const request = operation(this.db.transaction(store, mode).objectStore(store));
+                        request.onsuccess = () => resolve(request.result);
+                        request.onerror = () => resolve(null);
+                    });
+                },
+                
+                get(store, id) {
+                    return this.run(store, 'readonly', s => s.get(id));
+                },
+                
+                getAll(store) {
+                    return this.run(store, 'readonly', s => s.getAll());
+                },
+                
+                put(store, value) {
+                    return this.run(store, 'readwrite', s => s.put(value));
+                },
+                
+                delete(store, id) {
+                    return this.run(store, 'readwrite', s => s.delete(id));
+                },
+            };
+            
+            // Renders only the rows of a long list that are in or near view, between two spacers
+            // that stand in for the rest. Rows are measured once shown; rows not seen yet count
+            // as `estimate` pixels. Row elements are kept by key, so updates touch only the rows
+            // that changed. With `anchored`, the row at the top of the view stays where it is when
+            // rows above it are added or change height.
+            class VirtualList {
+                constructor(container, { estimate, key, render, overscan = 8, anchored = false }) {
+                    this.container = container;
+                    this.estimate = estimate;
+                    this.keyOf = key;
+                    this.renderRow = render;
+                    this.overscan = overscan;
+                    this.anchored = anchored;
+                    this.items = [];
+                    this.indexByKey = new Map();
+                    this.heights = new Map();
+                    this.rows = new Map();
+                    this.offsets = [0];
+                    this.dirty = true;
+                    this.anchor = null;
+                    this.stickToEnd = false;
+                    this.frame = null;
+                    
+                    this.topSpacer = document.createElement('div');
+                    this.content = document.createElement('div');
+                    this.bottomSpacer = document.createElement('div');
+                    container.append(this.topSpacer, this.content, this.bottomSpacer);
+                    
+                    container.addEventListener('scroll', () => {
+                        // The user moved; anchor to whatever is at the top now
+                        this.anchor = null;
+                        this.schedule();
+                    });
+                    window.addEventListener('resize', () => {
+                        // Wrapping changes with the width, so every height has to be measured again
+                        this.heights.clear();
+                        this.dirty = true;
+                        this.schedule();
+                    });
+                }
+                
+                setItems(items) {
+                    this.items = items;
+                    this.indexByKey = new Map(items.map((item, i) => [this.keyOf(item), i]));
+                    this.dirty = true;
+                    this.schedule();
+                }
+                
+                // The row for an item, if it is on screen
+                rowFor(item) {
+                    return this.rows.get(this.keyOf(item));
+                }
+                
+                // Call after a row grew or shrank, e.g. while a reply streams in
+                resized(item) {
+                    this.heights.delete(this.keyOf(item));
+                    this.dirty = true;
+                    this.schedule();
+                }
+                
+                scrollToEnd() {
+                    this.stickToEnd = true;
+                    this.schedule();
+                }
+                
+                atEnd() {
+                    const c = this.container;
+                    return c.scrollTop + c.clientHeight >= c.scrollHeight - 30;
+                }
+                
+                schedule() {
+                    if (this.frame === null) {
+                        this.frame = requestAnimationFrame(() => {
+                            this.frame = null;
+                            this.update();
+                        });
+                    }
+                }
+                
+                computeOffsets() {
+                    const offsets = new Array(this.items.length + 1);
+                    offsets[0] = 0;
+                    for (let i = 0; i < this.items.length; i++) {
+                        const height = this.heights.get(this.keyOf(this.items[i]));
+                        offsets[i + 1] = offsets[i] + (height === undefined ? this.estimate : height);
+                    }
+                    this.offsets = offsets;
+                    this.dirty = false;
+                }
+                
+                // Index of the item at `y` pixels from the top of the list
+                indexAt(y) {
+                    let low = 0;
+                    let high = this.items.length;
+                    while (low < high) {
+                        const mid = (low + high) >> 1;
+                        if (this.offsets[mid + 1] <= y) low = mid + 1;
+                        else high = mid;
+                    }
+                    return low;
+                }
+                
+                update() {
+                    if (this.dirty) this.computeOffsets();
+                    const count = this.items.length;
+                    const follow = this.stickToEnd;
+                    this.stickToEnd = false;
+                    
+                    // Where the list starts inside the container, below anything placed before it
+                    const top = this.topSpacer.getBoundingClientRect().top
+                        - this.container.getBoundingClientRect().top + this.container.scrollTop;
+                    const height = this.container.clientHeight;
+                    let viewTop = this.container.scrollTop - top;
+                    if (this.anchor && !this.indexByKey.has(this.anchor.key)) this.anchor = null;
+                    if (this.anchored && !this.anchor && count > 0) {
+                        const i = Math.min(this.indexAt(Math.max(viewTop, 0)), count - 1);
+                        this.anchor = { key: this.keyOf(this.items[i]), delta: viewTop - this.offsets[i] };
+                    }
+                    
+                    // Rows seen for the first time may not be as tall as estimated; lay out until it settles
+                    for (let pass = 0; pass < 3; pass++) {
+                        if (follow) {
+                            viewTop = this.offsets[count] - height;
+                        } else if (this.anchored && this.anchor) {
+                            viewTop = this.offsets[this.indexByKey.get(this.anchor.key)] + this.anchor.delta;
+                        }
+                        this.render(viewTop, height);
+                        if (!this.measure()) break;
+                        this.computeOffsets();
+                    }
+                    
+                    const scrollTop = follow ? this.container.scrollHeight : top + viewTop;
+                    if (Math.abs(this.container.scrollTop - scrollTop) >= 1) {
+                        this.container.scrollTop = scrollTop;
+                    }
+                }
+                
+                render(viewTop, height) {
+                    const count = this.items.length;
+                    const start = Math.max(0, this.indexAt(Math.max(viewTop, 0)) - this.overscan);
+                    const end = Math.min(count, this.indexAt(viewTop + height) + 1 + this.overscan);
+                    
+                    // Drop the rows that left the range, then put the range in order, reusing rows
+                    const wanted = new Set();
+                    for (let i = start; i < end; i++) {
+                        wanted.add(this.keyOf(this.items[i]));
+                    }
+                    for (const [key, row] of this.rows) {
+                        if (!wanted.has(key)) {
+                            row.remove();
+                            this.rows.delete(key);
+                        }
+                    }
+                    let next = this.content.firstChild;
+                    for (let i = start; i < end; i++) {
+                        const key = this.keyOf(this.items[i]);
+                        let row = this.rows.get(key);
+                        if (!row) {
+                            row = this.renderRow(this.items[i]);
+                            row.dataset.key = key;
+                            this.rows.set(key, row);
+                        }
+                        if (row === next) {
+                            next = next.nextSibling;
+                        } else {
+                            this.content.insertBefore(row, next);
+                        }
+                    }
+                    this.topSpacer.style.height = `${this.offsets[start]}px`;
+                    this.bottomSpacer.style.height = `${this.offsets[count] - this.offsets[end]}px`;
+                }
+                
+                // Record the heights of the rows on screen; true if any changed
+                measure() {
+                    let changed = false;
+                    for (const [key, row] of this.rows) {
+                        const height = row.offsetHeight;
+                        if (this.heights.get(key) !== height) {
+                            this.heights.set(key, height);
+                            changed = true;
+                        }
+                    }
+                    return changed;
+                }
+            }
+            
+            // Sidebar rows; clicks are handled once for the whole list
+            function createConversationItem(id) {
+                const conv = conversationsById.get(id);
+                const item = document.createElement('div');
+                item.className = 'conversation-item';
+                if (id === currentConversationId) {
+                    item.classList.add('active');
+                }
+                
+                // Create title span; the server titles conversations with the first user message
+                const titleSpan = document.createElement('span');
+                titleSpan.className = 'conversation-title';
+                titleSpan.textContent = conv.title || 'New conversation';
+                item.appendChild(titleSpan);
+                
+                // Create delete button
+                const deleteBtn = document.createElement('span');
+                deleteBtn.className = 'delete-btn';
+                deleteBtn.textContent = 'x';
+                deleteBtn.title = 'Delete conversation';
+                item.appendChild(deleteBtn);
+                return item;
+            }
+            
+            const sidebarList = new VirtualList(conversationList, {
+                estimate: 40,
+                key: id => id,
+                render: createConversationItem,
+            });
+            
+            const loadMoreButton = document.createElement('div');
+            loadMoreButton.className = 'load-more';
+            loadMoreButton.textContent = 'Load more';
+            loadMoreButton.onclick = () => loadMoreConversations();
+            conversationList.appendChild(loadMoreButton);
+            
+            conversationList.addEventListener('click', event => {
+                const item = event.target.closest('.conversation-item');
+                if (!item) return;
+                if (event.target.closest('.delete-btn')) {
+                    deleteConversation(item.dataset.key);
+                } else {
+                    loadConversation(item.dataset.key);
+                }
+            });
+            
+            // Show the sidebar in its current order
+            function renderConversationList() {
+                sidebarList.setItems(conversationOrder);
+                loadMoreButton.style.display = nextConversationCursor ? '' : 'none';
+            }
+            
+            // Update the title of one sidebar row
+            function renderConversationTitle(id) {
+                const row = sidebarList.rowFor(id);
+                if (row) {
+                    row.querySelector('.conversation-title').textContent = conversationsById.get(id).title || 'New conversation';
+                }
+            }
+            
+            function setCurrentConversation(id) {
+                const previous = sidebarList.rowFor(currentConversationId);
+                if (previous) previous.classList.remove('active');
+                currentConversationId = id;
+                const row = sidebarList.rowFor(id);
+                if (row) row.classList.add('active');
+            }
+            
+            // Move a conversation to the top of the sidebar after it was updated
+            function bumpConversation(id) {
+                const conv = conversationsById.get(id);
+                conv.updated_at = Date.now() / 1000;
+                if (conversationOrder[0] !== id) {
+                    conversationOrder = [id, ...conversationOrder.filter(other => other !== id)];
+                    renderConversationList();
+                }
+                localStore.put('conversations', conv);
+            }
+            
+            function rememberConversations(list) {
+                for (const conv of list) {
+                    conversationsById.set(conv.id, conv);
+                }
+            }
+            
+            // Move conversations saved by older versions from localStorage to the server
+            async function migrateLocalConversations() {
                 const savedConversations = localStorage.getItem('nicebear-conversations');
-                if (savedConversations) {
-                    conversations = JSON.parse(savedConversations);
+                if (!savedConversations) return;
+                
+                // Oldest first, so the most recent conversation ends up at the top of the list
+                const saved = JSON.parse(savedConversations).reverse();
+                for (const conv of saved) {
+                    if (conv.messages.length > 0) {
+                        await postJSON('/api/conversations', { id: conv.id, messages: conv.messages });
+                    }
+                }
+                localStorage.removeItem('nicebear-conversations');
+            }
+            
+            // Show the copy kept in IndexedDB at once, then the first page from the server
+            async function loadConversations() {
+                await localStore.open();
+                const cached = (await localStore.getAll('conversations')) || [];
+                if (cached.length > 0) {
+                    cached.sort((a, b) => b.updated_at - a.updated_at);
+                    rememberConversations(cached);
+                    conversationOrder = cached.map(conv => conv.id);
                     renderConversationList();
+                    setCurrentConversation(conversationOrder[0]);
+                    await showCachedMessages(conversationOrder[0]);
+                }
+                
+                await migrateLocalConversations();
+                const page = await fetchJSON('/api/conversations');
+                rememberConversations(page.conversations);
+                conversationOrder = page.conversations.map(conv => conv.id);
+                nextConversationCursor = page.next_cursor;
+                page.conversations.forEach(conv => localStore.put('conversations', conv));
+                
+                // Forget local copies of conversations the server no longer has; ones older than
+                // the first page are kept until the sidebar reaches them
+                const oldest = page.next_cursor ? page.conversations[page.conversations.length - 1].updated_at : -Infinity;
+                const onServer = new Set(conversationOrder);
+                for (const conv of cached) {
+                    if (!onServer.has(conv.id) && conv.updated_at >= oldest) {
+                        conversationsById.delete(conv.id);
+                        localStore.delete('conversations', conv.id);
+                        localStore.delete('messages', conv.id);
+                    }
                 }
+                renderConversationList();
                 
                 // Start a new chat if no conversations exist
-                if (conversations.length === 0) {
-                    startNewChat();
+                if (conversationOrder.length === 0) {
+                    await startNewChat();
                 } else {
                     // Load the most recent conversation
-                    loadConversation(conversations[0].id);
+                    await loadConversation(conversationOrder[0]);
                 }
             }
             
-            // Save conversations to localStorage
-            function saveConversations() {
-                localStorage.setItem('nicebear-conversations', JSON.stringify(conversations));
+            // Fetch the next page of the sidebar
+            async function loadMoreConversations() {
+                if (!nextConversationCursor || loadingMore) return;
+                loadingMore = true;
+                try {
+                    const page = await fetchJSON(`/api/conversations?cursor=${encodeURIComponent(nextConversationCursor)}`);
+                    rememberConversations(page.conversations);
+                    const known = new Set(conversationOrder);
+                    conversationOrder = conversationOrder.concat(
+                        page.conversations.map(conv => conv.id).filter(id => !known.has(id)));
+                    nextConversationCursor = page.next_cursor;
+                    page.conversations.forEach(conv => localStore.put('conversations', conv));
+                    renderConversationList();
+                } finally {
+                    loadingMore = false;
+                }
             }
             
             // Delete a conversation
-            function deleteConversation(id, event) {
-                // Prevent the click from propagating to the parent (which would load the conversation)
-                event.stopPropagation();
-                
+            async function deleteConversation(id) {
                 // Ask for confirmation
                 if (confirm('Are you sure you want to delete this conversation?')) {
-                    // Remove the conversation from the array
-                    const index = conversations.findIndex(c => c.id === id);
-                    if (index !== -1) {
-                        conversations.splice(index, 1);
-                    }
+                    await fetch(`/api/conversations/${encodeURIComponent(id)}`, { method: 'DELETE' });
+                    
+                    // Remove the conversation from the list
+                    conversationsById.delete(id);
+                    conversationOrder = conversationOrder.filter(other => other !== id);
+                    localStore.delete('conversations', id);
+                    localStore.delete('messages', id);
                     
                     // If we deleted the current conversation, load another one
                     if (id === currentConversationId) {
-                        if (conversations.length > 0) {
-                            loadConversation(conversations[0].id);
+                        if (conversationOrder.length > 0) {
+                            await loadConversation(conversationOrder[0]);
                         } else {
-                            startNewChat();
+                            await startNewChat();
                         }
                     }
                     
-                    // Update UI and save
+                    // Update UI
                     renderConversationList();
-                    saveConversations();
                 }
             }
             
-            // Render the conversation list in the sidebar
-            function renderConversationList() {
-                conversationList.innerHTML = '';
-                
-                conversations.forEach(conv => {
-                    const item = document.createElement('div');
-                    item.className = 'conversation-item';
-                    if (conv.id === currentConversationId) {
-                        item.classList.add('active');
-                    }
-                    
-                    // Use the first user message as the title, or a default title
-                    let title = 'New conversation';
-                    for (const message of conv.messages) {
-                        if (message.role === 'user') {
-                            title = message.content.substring(0, 25);
-                            if (message.content.length > 25) title += '...';
-                            break;
-                        }
-                    }
-                    
-                    // Create title span
-                    const titleSpan = document.createElement('span');
-                    titleSpan.className = 'conversation-title';
-                    titleSpan.textContent = title;
-                    item.appendChild(titleSpan);
-                    
-                    // Create delete button
-                    const deleteBtn = document.createElement('span');
-                    deleteBtn.className = 'delete-btn';
-                    deleteBtn.textContent = 'x';
-                    deleteBtn.title = 'Delete conversation';
-                    deleteBtn.onclick = (e) => deleteConversation(conv.id, e);
-                    item.appendChild(deleteBtn);
-                    
-                    // Set click handler for the item
-                    item.onclick = () => loadConversation(conv.id);
-                    
-                    conversationList.appendChild(item);
-                });
+            // Full-text search over every message; while a query is typed its results replace
+            // the conversation list
+            let searchQuery = '';
+            let nextSearchCursor = null;
+            let searchTimer = null;
+            let searchGeneration = 0;
+            
+            const searchMoreButton = document.createElement('div');
+            searchMoreButton.className = 'load-more';
+            searchMoreButton.textContent = 'More results';
+            searchMoreButton.onclick = () => loadMoreSearchResults();
+            
+            searchInput.addEventListener('input', () => {
+                clearTimeout(searchTimer);
+                searchTimer = setTimeout(() => runSearch(searchInput.value.trim()), 200);
+            });
+            
+            searchInput.addEventListener('keydown', event => {
+                if (event.key === 'Escape') {
+                    searchInput.value = '';
+                    clearTimeout(searchTimer);
+                    runSearch('');
+                }
+            });
+            
+            // Show the first page of results for a query, or the conversations again when it is empty
+            async function runSearch(query) {
+                searchQuery = query;
+                const generation = ++searchGeneration;
+                if (!query) {
+                    searchResults.style.display = 'none';
+                    conversationList.style.display = '';
+                    return;
+                }
+                const page = await fetchJSON(`/api/search?q=${encodeURIComponent(query)}`).catch(() => null);
+                // An answer to an earlier query that arrives late is dropped
+                if (generation !== searchGeneration) return;
+                searchResults.replaceChildren();
+                conversationList.style.display = 'none';
+                searchResults.style.display = '';
+                showSearchResults(page);
             }
             
-            // Start a new chat
-            function startNewChat() {
-                const newId = Date.now().toString();
-                const newConversation = {
-                    id: newId,
-                    messages: []
-                };
+            async function loadMoreSearchResults() {
+                if (!nextSearchCursor) return;
+                const generation = searchGeneration;
+                searchMoreButton.remove();
+                const page = await fetchJSON(`/api/search?q=${encodeURIComponent(searchQuery)}&cursor=${nextSearchCursor}`).catch(() => null);
+                if (generation === searchGeneration) showSearchResults(page);
+            }
+            
+            function showSearchResults(page) {
+                if (!page || (page.results.length === 0 && searchResults.childElementCount === 0)) {
+                    const note = document.createElement('div');
+                    note.className = 'load-more';
+                    note.textContent = page ? 'No messages found' : 'Search is unavailable';
+                    searchResults.appendChild(note);
+                    return;
+                }
+                for (const result of page.results) {
+                    searchResults.appendChild(createSearchResult(result));
+                }
+                nextSearchCursor = page.next_cursor;
+                if (nextSearchCursor) searchResults.appendChild(searchMoreButton);
+            }
+            
+            function createSearchResult(result) {
+                const item = document.createElement('div');
+                item.className = 'conversation-item search-result';
                 
-                // Add to the beginning of the array (most recent first)
-                conversations.unshift(newConversation);
-                currentConversationId = newId;
+                const titleSpan = document.createElement('span');
+                titleSpan.className = 'conversation-title';
+                titleSpan.textContent = result.title || 'New conversation';
+                item.appendChild(titleSpan);
                 
-                // Clear the chat container
-                chatContainer.innerHTML = '<div>chat with bear</div><div>type your message</div><br>';
+                // The server escapes the snippet; its only markup is <mark> around the matches
+                const snippet = document.createElement('div');
+                snippet.className = 'search-snippet';
+                snippet.innerHTML = result.snippet;
+                item.appendChild(snippet);
                 
-                // Update UI
-                renderConversationList();
-                saveConversations();
+                item.onclick = () => openSearchResult(result);
+                return item;
             }
             
-            // Load a conversation
-            function loadConversation(id) {
-                const conversation = conversations.find(c => c.id === id);
-                if (!conversation) return;
-                
-                currentConversationId = id;
+            function openSearchResult(result) {
+                const id = result.conversation_id;
+                // The conversation may be older than the pages of the sidebar loaded so far
+                if (!conversationsById.has(id)) {
+                    conversationsById.set(id, { id, title: result.title, updated_at: result.updated_at });
+                }
+                loadConversation(id);
+            }
+            
+            // Start a new chat
+            async function startNewChat() {
+                abortActiveRequest();
+                const newConversation = await postJSON('/api/conversations', {});
                 
-                // Clear the chat container
-                chatContainer.innerHTML = '';
+                // Add to the beginning of the list (most recent first)
+                conversationsById.set(newConversation.id, newConversation);
+                conversationOrder = [newConversation.id, ...conversationOrder];
+                localStore.put('conversations', newConversation);
+                setCurrentConversation(newConversation.id);
                 
-                // Render all messages
-                conversation.messages.forEach(msg => {
-                    if (msg.role === 'user') {
-                        addMessage(`You: ${msg.content}`, 'user-message');
-                    } else if (msg.role === 'assistant') {
-                        addMessage(`LLM: ${msg.content}`, 'llm-message');
-                    }
-                });
+                // Clear the chat
+                setMessages([], null);
                 
                 // Update UI
                 renderConversationList();
             }
             
-            function addMessage(text, className) {
+            function createMessageElement(msg) {
                 const messageDiv = document.createElement('div');
-                messageDiv.className = className;
-                messageDiv.textContent = text;
-                chatContainer.appendChild(messageDiv);
-                chatContainer.scrollTop = chatContainer.scrollHeight;
+                if (msg.role === 'user') {
+                    messageDiv.className = 'user-message';
+                    messageDiv.textContent = `You: ${msg.content}`;
+                } else if (msg.role === 'thinking') {
+                    messageDiv.className = 'thinking';
+                    messageDiv.textContent = msg.content || 'nicebear says...';
+                } else if (msg.role === 'error') {
+                    messageDiv.className = 'llm-message';
+                    messageDiv.textContent = `Error: ${msg.content}`;
+                } else {
+                    messageDiv.className = 'llm-message';
+                    messageDiv.textContent = `LLM: ${msg.content}`;
+                }
+                if (msg.title) messageDiv.title = msg.title;
                 return messageDiv;
             }
             
+            // Stored messages are keyed by their sequence number, the rest get a local key
+            function messageKey(msg) {
+                if (msg.key === undefined) {
+                    msg.key = msg.seq !== undefined ? `seq-${msg.seq}` : `local-${++localKeyCounter}`;
+                }
+                return msg.key;
+            }
+            
+            // Above the messages: the greeting for an empty chat, or the button for earlier messages
+            const chatHeader = document.createElement('div');
+            const chatIntro = document.createElement('div');
+            chatIntro.innerHTML = '<div>chat with bear</div><div>type your message</div><br>';
+            const loadEarlierButton = document.createElement('div');
+            loadEarlierButton.className = 'load-more';
+            loadEarlierButton.textContent = 'Load earlier messages';
+            loadEarlierButton.onclick = () => loadEarlierMessages();
+            chatContainer.replaceChildren(chatHeader);
+            
+            const messageList = new VirtualList(chatContainer, {
+                estimate: 30,
+                key: messageKey,
+                render: createMessageElement,
+                anchored: true,
+            });
+            
+            function renderChatHeader() {
+                if (nextMessageCursor !== null) {
+                    chatHeader.replaceChildren(loadEarlierButton);
+                } else if (messages.length === 0) {
+                    chatHeader.replaceChildren(chatIntro);
+                } else {
+                    chatHeader.replaceChildren();
+                }
+            }
+            
+            function setMessages(list, cursor) {
+                messages = list;
+                nextMessageCursor = cursor;
+                renderChatHeader();
+                messageList.setItems(messages);
+                messageList.scrollToEnd();
+            }
+            
+            // Show a conversation's messages as last kept in IndexedDB, or nothing until the server answers
+            async function showCachedMessages(id) {
+                const cached = await localStore.get('messages', id);
+                if (id !== currentConversationId) return;
+                if (cached) {
+                    setMessages(cached.messages, cached.next_cursor);
+                } else {
+                    setMessages([], null);
+                    chatHeader.replaceChildren();
+                }
+            }
+            
+            // Keep the latest messages of a conversation in IndexedDB
+            function saveMessages(id) {
+                const stored = messages.filter(msg => (msg.role === 'user' || msg.role === 'assistant') && !msg.failed);
+                const kept = stored.slice(-CACHED_MESSAGES);
+                // Messages sent in this session have no sequence number to page back from;
+                // the server's copy replaces the local one as soon as the conversation is opened
+                let cursor = nextMessageCursor;
+                if (kept.length < stored.length) {
+                    cursor = kept[0].seq !== undefined ? kept[0].seq : null;
+                }
+                localStore.put('messages', {
+                    id,
+                    messages: kept.map(({ seq, role, content, title }) => ({ seq, role, content, title })),
+                    next_cursor: cursor,
+                });
+            }
+            
+            // Load a conversation: the local copy first if there is one, then the latest page from the server
+            async function loadConversation(id) {
+                if (id !== currentConversationId) {
+                    abortActiveRequest();
+                    setCurrentConversation(id);
+                    await showCachedMessages(id);
+                    if (id !== currentConversationId) return;
+                }
+                
+                const page = await fetchJSON(`/api/conversations/${encodeURIComponent(id)}/messages`);
+                if (id !== currentConversationId) return;
+                
+                // Only touch the page if the server has something the local copy didn't
+                const same = messages.length === page.messages.length
+                    && messages.every((msg, i) => msg.seq === page.messages[i].seq);
+                if (same) {
+                    nextMessageCursor = page.next_cursor;
+                    renderChatHeader();
+                } else {
+                    setMessages(page.messages, page.next_cursor);
+                }
+                saveMessages(id);
+            }
+            
+            // Prepend the previous page of messages when the user scrolls up
+            async function loadEarlierMessages() {
+                if (nextMessageCursor === null || loadingMore) return;
+                const id = currentConversationId;
+                loadingMore = true;
+                try {
+                    const page = await fetchJSON(`/api/conversations/${encodeURIComponent(id)}/messages?before=${nextMessageCursor}`);
+                    if (id !== currentConversationId) return;
+                    nextMessageCursor = page.next_cursor;
+                    renderChatHeader();
+                    
+                    // The list keeps the messages the user was reading in place
+                    messages = page.messages.concat(messages);
+                    messageList.setItems(messages);
+                } finally {
+                    loadingMore = false;
+                }
+            }
+            
+            chatContainer.addEventListener('scroll', () => {
+                if (chatContainer.scrollTop === 0) loadEarlierMessages();
+            });
+            conversationList.addEventListener('scroll', () => {
+                if (conversationList.scrollTop + conversationList.clientHeight >= conversationList.scrollHeight - 50) {
+                    loadMoreConversations();
+                }
+            });
+            
+            function addMessage(msg) {
+                const follow = messageList.atEnd();
+                messages.push(msg);
+                messageList.setItems(messages);
+                if (follow || msg.role === 'user') messageList.scrollToEnd();
+                return msg;
+            }
+            
+            function removeMessage(msg) {
+                messages = messages.filter(other => other !== msg);
+                messageList.setItems(messages);
+            }
+            
             function getCurrentConversation() {
-                return conversations.find(c => c.id === currentConversationId);
+                return conversationsById.get(currentConversationId);
+            }
+            
+            // The reply being streamed, so it can be stopped when the user moves on
+            let activeRequest = null;
+            
+            function newRequestId() {
+                // randomUUID is only there on https and localhost
+                if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+                return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+            }
+            
+            // Stop the reply being streamed, here and on the server, which stops generating it
+            function abortActiveRequest() {
+                if (!activeRequest) return;
+                // A request sent over the socket is cancelled on it when its signal fires
+                if (!chatSocket.pending.has(activeRequest.id)) {
+                    const body = JSON.stringify({ request_id: activeRequest.id });
+                    if (!navigator.sendBeacon || !navigator.sendBeacon('/api/chat/abort', body)) {
+                        fetch('/api/chat/abort', { method: 'POST', body, keepalive: true }).catch(() => {});
+                    }
+                }
+                activeRequest.controller.abort();
+                activeRequest = null;
+            }
+            
+            // One WebSocket carries the chat requests of every conversation when the server has
+            // it (the ASGI app); replies are matched to their requests by ID. If it can't be
+            // opened, chat goes over HTTP instead.
+            const chatSocket = {
+                socket: null,
+                opening: null,
+                unavailable: false,
+                pending: new Map(),
+                
+                // Resolves to the open socket, or to null if there is none to be had
+                connect() {
+                    if (this.unavailable) return Promise.resolve(null);
+                    if (!this.opening) {
+                        this.opening = new Promise(resolve => {
+                            const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+                            const socket = new WebSocket(`${protocol}//${location.host}/api/ws`);
+                            socket.onopen = () => {
+                                this.socket = socket;
+                                resolve(socket);
+                            };
+                            socket.onmessage = event => this.receive(JSON.parse(event.data));
+                            socket.onclose = () => {
+                                // A socket that never opened means the server has none; one that
+                                // closed later is opened again for the next request
+                                if (!this.socket) this.unavailable = true;
+                                this.socket = null;
+                                this.opening = null;
+                                resolve(null);
+                                for (const entry of this.pending.values()) {
+                                    entry.reject(new Error('The connection to the server was lost'));
+                                }
+                                this.pending.clear();
+                            };
+                        });
+                    }
+                    return this.opening;
+                },
+                
+                receive(message) {
+                    const entry = this.pending.get(message.request_id);
+                    if (!entry) return;
+                    if (message.type === 'queued') {
+                        entry.onQueued(message.position);
+                        return;
+                    }
+                    // Chunks and errors look like the lines of /api/chat/stream
+                    entry.onChunk(message);
+                    if (message.done) {
+                        this.pending.delete(message.request_id);
+                        entry.resolve();
+                    }
+                },
+                
+                // Send a chat request and wait for the last chunk of its reply; returns false
+                // without sending it if there is no socket
+                async chat(body, onChunk, onQueued, signal) {
+                    const socket = await this.connect();
+                    if (!socket) return false;
+                    if (signal.aborted) throw new DOMException('The reply was stopped', 'AbortError');
+                    await new Promise((resolve, reject) => {
+                        this.pending.set(body.request_id, { onChunk, onQueued, resolve, reject });
+                        signal.addEventListener('abort', () => {
+                            if (!this.pending.delete(body.request_id)) return;
+                            socket.send(JSON.stringify({ type: 'cancel', request_id: body.request_id }));
+                            reject(new DOMException('The reply was stopped', 'AbortError'));
+                        });
+                        socket.send(JSON.stringify({ type: 'chat', ...body }));
+                    });
+                    return true;
+                },
+            };
+            
+            // Send a chat request over HTTP, handing each line of the streamed reply to onChunk
+            async function streamOverHttp(body, onChunk, signal) {
+                const response = await fetch('/api/chat/stream', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify(body),
+                    signal,
+                });
+                if (!response.ok || !response.body) {
+                    // A busy server answers 429 with the reason in the body
+                    const data = await response.json().catch(() => ({}));
+                    throw new Error(data.error || `${response.status} ${response.statusText}`);
+                }
+                
+                // Each line of the body is one JSON chunk
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\\n');
+                    buffer = lines.pop();
+                    for (const line of lines) {
+                        if (line.trim()) onChunk(JSON.parse(line));
+                    }
+                }
             }
             
             async function sendMessage() {
@@ -508,53 +5228,96 @@ def create_template_files():
                 const conversation = getCurrentConversation();
                 if (!conversation) return;
                 
+                // A new message replaces a reply still coming in
+                abortActiveRequest();
+                const request = { id: newRequestId(), controller: new AbortController() };
+                activeRequest = request;
+                
                 // Add user message
-                addMessage(`You: ${message}`, 'user-message');
+                addMessage({ role: 'user', content: message });
                 userInput.value = '';
                 
-                // Store the message
-                conversation.messages.push({
-                    role: 'user',
-                    content: message
-                });
+                // The server stores both sides of the exchange; keep the sidebar in step
+                if (!conversation.title) {
+                    conversation.title = message.substring(0, 25) + (message.length > 25 ? '...' : '');
+                    renderConversationTitle(conversation.id);
+                }
+                bumpConversation(conversation.id);
                 
                 // Add thinking message
-                const thinkingDiv = addMessage('nicebear says...', 'thinking');
+                const thinking = addMessage({ role: 'thinking' });
+                
+                let reply = null;
+                
+                // Render tokens as they arrive
+                function onChunk(chunk) {
+                    if (chunk.restart) {
+                        // The answer fell short and a bigger model starts it over
+                        if (reply) {
+                            reply.content = '';
+                            const row = messageList.rowFor(reply);
+                            if (row) row.textContent = '';
+                            messageList.resized(reply);
+                        }
+                        return;
+                    }
+                    const text = chunk.error || chunk.response || '';
+                    if (!reply && (text || chunk.done)) {
+                        // Replace the thinking message with the reply on the first token
+                        removeMessage(thinking);
+                        reply = addMessage({ role: 'assistant', content: '' });
+                    }
+                    if (chunk.error) reply.failed = true;
+                    if (text) {
+                        // Only the new text is added to the page, not the whole reply again
+                        const follow = messageList.atEnd();
+                        reply.content += text;
+                        const row = messageList.rowFor(reply);
+                        if (row) row.append(text);
+                        messageList.resized(reply);
+                        if (follow) messageList.scrollToEnd();
+                    }
+                    if (chunk.done && chunk.eval_count && chunk.eval_duration) {
+                        const tokensPerSecond = chunk.eval_count / (chunk.eval_duration / 1e9);
+                        const model = chunk.model ? `${chunk.model}, ` : '';
+                        reply.title = `${model}${chunk.eval_count} tokens, ${tokensPerSecond.toFixed(1)} tokens/s`;
+                        const row = messageList.rowFor(reply);
+                        if (row) row.title = reply.title;
+                    }
+                }
+                
+                // Only the socket says where a waiting request is in the queue
+                function onQueued(position) {
+                    if (reply) return;
+                    thinking.content = `Waiting for a turn, number ${position} in the queue...`;
+                    const row = messageList.rowFor(thinking);
+                    if (row) row.textContent = thinking.content;
+                    messageList.resized(thinking);
+                }
                 
                 try {
-                    const response = await fetch('/api/chat', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        },
-                        body: JSON.stringify({ message }),
-                    });
-                    
-                    const data = await response.json();
-                    
-                    // Remove thinking message
-                    chatContainer.removeChild(thinkingDiv);
-                    
-                    // Add LLM response
-                    addMessage(`LLM: ${data.response}`, 'llm-message');
-                    
-                    // Store the response
-                    conversation.messages.push({
-                        role: 'assistant',
-                        content: data.response
-                    });
-                    
-                    // Update the conversation list (in case this is the first message)
-                    renderConversationList();
-                    
-                    // Save to localStorage
-                    saveConversations();
+                    const body = { message, conversation_id: conversation.id, request_id: request.id };
+                    if (!await chatSocket.chat(body, onChunk, onQueued, request.controller.signal)) {
+                        await streamOverHttp(body, onChunk, request.controller.signal);
+                    }
+                    if (!reply) {
+                        removeMessage(thinking);
+                        reply = addMessage({ role: 'assistant', content: '' });
+                    }
+                    if (conversation.id === currentConversationId) saveMessages(conversation.id);
                 } catch (error) {
                     // Remove thinking message
-                    chatContainer.removeChild(thinkingDiv);
+                    if (!reply) removeMessage(thinking);
                     
-                    // Add error message
-                    addMessage(`Error: ${error.message}`, 'llm-message');
+                    // Add error message, unless the user stopped the reply by moving on; a reply
+                    // cut short isn't stored, so it isn't kept locally either
+                    if (error.name === 'AbortError') {
+                        if (reply) reply.failed = true;
+                    } else {
+                        addMessage({ role: 'error', content: error.message });
+                    }
+                } finally {
+                    if (activeRequest === request) activeRequest = null;
                 }
             }
             
@@ -565,8 +5328,12 @@ def create_template_files():
                 }
             });
             
+            // Closing or leaving the page stops the reply being generated for it
+            window.addEventListener('pagehide', abortActiveRequest);
+            
             // Initialize
             initTheme();
+            chatSocket.connect();
             loadConversations();
         </script>
     </body>
@@ -574,16 +5341,56 @@ def create_template_files():
     '''
     
     # Write the file with explicit UTF-8 encoding
-    with open('templates/index.html', 'w', encoding='utf-8') as f:
+    with open(os.path.join(template_dir, 'index.html'), 'w', encoding='utf-8') as f:
         f.write(html_content)
 
 if __name__ == '__main__':
-    create_template_files()
-    
-    print("IMPORTANT: Please save your bear images as 'lightbear.png' and 'darkbear.png' in the same directory as this script")
-    
-    # Open browser after a short delay
-    threading.Timer(1.5, open_browser).start()
-    
-    # Run the Flask app
-    app.run(debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Chat with the nicebear model in the browser')
+    parser.add_argument('--production', action='store_true',
+                        help='serve the page on disk without the debugger, the reloader or opening a browser')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on (default 5000)')
+    commands = parser.add_subparsers(dest='command')
+    batch_parser = commands.add_parser('batch', help='answer the prompts in a JSONL file instead of serving',
+                                       description='Answer the prompts in a JSONL file, resuming an interrupted run')
+    batch_parser.add_argument('input', help="JSONL file of prompts, or - for stdin")
+    batch_parser.add_argument('--output', help='JSONL file results are appended to (default INPUT.results.jsonl)')
+    batch_parser.add_argument('--checkpoint', help='progress file to resume from (default OUTPUT.checkpoint)')
+    batch_parser.add_argument('--parallel', type=int, default=BATCH_PARALLEL,
+                              help=f"prompts answered at once (default {BATCH_PARALLEL}, at most {BATCH_MAX_PARALLEL})")
+    batch_parser.add_argument('--id-field',
+                              help=f"field holding each prompt's ID (default the first of {', '.join(BATCH_ID_FIELDS)})")
+    batch_parser.add_argument('--prompt-field',
+                              help=f"field holding each prompt (default the first of {', '.join(BATCH_PROMPT_FIELDS)})")
+    batch_parser.add_argument('--no-cache', action='store_true', help="don't answer from the response cache")
+    args = parser.parse_args()
+
+    if args.command == 'batch':
+        if args.input == '-' and not args.output:
+            batch_parser.error('give --output when reading from stdin')
+        output_path = args.output or f"{os.path.splitext(args.input)[0]}.results.jsonl"
+        checkpoint_path = args.checkpoint or f"{output_path}.checkpoint"
+        try:
+            batch_stats = run_batch_file(args.input, output_path, checkpoint_path, args.parallel, args.id_field,
+                                         args.prompt_field, use_cache=not args.no_cache)
+        except KeyboardInterrupt:
+            sys.exit(f"Interrupted; run the same command again to resume from {checkpoint_path}")
+        print(f"{batch_stats['succeeded']} answered, {batch_stats['failed']} failed, "
+              f"{batch_stats['skipped']} done before; results in {output_path}", file=sys.stderr)
+    elif args.production:
+        # The page is only built if it isn't there yet
+        if not os.path.exists(os.path.join(app.root_path, 'templates', 'index.html')):
+            create_template_files()
+        start_background_tasks()
+        app.run(host=args.host, port=args.port, threaded=True)
+    else:
+        create_template_files()
+
+        print("IMPORTANT: Please save your bear images as 'lightbear.png' and 'darkbear.png' in the same directory as this script")
+
+        # Open browser after a short delay
+        threading.Timer(1.5, open_browser).start()
+        start_background_tasks()
+
+        # Run the Flask app
+        app.run(host=args.host, port=args.port, debug=True)
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""Shared setup: nicebear configured to talk to the mock Ollama server in bench/, with one
+generation slot and one queued request per client so the tests can fill the queue quickly.
+
+Import this before nicebear; nicebear reads its settings at import time.
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+PORT = free_port()
+DATA_DIR = tempfile.mkdtemp(prefix='nicebear-test-')
+os.environ.update({
+    'NICEBEAR_OLLAMA_HOST': f'http://127.0.0.1:{PORT}',
+    'NICEBEAR_MAX_CONCURRENT': '1',
+    'NICEBEAR_MAX_QUEUE_PER_CLIENT': '1',
+    'NICEBEAR_PRELOAD': '0',
+    'NICEBEAR_DB_PATH': os.path.join(DATA_DIR, 'nicebear.db'),
+    'NICEBEAR_TRACE_PATH': '',
+})
+
+import mock_ollama  # noqa: E402
+
+# Slow enough to queue requests behind one another; tests may change its settings for a while
+MOCK = mock_ollama.MockOllama(ttft=0.3, tokens=8, tokens_per_second=40.0, models=('small', 'nicebear'))
+
+_server = None
+
+def start_mock():
+    """Start the mock once for the whole run"""
+    global _server
+    if _server is None:
+        _server = mock_ollama.serve(MOCK, port=PORT)
+    return _server
+
+def run_turn(turn, outcomes):
+    """Prepare and generate a turn in a thread, recording its result or error by request ID"""
+    def run():
+        try:
+            turn.prepare()
+            outcomes[turn.request_id] = turn.generate()
+        except Exception as e:
+            outcomes[turn.request_id] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
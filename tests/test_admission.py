@@ -0,0 +1,66 @@
+"""Admission: requests turned away or aborted in the queue leave it cleanly"""
+
+import unittest
+
+from support import run_turn, start_mock, wait_for
+
+import nicebear
+
+class AdmissionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_mock()
+
+    def test_rejected_turn_retracts_its_user_message(self):
+        outcomes = {}
+        busy = nicebear.ChatTurn('Hold the only slot', use_cache=False, client='other')
+        queued = nicebear.ChatTurn('Wait for the slot', use_cache=False, client='same')
+        threads = [run_turn(busy, outcomes)]
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 1)
+        threads.append(run_turn(queued, outcomes))
+        wait_for(lambda: nicebear.scheduler.stats()['queued'] == 1)
+
+        rejected = nicebear.ChatTurn('Turned away', 'conversation-rejected', client='same')
+        rejected.prepare()
+        self.assertEqual(nicebear.get_conversation('conversation-rejected')['message_count'], 1)
+        with self.assertRaises(nicebear.QueueFull):
+            rejected.generate()
+        conversation = nicebear.get_conversation('conversation-rejected')
+        self.assertEqual(conversation['message_count'], 0)
+        self.assertEqual(conversation['title'], '')
+        self.assertEqual(nicebear.get_messages('conversation-rejected')[0], [])
+
+        for thread in threads:
+            thread.join(10)
+        # Sent again once there is room, the message is stored once
+        again = nicebear.ChatTurn('Turned away', 'conversation-rejected', client='same')
+        again.prepare()
+        again.generate()
+        messages, _ = nicebear.get_messages('conversation-rejected')
+        self.assertEqual([message['role'] for message in messages], ['user', 'assistant'])
+
+    def test_abort_wakes_a_queued_request_of_the_same_client_only(self):
+        outcomes = {}
+        busy = nicebear.ChatTurn('Hold the slot while another waits', use_cache=False, client='other')
+        queued = nicebear.ChatTurn('Wait to be aborted', use_cache=False, client='owner', request_id='queued')
+        threads = [run_turn(busy, outcomes)]
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 1)
+        threads.append(run_turn(queued, outcomes))
+        wait_for(lambda: nicebear.scheduler.stats()['queued'] == 1)
+
+        client = nicebear.app.test_client()
+        response = client.post('/api/chat/abort', json={'request_id': 'queued'}, headers={'X-Client-ID': 'stranger'})
+        self.assertEqual(response.status_code, 404)
+        response = client.post('/api/chat/abort', json={'request_id': 'queued'}, headers={'X-Client-ID': 'owner'})
+        self.assertEqual(response.status_code, 200)
+        # Out of the queue at once, well before the request holding the slot is done
+        threads[1].join(1)
+        self.assertFalse(threads[1].is_alive())
+        self.assertIsInstance(outcomes['queued'], nicebear.GenerationCancelled)
+        self.assertEqual(nicebear.scheduler.stats()['queued'], 0)
+        threads[0].join(10)
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""The HTTP routes, driven through the ASGI app with ASGI messages and through Flask"""
+
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from support import start_mock
+
+import nicebear
+
+async def call(method, path, body=b'', query=b''):
+    """Run one HTTP request through the ASGI app; returns (status, body)"""
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'path': path, 'query_string': query,
+             'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+             'scheme': 'http', 'root_path': '',
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 40000)}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # The client stays connected until the response is over
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    await nicebear.asgi_app(scope, receive, send)
+    status = next(message['status'] for message in sent if message['type'] == 'http.response.start')
+    return status, b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+
+class AsgiTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_mock()
+
+    def test_flask_routes_are_served_while_a_batch_streams(self):
+        prompts = b''.join(json.dumps({'prompt': f"Batch prompt {i}"}).encode() + b'\n' for i in range(4))
+
+        async def run():
+            batch = asyncio.create_task(call('POST', '/api/batch', prompts, b'parallel=1&cache=false'))
+            await asyncio.sleep(0.2)
+            status, body = await asyncio.wait_for(call('GET', '/api/stats'), 1)
+            self.assertEqual(status, 200)
+            self.assertIn('scheduler', json.loads(body))
+            self.assertFalse(batch.done())
+            status, body = await batch
+            self.assertEqual(status, 200)
+            return [json.loads(line) for line in body.splitlines()]
+
+        lines = asyncio.run(run())
+        self.assertEqual(lines[-1]['succeeded'], 4)
+
+    def test_malformed_chat_bodies_are_rejected(self):
+        async def run():
+            for path in ('/api/chat', '/api/chat/stream'):
+                for body in (b'{"message": 42}', b'["hello"]', b'not json', b'{"message": "hi", "conversation_id": {}}'):
+                    status, _ = await call('POST', path, body)
+                    self.assertEqual(status, 400, (path, body))
+
+        asyncio.run(run())
+        client = nicebear.app.test_client()
+        for path in ('/api/chat', '/api/chat/stream'):
+            for body in ('{"message": 42}', '["hello"]', 'not json'):
+                response = client.post(path, data=body, content_type='application/json')
+                self.assertEqual(response.status_code, 400, (path, body))
+
+    def test_websocket_cancel_gets_through_while_the_client_is_not_reading(self):
+        async def run():
+            stuck = asyncio.Event()
+            incoming = asyncio.Queue()
+            for message in ({'type': 'websocket.connect'},
+                            {'type': 'websocket.receive', 'text': json.dumps(
+                                {'type': 'chat', 'message': 'A slow reader', 'request_id': 'slow', 'cache': False})}):
+                incoming.put_nowait(message)
+
+            async def send(message):
+                if message['type'] == 'websocket.send':
+                    # The client never reads, so nothing sent gets through
+                    await stuck.wait()
+
+            channel = nicebear.WebSocketChannel({'type': 'websocket', 'headers': [], 'client': ('127.0.0.1', 1)},
+                                                incoming.get, send)
+            task = asyncio.create_task(channel.run())
+            while not channel.outbox.full():
+                await asyncio.sleep(0.01)
+            turn = channel.turns['slow']
+            # A reply that can't be queued must not hold up the cancel behind it
+            for text in (json.dumps({'type': 'ping'}), json.dumps({'type': 'cancel', 'request_id': 'slow'})):
+                incoming.put_nowait({'type': 'websocket.receive', 'text': text})
+            for _ in range(100):
+                if turn.cancelled is not None:
+                    break
+                await asyncio.sleep(0.01)
+            incoming.put_nowait({'type': 'websocket.disconnect'})
+            await asyncio.wait_for(task, 5)
+            return turn.cancelled
+
+        with mock.patch.object(nicebear, 'WS_SEND_QUEUE', 2):
+            self.assertEqual(asyncio.run(run()), 'abort')
+
+if __name__ == '__main__':
+    unittest.main()
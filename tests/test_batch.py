@@ -0,0 +1,79 @@
+"""Batch runs stopped partway and resumed from their checkpoint"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from support import start_mock
+
+import nicebear
+
+def batch_lines(count):
+    return [json.dumps({'id': f'item-{n}', 'prompt': f'batch prompt number {n}'}) + '\n' for n in range(count)]
+
+class BatchResumeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_mock()
+
+    def test_interrupted_run_resumes_where_it_stopped(self):
+        lines = batch_lines(5)
+        checkpoint = nicebear.BatchCheckpoint()
+        results = iter(nicebear.BatchRun(lines, 1, checkpoint, use_cache=False))
+        first = [next(results)['id'] for _ in range(2)]
+        results.close()
+        self.assertEqual(first, ['item-0', 'item-1'])
+        self.assertEqual(checkpoint.watermark, 2)
+
+        # Through the checkpoint file, as the CLI would between runs
+        path = os.path.join(tempfile.mkdtemp(prefix='nicebear-batch-'), 'checkpoint.json')
+        checkpoint.save(path)
+        run = nicebear.BatchRun(lines, 1, nicebear.BatchCheckpoint.load(path), use_cache=False)
+        rest = [result['id'] for result in run]
+        self.assertEqual(rest, ['item-2', 'item-3', 'item-4'])
+        self.assertEqual((run.stats()['skipped'], run.stats()['succeeded']), (2, 3))
+        self.assertEqual(run.stats()['checkpoint'], {'watermark': 5, 'done': []})
+
+    def test_lines_done_above_the_watermark_are_skipped(self):
+        run = nicebear.BatchRun(batch_lines(4), 1, nicebear.BatchCheckpoint(1, [2]), use_cache=False)
+        self.assertEqual(sorted(result['id'] for result in run), ['item-1', 'item-3'])
+        self.assertEqual(run.stats()['skipped'], 2)
+
+    def test_bad_lines_are_reported_and_count_as_done(self):
+        lines = ['not json\n', '\n', json.dumps({'id': 'x'}) + '\n'] + batch_lines(1)
+        run = nicebear.BatchRun(lines, 1, use_cache=False)
+        results = list(run)
+        self.assertEqual([result['id'] for result in results], [1, 3, 'item-0'])
+        self.assertTrue(all('error' in result for result in results[:2]))
+        self.assertEqual((run.stats()['failed'], run.stats()['succeeded']), (2, 1))
+        self.assertEqual(run.stats()['checkpoint']['watermark'], 4)
+
+    def test_resume_drops_output_written_after_the_checkpoint(self):
+        directory = tempfile.mkdtemp(prefix='nicebear-batch-')
+        input_path, output_path, checkpoint_path = (os.path.join(directory, name)
+                                                    for name in ('in.jsonl', 'out.jsonl', 'checkpoint.json'))
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.writelines(batch_lines(4))
+        # A run that checkpointed after two results, then wrote a third before it was killed
+        kept = ''.join(json.dumps({'id': f'item-{n}', 'response': 'earlier'}) + '\n' for n in range(2))
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(kept + json.dumps({'id': 'item-2', 'response': 'lost'}) + '\n')
+        nicebear.BatchCheckpoint(2, output_size=len(kept.encode('utf-8'))).save(checkpoint_path)
+
+        stats = nicebear.run_batch_file(input_path, output_path, checkpoint_path, parallel=1, use_cache=False)
+        with open(output_path, encoding='utf-8') as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual([result['id'] for result in results], ['item-0', 'item-1', 'item-2', 'item-3'])
+        self.assertNotEqual(results[2]['response'], 'lost')
+        self.assertEqual((stats['skipped'], stats['succeeded']), (2, 2))
+        saved = nicebear.BatchCheckpoint.load(checkpoint_path)
+        self.assertEqual((saved.watermark, saved.output_size), (4, os.path.getsize(output_path)))
+
+        # Running it again finds nothing left to do
+        self.assertEqual(nicebear.run_batch_file(input_path, output_path, checkpoint_path, parallel=1)['skipped'], 4)
+        self.assertEqual(os.path.getsize(output_path), saved.output_size)
+
+if __name__ == '__main__':
+    unittest.main()
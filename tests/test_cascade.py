@@ -0,0 +1,77 @@
+"""Routing a prompt to the smallest model that can answer it, and asking a bigger one when it can't"""
+
+import unittest
+from unittest import mock
+
+from support import MOCK, start_mock
+
+import nicebear
+
+class CascadeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_mock()
+
+    def setUp(self):
+        self.router = nicebear.ModelRouter(['small', 'nicebear'], 150, 12, r'\bproof\b', r"\bI don't know\b")
+        for patcher in (mock.patch.object(nicebear, 'model_router', self.router),
+                        mock.patch.object(nicebear, 'MODEL_TIERS', ['small', 'nicebear']),
+                        mock.patch.dict(MOCK.unsure, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ask(self, message):
+        turn = nicebear.ChatTurn(message, use_cache=False)
+        turn.prepare()
+        turn.generate()
+        return turn
+
+    def test_small_model_answers_easy_prompt(self):
+        turn = self.ask('hello there')
+        self.assertEqual(turn.response_fields()['model'], 'small')
+        self.assertFalse(turn.response_fields()['escalated'])
+        tiers = self.router.stats()['tiers']
+        self.assertEqual((tiers['small']['answered'], tiers['small']['escalated']), (1, 0))
+        self.assertEqual(tiers['nicebear']['answered'], 0)
+
+    def test_hard_prompt_goes_to_the_bigger_model(self):
+        turn = self.ask('write a proof that there are infinitely many primes')
+        self.assertEqual(turn.response_fields()['model'], 'nicebear')
+        self.assertEqual(self.router.stats()['tiers']['nicebear']['routed'], {'classifier': 1})
+
+    def test_unsure_answer_is_asked_again_of_the_bigger_model(self):
+        MOCK.unsure['small:latest'] = 1.0
+        chunks = list(nicebear.cascade_stream({'model': 'small', 'prompt': 'hello there'}))
+        restarts = [chunk for chunk in chunks if chunk.get('restart')]
+        self.assertEqual(restarts, [{'model': 'nicebear', 'response': '', 'done': False, 'restart': True}])
+        # The reader drops what came before the restart
+        after = chunks[chunks.index(restarts[0]) + 1:]
+        self.assertNotIn("I don't know", ''.join(chunk.get('response', '') for chunk in after))
+        self.assertTrue(after[-1]['done'])
+        tiers = self.router.stats()['tiers']
+        self.assertEqual((tiers['small']['answered'], tiers['small']['escalated']), (0, 1))
+        self.assertEqual(tiers['nicebear']['answered'], 1)
+
+        turn = self.ask('hello again')
+        fields = turn.response_fields()
+        self.assertEqual((fields['model'], fields['escalated']), ('nicebear', True))
+        self.assertNotIn("I don't know", turn.result['response'])
+
+    def test_largest_model_keeps_its_answer(self):
+        MOCK.unsure.update({'small:latest': 1.0, 'nicebear:latest': 1.0})
+        turn = self.ask('hello there')
+        fields = turn.response_fields()
+        self.assertEqual((fields['model'], fields['escalated']), ('nicebear', True))
+        self.assertIn("I don't know", turn.result['response'])
+        tiers = self.router.stats()['tiers']
+        self.assertEqual((tiers['nicebear']['answered'], tiers['nicebear']['escalated']), (1, 0))
+
+    def test_retry_picks_the_next_tier_up(self):
+        self.assertEqual(self.router.retry('small'), ('nicebear', 'retry'))
+        self.assertEqual(self.router.retry('nicebear'), ('nicebear', 'retry'))
+        self.assertIsNone(self.router.escalation('small', 'A fine answer.'))
+        self.assertEqual(self.router.escalation('small', '   '), 'nicebear')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Shared generations: the requests joined to one must get an answer whatever its leader does"""
+
+import asyncio
+import unittest
+
+from support import MOCK, run_turn, start_mock, wait_for
+
+import nicebear
+
+class CoalescingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_mock()
+
+    def test_leader_cancelled_while_queued_hands_off_to_follower(self):
+        outcomes = {}
+        busy = nicebear.ChatTurn('Hold the only slot', use_cache=False, request_id='busy')
+        leader = nicebear.ChatTurn('Shared question', request_id='leader')
+        follower = nicebear.ChatTurn('Shared question', request_id='follower')
+        threads = [run_turn(busy, outcomes)]
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 1)
+        threads.append(run_turn(leader, outcomes))
+        wait_for(lambda: nicebear.coalescer.stats()['in_flight'] == 1)
+        threads.append(run_turn(follower, outcomes))
+        wait_for(lambda: follower.follower)
+        leader.cancel('abort')
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive(), "a request never finished")
+
+        self.assertIsInstance(outcomes['leader'], nicebear.GenerationCancelled)
+        self.assertIsInstance(outcomes['follower'], dict)
+        self.assertTrue(outcomes['follower']['response'])
+        wait_for(lambda: nicebear.coalescer.stats()['in_flight'] == 0)
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 0)
+
+    def test_leader_cancelled_while_queued_alone_ends_the_generation(self):
+        outcomes = {}
+        busy = nicebear.ChatTurn('Hold the only slot again', use_cache=False, request_id='busy-alone')
+        leader = nicebear.ChatTurn('Question nobody else asks', request_id='leader-alone')
+        threads = [run_turn(busy, outcomes)]
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 1)
+        threads.append(run_turn(leader, outcomes))
+        wait_for(lambda: nicebear.coalescer.stats()['in_flight'] == 1)
+        leader.cancel('abort')
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive(), "a request never finished")
+
+        self.assertIsInstance(outcomes['leader-alone'], nicebear.GenerationCancelled)
+        self.assertEqual(nicebear.coalescer.stats()['in_flight'], 0)
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 0)
+        self.assertEqual(nicebear.response_cache.get(leader.cache_key), None)
+
+    def test_async_leader_cancelled_while_queued_hands_off_to_follower(self):
+        busy = nicebear.ChatTurn('Hold the only slot from a coroutine', use_cache=False)
+        leader = nicebear.ChatTurn('Shared question from a coroutine')
+        follower = nicebear.ChatTurn('Shared question from a coroutine')
+
+        async def run():
+            tasks = []
+            for turn in (busy, leader, follower):
+                turn.prepare()
+                task = asyncio.create_task(turn.async_generate())
+                turn.interrupt = task.cancel
+                tasks.append(task)
+                await asyncio.sleep(0.05)
+            leader.cancel('abort')
+            return await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 10)
+
+        _, cancelled, reply = asyncio.run(run())
+        self.assertIsInstance(cancelled, asyncio.CancelledError)
+        self.assertTrue(follower.follower)
+        self.assertTrue(reply['response'])
+        self.assertEqual(nicebear.coalescer.stats()['in_flight'], 0)
+        self.assertEqual(nicebear.scheduler.stats()['active'], 0)
+
+    def test_malformed_upstream_line_ends_the_shared_generation(self):
+        outcomes = {}
+        MOCK.malformed_rate = 1.0
+        try:
+            leader = nicebear.ChatTurn('Question answered with garbage', request_id='garbled-leader')
+            followers = [nicebear.ChatTurn('Question answered with garbage', request_id=f'garbled-{i}')
+                         for i in range(2)]
+            threads = [run_turn(leader, outcomes)]
+            wait_for(lambda: nicebear.coalescer.stats()['in_flight'] == 1)
+            threads += [run_turn(follower, outcomes) for follower in followers]
+            wait_for(lambda: all(follower.follower for follower in followers))
+            for thread in threads:
+                thread.join(10)
+                self.assertFalse(thread.is_alive(), "a request never finished")
+        finally:
+            MOCK.malformed_rate = 0.0
+
+        for request_id in ('garbled-leader', 'garbled-0', 'garbled-1'):
+            self.assertIsInstance(outcomes[request_id], nicebear.OllamaError)
+        wait_for(lambda: nicebear.coalescer.stats()['in_flight'] == 0)
+        wait_for(lambda: nicebear.scheduler.stats()['active'] == 0)
+
+if __name__ == '__main__':
+    unittest.main()
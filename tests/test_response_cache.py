@@ -0,0 +1,62 @@
+"""The exact-match response cache: keys, expiry, eviction and the SQLite copy"""
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import support  # noqa: F401
+
+import nicebear
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_key_ignores_whitespace_and_unrelated_fields(self):
+        payload = {'model': 'nicebear', 'prompt': 'hello   there'}
+        self.assertEqual(nicebear.cache_key(payload),
+                         nicebear.cache_key({**payload, 'prompt': ' hello there\n', 'stream': True, 'keep_alive': '5m'}))
+        self.assertNotEqual(nicebear.cache_key(payload), nicebear.cache_key({**payload, 'model': 'small'}))
+        self.assertNotEqual(nicebear.cache_key(payload),
+                            nicebear.cache_key({**payload, 'options': {'temperature': 0}}))
+
+    def test_entries_expire(self):
+        cache = nicebear.ResponseCache(4, 60)
+        cache.put('a', {'response': 'A'})
+        self.assertEqual(cache.get('a'), {'response': 'A'})
+        later = time.time() + 61
+        with mock.patch.object(nicebear.time, 'time', return_value=later):
+            self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses'], stats['expirations']), (0, 1, 1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = nicebear.ResponseCache(2, 60)
+        cache.put('a', {'response': 'A'})
+        cache.put('b', {'response': 'B'})
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', {'response': 'C'})
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_disabled_cache_stores_nothing(self):
+        cache = nicebear.ResponseCache(0, 60)
+        cache.put('a', {'response': 'A'})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_entries_survive_a_restart_until_they_expire(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='nicebear-cache-'), 'cache.db')
+        nicebear.ResponseCache(4, 60, path).put('a', {'response': 'A'})
+
+        reopened = nicebear.ResponseCache(4, 60, path)
+        self.assertEqual(reopened.get('a'), {'response': 'A'})
+        self.assertEqual(reopened.stats()['entries'], 1)
+        later = time.time() + 61
+        with mock.patch.object(nicebear.time, 'time', return_value=later):
+            self.assertIsNone(nicebear.ResponseCache(4, 60, path).get('a'))
+
+if __name__ == '__main__':
+    unittest.main()
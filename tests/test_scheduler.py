@@ -0,0 +1,82 @@
+"""Who gets the next generation slot"""
+
+import threading
+import time
+import unittest
+
+from support import wait_for
+
+import nicebear
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = nicebear.Scheduler(1, 10, 10, 5)
+        self.ticket = self.scheduler.acquire('holder')
+
+    def queue(self, *requests):
+        waiters = []
+        for client, priority in requests:
+            waiter = nicebear.SchedulerWaiter(client, priority)
+            self.assertFalse(self.scheduler.enqueue(waiter))
+            waiters.append(waiter)
+        return waiters
+
+    def serve_all(self, waiters):
+        """Release the slot one generation at a time and return who got it, in order"""
+        order = []
+        for _ in waiters:
+            self.scheduler.release(self.ticket)
+            granted = [waiter for waiter in waiters if waiter.granted and waiter not in order]
+            self.assertEqual(len(granted), 1)
+            order.extend(granted)
+            self.ticket = time.monotonic()
+        return order
+
+    def test_clients_take_turns(self):
+        a1, a2, a3, b1, b2 = self.queue(('a', 'normal'), ('a', 'normal'), ('a', 'normal'),
+                                        ('b', 'normal'), ('b', 'normal'))
+        self.assertEqual([self.scheduler.position(waiter) for waiter in (a1, b1, a2, b2, a3)], [1, 2, 3, 4, 5])
+        # A burst from one client doesn't hold up the one that asked after it
+        self.assertEqual(self.serve_all([a1, a2, a3, b1, b2]), [a1, b1, a2, b2, a3])
+        self.assertEqual(self.scheduler.stats()['queued'], 0)
+
+    def test_higher_priority_goes_first(self):
+        low, normal, high = self.queue(('a', 'low'), ('b', 'normal'), ('c', 'high'))
+        self.assertEqual(self.scheduler.depth('normal'), 2)
+        self.assertEqual(self.scheduler.position(low), 3)
+        self.assertEqual(self.serve_all([low, normal, high]), [high, normal, low])
+
+    def test_per_client_queue_is_capped(self):
+        scheduler = nicebear.Scheduler(1, 10, 2, 5)
+        scheduler.acquire('holder')
+        for _ in range(2):
+            self.assertFalse(scheduler.enqueue(nicebear.SchedulerWaiter('a', 'normal')))
+        with self.assertRaises(nicebear.QueueFull):
+            scheduler.enqueue(nicebear.SchedulerWaiter('a', 'normal'))
+        # Another client still gets in line
+        self.assertFalse(scheduler.enqueue(nicebear.SchedulerWaiter('b', 'normal')))
+        self.assertEqual(scheduler.stats()['rejected'], 1)
+
+    def test_cancelled_waiter_gives_up_its_place(self):
+        waiters = []
+        errors = []
+
+        def wait():
+            try:
+                self.scheduler.acquire('a', on_wait=waiters.append)
+            except nicebear.GenerationCancelled as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        wait_for(lambda: waiters)
+        later, = self.queue(('b', 'normal'))
+        waiters[0].cancel()
+        thread.join(5)
+        self.assertEqual(len(errors), 1)
+        self.scheduler.release(self.ticket)
+        self.assertTrue(later.granted)
+
+if __name__ == '__main__':
+    unittest.main()
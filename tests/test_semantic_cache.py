@@ -0,0 +1,116 @@
+"""The semantic cache, with the mock as the embedding server"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from support import start_mock
+
+import nicebear
+
+@unittest.skipIf(nicebear.np is None, "the semantic cache needs numpy")
+class SemanticCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_mock()
+
+    def reply(self, text):
+        return {'response': text, 'total_duration': int(2e9), 'context': [1, 2, 3]}
+
+    def test_paraphrase_hits_and_unrelated_prompt_misses(self):
+        cache = nicebear.SemanticCache(8, 0.8)
+        reply, _, vector = cache.lookup('how do I reset my password', 1)
+        self.assertIsNone(reply)
+        cache.add(vector, 1, self.reply('Go to settings.'))
+
+        reply, similarity, _ = cache.lookup('how do I reset my password please', 1)
+        self.assertEqual(reply['response'], 'Go to settings.')
+        self.assertGreaterEqual(similarity, 0.8)
+        # The stored reply can't continue a conversation it wasn't part of
+        self.assertNotIn('context', reply)
+        self.assertIsNone(cache.lookup('what is the capital of france', 1)[0])
+        stats = cache.stats()
+        self.assertEqual((stats['lookups'], stats['hits']), (3, 1))
+        self.assertAlmostEqual(stats['generation_seconds_saved'], 2.0)
+
+    def test_scopes_do_not_mix(self):
+        cache = nicebear.SemanticCache(8, 0.8)
+        _, _, vector = cache.lookup('tell me about bears', 1)
+        cache.add(vector, 1, self.reply('Bears are big.'))
+        self.assertIsNone(cache.lookup('tell me about bears', 2)[0])
+        self.assertIsNotNone(cache.lookup('tell me about bears', 1)[0])
+
+    def test_batched_top_k_search(self):
+        cache = nicebear.SemanticCache(8, 0.8)
+        prompts = ['tell me about bears', 'tell me about fish', 'tell me about honey']
+        for (_, _, vector), prompt in zip(cache.lookup_many(prompts, 1), prompts):
+            cache.add(vector, 1, self.reply(prompt))
+        matches = cache.search(cache.vectors(['tell me about bears', 'tell me about honey']), 1, k=2)
+        self.assertEqual([len(best) for best in matches], [2, 2])
+        self.assertEqual([best[0][1] for best in matches], [0, 2])
+        self.assertTrue(all(best[0][0] >= best[1][0] for best in matches))
+        found = cache.lookup_many(['tell me about fish', 'something else entirely'], 1)
+        self.assertEqual(found[0][0]['response'], 'tell me about fish')
+        self.assertIsNone(found[1][0])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = nicebear.SemanticCache(2, 0.8)
+        for prompt in ('first prompt about bears', 'second prompt about fish'):
+            _, _, vector = cache.lookup(prompt, 1)
+            cache.add(vector, 1, self.reply(prompt))
+        # Using the first one makes the second the least recently used
+        self.assertIsNotNone(cache.lookup('first prompt about bears', 1)[0])
+        _, _, vector = cache.lookup('third prompt about honey', 1)
+        cache.add(vector, 1, self.reply('third prompt about honey'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertIsNotNone(cache.lookup('first prompt about bears', 1)[0])
+        self.assertIsNone(cache.lookup('second prompt about fish', 1)[0])
+
+    def test_persisted_entries_are_reloaded(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='nicebear-semantic-'), 'cache')
+        cache = nicebear.SemanticCache(4, 0.8, path)
+        _, _, vector = cache.lookup('how do bears sleep', 1)
+        cache.add(vector, 1, self.reply('All winter.'))
+        cache.db.close()
+
+        reopened = nicebear.SemanticCache(4, 0.8, path)
+        self.assertEqual(reopened.lookup('how do bears sleep', 1)[0], {'response': 'All winter.',
+                                                                      'total_duration': int(2e9)})
+        reopened.db.close()
+        # A different size starts over rather than guess which rows to keep
+        resized = nicebear.SemanticCache(8, 0.8, path)
+        self.assertIsNone(resized.lookup('how do bears sleep', 1)[0])
+
+    def test_new_embedding_size_clears_the_persisted_entries(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='nicebear-semantic-'), 'cache')
+        cache = nicebear.SemanticCache(4, 0.8, path, embed=lambda texts: [[1.0] * 16 for _ in texts])
+        _, _, vector = cache.lookup('a question', 1)
+        cache.add(vector, 1, self.reply('An answer.'))
+        cache.db.close()
+
+        reopened = nicebear.SemanticCache(4, 0.8, path, embed=lambda texts: [[1.0] * 32 for _ in texts])
+        reply, _, vector = reopened.lookup('a question', 1)
+        self.assertIsNone(reply)
+        reopened.add(vector, 1, self.reply('Another answer.'))
+        self.assertEqual(reopened.stats()['entries'], 1)
+        self.assertEqual(reopened.lookup('a question', 1)[0]['response'], 'Another answer.')
+
+    def test_chat_is_answered_from_a_near_duplicate(self):
+        with mock.patch.object(nicebear, 'semantic_cache', nicebear.SemanticCache(8, 0.8)):
+            first = nicebear.ChatTurn('how can I change the color of my bear')
+            first.prepare()
+            first.generate()
+            self.assertIsNone(first.similarity)
+
+            second = nicebear.ChatTurn('how can I change the color of my bear today')
+            second.prepare()
+            result = second.generate()
+        self.assertEqual(result['response'], first.result['response'])
+        fields = second.response_fields()
+        self.assertTrue(fields['cached'])
+        self.assertGreaterEqual(fields['similarity'], 0.8)
+
+if __name__ == '__main__':
+    unittest.main()
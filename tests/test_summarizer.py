@@ -0,0 +1,40 @@
+"""Summaries fold a long stretch of conversation in prompts that each fit the budget"""
+
+import unittest
+from unittest import mock
+
+from support import start_mock
+
+import nicebear
+
+class SummarizerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_mock()
+
+    def test_folds_in_budget_sized_chunks(self):
+        messages = [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"Message {i} " + 'word ' * 40}
+                    for i in range(30)]
+        nicebear.create_conversation('conversation-long', messages)
+        prompts = []
+
+        def generate(data, conversation_id=None):
+            prompts.append(data['prompt'])
+            return real_generate(data, conversation_id)
+
+        real_generate = nicebear.ollama_generate
+        with mock.patch.object(nicebear, 'PROMPT_TOKEN_BUDGET', 400), \
+                mock.patch.object(nicebear, 'ollama_generate', generate):
+            summarizer = nicebear.Summarizer()
+            summarizer.summarize('conversation-long', 25)
+
+        self.assertGreater(len(prompts), 1)
+        self.assertTrue(all(nicebear.count_tokens(prompt) <= 400 for prompt in prompts))
+        # Every message before the window was folded in, once
+        self.assertEqual(sum(prompt.count('Message ') for prompt in prompts), 25)
+        self.assertEqual(nicebear.get_conversation('conversation-long')['summarized_seq'], 25)
+        self.assertEqual(summarizer.stats()['messages_folded'], 25)
+
+if __name__ == '__main__':
+    unittest.main()